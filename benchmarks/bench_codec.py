@@ -0,0 +1,64 @@
+"""Compare encode/decode ns per msg and bytes on the wire of the JSON and binary codecs.
+
+Run from the repo root:
+> python benchmarks/bench_codec.py --rounds 100000
+"""
+import time
+import click
+
+from system.codec import CODECS
+from system.histogram import KINDS
+
+MESSAGES = {
+    "sendmsg": {"message_type": "sendmsg", "msg_id": 123456, "phone": "123456789",
+                "msg": "x" * 50},
+    "sendmsg_batch": {"message_type": "sendmsg_batch",
+                      "tasks": [[123456 + i, "123456789", "x" * 50] for i in range(16)]},
+    "finished": {"message_type": "finished", "sender_port": 6001, "msg_id": 123456,
+                 "success": True, "send_time": 9.87654321, "credits": 1},
+    "finished_batch": {"message_type": "finished_batch", "sender_port": 6001,
+                       "results": [[123456 + i, True, 9.87654321] for i in range(16)],
+                       "credits": 16},
+    "stats": {"message_type": "stats", "seq": 1234, "num_sent": 16, "num_fail": 1,
+              "total_time": 98.7654321,
+              "histograms": {kind: [[70 + i, 2] for i in range(4)] for kind in KINDS},
+              "senders": {str(6001 + i): [[70, 4]] for i in range(4)},
+              "retries": {"first_try": 15, "retried": 1, "exhausted": 0},
+              "dedup": {"suppressed": 0, "coalesced": 0}, "backlog": 1000,
+              "producer_port": 6000},
+    "query": {"message_type": "status"},
+}
+
+
+def per_msg_ns(func, rounds):
+    """Return the ns one call of func takes on average."""
+    start = time.perf_counter_ns()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter_ns() - start) / rounds
+
+
+def measure(codec, msg, rounds):
+    """Return (encode ns, decode ns, bytes) of msg in codec."""
+    frame = codec.encode(msg)
+    decoder = codec.decoder()
+    encode_ns = per_msg_ns(lambda: codec.encode(msg), rounds)
+    decode_ns = per_msg_ns(lambda: decoder.feed(frame), rounds)
+    return encode_ns, decode_ns, len(frame)
+
+
+@click.command()
+@click.option("--rounds", "rounds", default=100000)
+def main(rounds):
+    """Run the codec benchmark."""
+    print("{:<15} {:<7} {:>10} {:>10} {:>7}".format(
+        "msg", "codec", "encode ns", "decode ns", "bytes"))
+    for label, msg in MESSAGES.items():
+        for name, codec in CODECS.items():
+            encode_ns, decode_ns, size = measure(codec, msg, rounds)
+            print("{:<15} {:<7} {:>10.0f} {:>10.0f} {:>7}".format(
+                label, name, encode_ns, decode_ns, size))
+
+
+if __name__ == '__main__':
+    main()
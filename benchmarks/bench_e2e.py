@@ -0,0 +1,269 @@
+"""Push msgs through real Producer, Monitor and Sender processes and record the results.
+
+Every scenario launches a Producer, a Monitor and N zero-delay Senders on
+localhost, waits for the Senders to register, streams --msg-num alerts into the
+Producer's ingest port and times them until all are delivered. It reports
+msgs/sec, enqueue to delivered percentiles, and CPU secs and peak RSS of every
+process, and stores it all as JSON to compare across commits.
+
+Run from the repo root:
+> python benchmarks/bench_e2e.py --senders 1,10,100 --msg-num 20000
+
+> python benchmarks/bench_e2e.py --compare benchmarks/results/e2e-<old>.json
+"""
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import click
+
+from system import Monitor
+from system.histogram import PERCENTILES
+from system.utils import send_msg_tcp
+
+COMPONENTS = {
+    "producer": "system.producer.__main__",
+    "sender": "system.sender.__main__",
+    "monitor": "system.monitor.__main__",
+}
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def launch(component, *args):
+    """Start a component in a process of its own, its log thrown away."""
+    command = [sys.executable, "-c", "from {} import main; main()".format(COMPONENTS[component])]
+    return subprocess.Popen(command + [str(arg) for arg in args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def cpu_secs(pid):
+    """Return user plus system CPU secs of pid so far, None where /proc is missing."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat:
+            # fields after the parenthesized command name, utime and stime are 14 and 15
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def peak_rss_mb(pid):
+    """Return the peak resident set size of pid in MB, None where /proc is missing."""
+    try:
+        with open("/proc/{}/status".format(pid)) as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def scrape(metrics_port, name):
+    """Return the value of the unlabeled metric name, None if unreachable."""
+    url = "http://localhost:{}/metrics".format(metrics_port)
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            text = response.read().decode("utf-8")
+    except OSError:
+        return None
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return None
+
+
+def wait_until(condition, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise click.ClickException("Timed out waiting for " + what)
+        time.sleep(0.05)
+
+
+def stream_alerts(ingest_port, msg_num):
+    """Stream msg_num CSV alerts into the Producer in one connection."""
+    msg = "x" * 60
+    rows = "".join("{:09d},{}\n".format(n, msg) for n in range(msg_num))
+    with socket.create_connection(("localhost", ingest_port)) as sock:
+        sock.sendall(("phone,msg\n" + rows).encode("utf-8"))
+
+
+def run_scenario(num_senders, msg_num, port, options):
+    """Run one scenario and return its results."""
+    monitor_port, producer_port, ingest_port = port, port + 1, port + 2
+    metrics_port, observer_port = port + 3, port + 4
+    # every component talks over Unix sockets here instead of TCP
+    transport = []
+    if options["socket_dir"] is not None:
+        transport = ["--socket-dir", options["socket_dir"]]
+    processes = {}
+    observer = None
+    try:
+        processes["monitor"] = launch(
+            "monitor", "--port", monitor_port, "--producer-port", producer_port,
+            "--N", 3600, "--codec", options["codec"], *transport,
+        )
+        processes["producer"] = launch(
+            "producer", "--port", producer_port, "--monitor-port", monitor_port,
+            "--msg-num", 0, "--ingest-port", ingest_port, "--high-water", 2 * msg_num,
+            "--metrics-port", metrics_port, "--batch-size", options["batch_size"],
+            "--scheduler", options["scheduler"], "--codec", options["codec"],
+            "--server-mode", options["server_mode"], *transport,
+        )
+        wait_until(lambda: scrape(metrics_port, "sms_senders") is not None, 30, "the Producer")
+        for n in range(num_senders):
+            processes["sender-{}".format(n)] = launch(
+                "sender", "--port", port + 10 + n, "--producer-port", producer_port,
+                "--mean-time", 0, "--std-time", 0, "--failure-rate", 0,
+                "--window", options["window"], "--batch-size", options["batch_size"],
+                "--codec", options["codec"], "--server-mode", options["server_mode"], *transport,
+            )
+        wait_until(lambda: scrape(metrics_port, "sms_senders") == num_senders,
+                   30 + num_senders, "the Senders to register")
+
+        # watches the stats the Producer pushes, like any extra Monitor
+        observer = Monitor(observer_port, producer_port, N=3600, codec=options["codec"],
+                           socket_dir=options["socket_dir"])
+        wait_until(lambda: observer.seq is not None, 10, "the stats subscription")
+        cpu_before = {name: cpu_secs(process.pid) for name, process in processes.items()}
+        start = time.perf_counter()
+        stream_alerts(ingest_port, msg_num)
+        wait_until(lambda: observer.status["num_sent"] >= msg_num, 600, "the msgs to be sent")
+        elapsed = time.perf_counter() - start
+        cpu_after = {name: cpu_secs(process.pid) for name, process in processes.items()}
+
+        with observer.lock:
+            percentiles = {
+                kind: {"p{:g}".format(p): value
+                       for p, value in observer.histograms[kind].percentiles().items()}
+                for kind in ("queue", "e2e")
+            }
+        process_stats = {}
+        for name, process in processes.items():
+            before, after = cpu_before[name], cpu_after[name]
+            process_stats[name] = {
+                "cpu_secs": None if before is None else round(after - before, 3),
+                "peak_rss_mb": peak_rss_mb(process.pid),
+            }
+        return {
+            "senders": num_senders,
+            "msg_num": msg_num,
+            "elapsed": elapsed,
+            "msgs_per_sec": msg_num / elapsed,
+            "percentiles": percentiles,
+            "processes": process_stats,
+        }
+    finally:
+        try:
+            send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        except OSError:
+            pass
+        for process in processes.values():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def summarize(result):
+    """Format one scenario result as a line."""
+    senders = [stats for name, stats in result["processes"].items() if name.startswith("sender")]
+    producer = result["processes"]["producer"]
+
+    def total(stats, key):
+        values = [s[key] for s in stats if s[key] is not None]
+        return sum(values) if values else float("nan")
+
+    e2e = result["percentiles"]["e2e"]
+    return ("{:>4d} senders {:>8.0f} msgs/sec  e2e {}  producer {:.2f} cpu secs {:.0f} MB"
+            "  senders {:.2f} cpu secs {:.0f} MB").format(
+        result["senders"], result["msgs_per_sec"],
+        "/".join("-" if e2e["p{:g}".format(p)] is None else "{:.4f}".format(e2e["p{:g}".format(p)])
+                 for p in PERCENTILES),
+        total([producer], "cpu_secs"), total([producer], "peak_rss_mb"),
+        total(senders, "cpu_secs"), total(senders, "peak_rss_mb"),
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path, results):
+    """Print the change in msgs/sec against the scenarios of an earlier run."""
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    old_rates = {r["senders"]: r["msgs_per_sec"] for r in old["scenarios"]}
+    print("Compared with {} ({}):".format(old_path, old.get("commit")))
+    for result in results:
+        before = old_rates.get(result["senders"])
+        if before:
+            print("{:>4d} senders {:>8.0f} -> {:>8.0f} msgs/sec ({:+.1f}%)".format(
+                result["senders"], before, result["msgs_per_sec"],
+                (result["msgs_per_sec"] / before - 1) * 100))
+
+
+@click.command()
+@click.option("--port", "port", default=7300, help="First of the ports the scenarios use.")
+@click.option("--senders", "senders", default="1,10,100",
+              help="Comma separated number of Senders, one scenario each.")
+@click.option("--msg-num", "msg_num", default=20000, type=click.IntRange(min=1))
+@click.option("--window", "window", default=8, type=click.IntRange(min=1))
+@click.option("--batch-size", "batch_size", default=1, type=click.IntRange(min=1))
+@click.option("--scheduler", "scheduler", default="fifo")
+@click.option("--codec", "codec", default="json")
+@click.option("--server-mode", "server_mode", default="thread")
+@click.option("--transport", "transport", default="tcp", type=click.Choice(["tcp", "uds"]),
+              help="uds has the components talk over Unix sockets in a temporary dir.")
+@click.option("--output", "output", default=None, type=click.Path(dir_okay=False),
+              help="Results file, benchmarks/results/e2e-<commit>.json by default.")
+@click.option("--compare", "compare_path", default=None, type=click.Path(exists=True),
+              help="Earlier results file to compare msgs/sec with.")
+def main(port, senders, msg_num, window, batch_size, scheduler, codec, server_mode, transport,
+         output, compare_path):
+    """Run the end-to-end benchmark."""
+    options = {"window": window, "batch_size": batch_size, "scheduler": scheduler,
+               "codec": codec, "server_mode": server_mode, "transport": transport}
+    results = []
+    with tempfile.TemporaryDirectory() as socket_dir:
+        options["socket_dir"] = socket_dir if transport == "uds" else None
+        for num_senders in (int(n) for n in senders.split(",")):
+            result = run_scenario(num_senders, msg_num, port, options)
+            print(summarize(result))
+            results.append(result)
+            # the next scenario gets fresh ports, lingering sockets may still hold the old ones
+            port += 10 + num_senders
+    del options["socket_dir"]
+
+    commit = git_commit()
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, "e2e-{}.json".format(commit))
+    with open(output, "w") as results_file:
+        json.dump({
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "options": options,
+            "scenarios": results,
+        }, results_file, indent=2)
+    print("Wrote", output)
+    if compare_path is not None:
+        compare(compare_path, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Measure bulk ingestion throughput of NDJSON and CSV streams into a Producer.
+
+Run from the repo root:
+> python benchmarks/bench_ingest.py --rows 1000000
+"""
+import json
+import socket
+import time
+import click
+
+from system import Monitor, Producer
+from system.utils import send_msg_tcp
+
+
+def make_stream(fmt, rows):
+    """Build the bulk stream of rows in fmt."""
+    msg = "x" * 60
+    if fmt == "ndjson":
+        lines = (json.dumps({"phone": "{:09d}".format(n), "msg": msg}) for n in range(rows))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+    lines = ("{:09d},{}".format(n, msg) for n in range(rows))
+    return ("phone,msg\n" + "\n".join(lines) + "\n").encode("utf-8")
+
+
+def run(fmt, producer, ingest_port, rows):
+    """Stream rows into the Producer and report rows/sec until all are queued."""
+    stream = make_stream(fmt, rows)
+    target = len(producer.queue) + rows
+    start = time.perf_counter()
+    with socket.create_connection(("localhost", ingest_port)) as sock:
+        sock.sendall(stream)
+    while len(producer.queue) < target:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print("{:<8} {:>9d} rows {:>7.2f}s {:>10.0f} rows/sec {:>7.1f} MB/sec".format(
+        fmt, rows, elapsed, rows / elapsed, len(stream) / elapsed / 1e6))
+
+
+@click.command()
+@click.option("--port", "port", default=7200)
+@click.option("--rows", "rows", default=1000000)
+def main(port, rows):
+    """Run the ingestion benchmark."""
+    monitor_port, producer_port, ingest_port = port, port + 1, port + 2
+    Monitor(monitor_port, producer_port, N=3600)
+    producer = Producer(producer_port, monitor_port, msg_num=0,
+                        ingest_port=ingest_port, high_water=4 * rows)
+    try:
+        run("ndjson", producer, ingest_port, rows)
+        run("csv", producer, ingest_port, rows)
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+
+
+if __name__ == '__main__':
+    main()
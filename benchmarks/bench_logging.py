@@ -0,0 +1,85 @@
+"""Measure what a Sender pays per logged send with a synchronous and an async handler.
+
+Threads log the Sender's per-send record like its executor does, through
+a StreamHandler or an AsyncHandler writing to a pipe that a reader drains
+with a delay per read, standing in for a terminal or log collector that
+falls behind. It reports the mean and worst secs a logging call took.
+
+Run from the repo root:
+> python benchmarks/bench_logging.py --records 20000 --threads 8
+"""
+import logging
+import os
+import threading
+import time
+import click
+
+from system.logs import AsyncHandler, EventFilter
+
+
+def drain(fd, delay):
+    """Read fd until it closes, sleeping delay after every read."""
+    with os.fdopen(fd, "rb") as reader:
+        while reader.read1(65536):
+            time.sleep(delay)
+
+
+def run(handler, records, threads):
+    """Log records from threads through handler, return the mean and max secs per call."""
+    logger = logging.Logger("bench")
+    logger.addHandler(handler)
+    times = []
+
+    def log():
+        spent = []
+        for n in range(records // threads):
+            start = time.perf_counter()
+            logger.info("Send {%s} --> phone number: %s", "x" * 60, "{:09d}".format(n),
+                        extra={"event": "sent"})
+            spent.append(time.perf_counter() - start)
+        times.extend(spent)
+
+    workers = [threading.Thread(target=log) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    handler.close()
+    return sum(times) / len(times), max(times)
+
+
+@click.command()
+@click.option("--records", "records", default=20000, type=click.IntRange(min=1))
+@click.option("--threads", "threads", default=8, type=click.IntRange(min=1))
+@click.option("--read-delay", "read_delay", default=0.001, type=click.FloatRange(min=0),
+              help="Secs the reader of the log sleeps after every read.")
+@click.option("--sample", "sample", default=None, type=click.FloatRange(0, 1),
+              help="Also run the async handler keeping this fraction of the sends.")
+def main(records, threads, read_delay, sample):
+    """Run the logging benchmark."""
+    formatter = logging.Formatter("Sender:6001 [%(levelname)s] %(message)s")
+    handlers = {
+        "sync": lambda stream: logging.StreamHandler(stream),
+        "async": lambda stream: AsyncHandler(stream),
+    }
+    if sample is not None:
+        def sampled(stream):
+            handler = AsyncHandler(stream)
+            handler.addFilter(EventFilter(samples={"sent": sample}))
+            return handler
+        handlers["async sampled"] = sampled
+    for name, make in handlers.items():
+        read_fd, write_fd = os.pipe()
+        reader = threading.Thread(target=drain, args=(read_fd, read_delay))
+        reader.start()
+        with os.fdopen(write_fd, "w") as stream:
+            handler = make(stream)
+            handler.setFormatter(formatter)
+            mean, worst = run(handler, records, threads)
+        reader.join()
+        print("{:>14}: {:8.2f} us mean {:10.2f} us max per call".format(
+            name, mean * 1e6, worst * 1e6))
+
+
+if __name__ == '__main__':
+    main()
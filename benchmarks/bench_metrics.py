@@ -0,0 +1,90 @@
+"""Measure the dispatch throughput a Producer loses to metrics.
+
+A stream of finished msgs is decoded and dispatched by two Producers, one
+with metrics off and one with a metrics port, exactly as their listeners
+would, minus the sockets. Every round runs both back to back, in alternating
+order, and the overhead is the median over rounds of their CPU time ratio,
+which cancels out drift of the machine between rounds.
+
+Run from the repo root:
+> python benchmarks/bench_metrics.py
+"""
+import statistics
+import threading
+import time
+import click
+
+from system import Producer
+from system.codec import CODECS
+from system.utils import RECV_SIZE, dispatch_msgs, new_decoder, serve_tcp
+
+
+class Sink:
+    """Stand in for the Monitor and swallow every msg."""
+
+    def __init__(self, port):
+        self.shut_down = False
+        self.ready = threading.Event()
+        self.thread = threading.Thread(
+            target=serve_tcp, args=(port, lambda msg: None, lambda: self.shut_down, self.ready)
+        )
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        self.shut_down = True
+        self.thread.join()
+
+
+def run(producer, chunks):
+    """Decode and dispatch every chunk like a listener would, return msgs/sec."""
+    before = producer.status["num_sent"]
+    metrics = producer.metrics
+    decoder = new_decoder(metrics)
+    dispatch_all = dispatch_msgs if metrics is None else metrics.timed_dispatch
+    start = time.process_time()
+    for chunk in chunks:
+        dispatch_all(decoder.feed(chunk), producer.dispatch, lambda: False)
+    elapsed = time.process_time() - start
+    return (producer.status["num_sent"] - before) / elapsed
+
+
+@click.command()
+@click.option("--port", "port", default=7300)
+@click.option("--msg-num", "msg_num", default=50000)
+@click.option("--rounds", "rounds", default=31)
+@click.option("--codec", "codec", default="json", type=click.Choice(list(CODECS)))
+def main(port, msg_num, rounds, codec):
+    """Run the metrics overhead benchmark."""
+    codec = CODECS[codec]
+    msg = {"message_type": "finished", "sender_port": 1, "msg_id": 1,
+           "success": True, "send_time": 0.5, "credits": 1}
+    stream = codec.preamble + codec.encode(msg) * msg_num
+    chunks = [stream[i:i + RECV_SIZE] for i in range(0, len(stream), RECV_SIZE)]
+
+    sink = Sink(port)
+    producers = {
+        "off": Producer(port + 1, port, msg_num=0),
+        "on": Producer(port + 2, port, msg_num=0, metrics_port=port + 3),
+    }
+    best = {label: 0 for label in producers}
+    ratios = []
+    try:
+        for round_num in range(rounds):
+            labels = ["off", "on"] if round_num % 2 == 0 else ["on", "off"]
+            rates = {label: run(producers[label], chunks) for label in labels}
+            ratios.append(rates["on"] / rates["off"])
+            for label, rate in rates.items():
+                best[label] = max(best[label], rate)
+    finally:
+        for producer in producers.values():
+            producer.dispatch({"message_type": "shutdown"})
+        sink.stop()
+
+    for label, rate in best.items():
+        print("metrics {:<4} {:>10.0f} msgs/sec".format(label, rate))
+    print("overhead     {:>10.1%}".format(1 - statistics.median(ratios)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Compare msgs/sec of one-shot connections against the pooled connections.
+
+Run from the repo root:
+> python benchmarks/bench_pool.py --msg-num 5000
+"""
+import threading
+import time
+import click
+
+from system.utils import ConnectionPool, send_msg_tcp, serve_tcp
+
+
+class Sink:
+    """Count msgs received on port."""
+
+    def __init__(self, port):
+        self.port = port
+        self.count = 0
+        self.shut_down = False
+        self.done = threading.Condition()
+        self.thread = threading.Thread(
+            target=serve_tcp, args=(port, self.dispatch, lambda: self.shut_down)
+        )
+        self.thread.start()
+        time.sleep(0.2)
+
+    def dispatch(self, msg_dict):
+        with self.done:
+            self.count += 1
+            self.done.notify_all()
+
+    def wait_for(self, count):
+        with self.done:
+            self.done.wait_for(lambda: self.count >= count)
+
+    def stop(self):
+        self.shut_down = True
+        self.thread.join()
+
+
+def run(label, send, sink, msg_num):
+    """Send msg_num msgs with send and report msgs/sec."""
+    target = sink.count + msg_num
+    msg = {"message_type": "sendmsg", "msg_id": 0, "phone": "123456789", "msg": "x" * 50}
+    start = time.perf_counter()
+    for msg_id in range(msg_num):
+        msg["msg_id"] = msg_id
+        send(sink.port, msg)
+    sink.wait_for(target)
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:>10.0f} msgs/sec".format(label, msg_num / elapsed))
+
+
+@click.command()
+@click.option("--port", "port", default=7100)
+@click.option("--msg-num", "msg_num", default=5000)
+def main(port, msg_num):
+    """Run the connection benchmark."""
+    sink = Sink(port)
+    pool = ConnectionPool()
+    try:
+        run("one-shot", send_msg_tcp, sink, msg_num)
+        run("pooled", pool.send, sink, msg_num)
+    finally:
+        pool.close()
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
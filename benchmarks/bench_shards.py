@@ -0,0 +1,135 @@
+"""Measure how dispatch throughput grows with the number of Producer shards.
+
+Every scenario launches a Monitor, SHARDS Producer processes sharing the
+work and N zero-delay Senders registered with all of them. It splits
+--msg-num alerts by phone the way the shards own them, streams each part
+into its shard's ingest port at once and times them until all are
+delivered. With --misroute every alert goes to the first shard instead,
+which passes those it does not own on to the others. Shards only scale as
+far as there are cores for them, so the core count is reported with the
+results.
+
+Run from the repo root:
+> python benchmarks/bench_shards.py --shards 1,2,4 --senders 8 --msg-num 40000
+"""
+import os
+import socket
+import subprocess
+import threading
+import time
+import click
+
+from bench_e2e import cpu_secs, launch, scrape, wait_until
+from system import Monitor
+from system.sharding import split_rows
+from system.utils import send_msg_tcp
+
+
+def stream_rows(ingest_port, rows):
+    """Stream (phone, msg) rows as CSV into a Producer in one connection."""
+    data = "phone,msg\n" + "".join("{},{}\n".format(phone, msg) for phone, msg in rows)
+    with socket.create_connection(("localhost", ingest_port)) as sock:
+        sock.sendall(data.encode("utf-8"))
+
+
+def run_scenario(shards, num_senders, msg_num, port, options):
+    """Run one scenario and return its msgs/sec and the CPU secs of the Producers."""
+    monitor_port, observer_port = port, port + 1
+    shard_ports = [port + 10 + n for n in range(shards)]
+    ingest_ports = [shard_port + shards for shard_port in shard_ports]
+    metrics_ports = [shard_port + 2 * shards for shard_port in shard_ports]
+    producer_args = [arg for shard_port in shard_ports for arg in ("--producer-port", shard_port)]
+    processes = {}
+    observer = None
+    try:
+        processes["monitor"] = launch("monitor", "--port", monitor_port, "--N", 3600,
+                                      *producer_args)
+        for shard_port, ingest_port, metrics_port in zip(shard_ports, ingest_ports,
+                                                          metrics_ports):
+            args = ["--port", shard_port, "--monitor-port", monitor_port, "--msg-num", 0,
+                    "--ingest-port", ingest_port, "--high-water", 2 * msg_num,
+                    "--metrics-port", metrics_port, "--batch-size", options["batch_size"],
+                    "--codec", options["codec"]]
+            if shards > 1:
+                args += [arg for each in shard_ports for arg in ("--shard-port", each)]
+            processes["producer-{}".format(shard_port)] = launch("producer", *args)
+        for metrics_port in metrics_ports:
+            wait_until(lambda: scrape(metrics_port, "sms_senders") is not None, 30,
+                       "the Producers")
+        for n in range(num_senders):
+            processes["sender-{}".format(n)] = launch(
+                "sender", "--port", port + 10 + 3 * shards + n, *producer_args,
+                "--mean-time", 0, "--std-time", 0, "--failure-rate", 0,
+                "--window", options["window"], "--batch-size", options["batch_size"],
+                "--codec", options["codec"],
+            )
+        for metrics_port in metrics_ports:
+            wait_until(lambda: scrape(metrics_port, "sms_senders") == num_senders,
+                       30 + num_senders, "the Senders to register")
+
+        observer = Monitor(observer_port, shard_ports, N=3600, codec=options["codec"])
+        wait_until(lambda: observer.seq is not None, 10, "the stats subscriptions")
+        rows = [("{:09d}".format(n), "x" * 60) for n in range(msg_num)]
+        if options["misroute"]:
+            streams = [threading.Thread(target=stream_rows, args=(ingest_ports[0], rows))]
+        else:
+            streams = [threading.Thread(target=stream_rows, args=(ingest_port, shard_rows))
+                       for ingest_port, shard_rows in zip(ingest_ports,
+                                                          split_rows(rows, shards))]
+        producers = [name for name in processes if name.startswith("producer")]
+        cpu_before = {name: cpu_secs(processes[name].pid) for name in producers}
+        start = time.perf_counter()
+        for stream in streams:
+            stream.start()
+        wait_until(lambda: observer.status["num_sent"] >= msg_num, 600, "the msgs to be sent")
+        elapsed = time.perf_counter() - start
+        for stream in streams:
+            stream.join()
+        cpu = [cpu_secs(processes[name].pid) - cpu_before[name] for name in producers
+               if cpu_before[name] is not None]
+        return {"shards": shards, "msgs_per_sec": msg_num / elapsed, "producer_cpu_secs": cpu}
+    finally:
+        if observer is not None:
+            with observer.lock:
+                observer.handle_shutdown()
+        try:
+            send_msg_tcp(shard_ports[0], {"message_type": "shutdown"})
+        except OSError:
+            pass
+        for process in processes.values():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+@click.command()
+@click.option("--port", "port", default=7600, help="First of the ports the scenarios use.")
+@click.option("--shards", "shards", default="1,2,4",
+              help="Comma separated number of Producer shards, one scenario each.")
+@click.option("--senders", "senders", default=8, type=click.IntRange(min=1))
+@click.option("--msg-num", "msg_num", default=40000, type=click.IntRange(min=1))
+@click.option("--window", "window", default=16, type=click.IntRange(min=1))
+@click.option("--batch-size", "batch_size", default=8, type=click.IntRange(min=1))
+@click.option("--codec", "codec", default="binary")
+@click.option("--misroute", "misroute", is_flag=True,
+              help="Stream every alert to the first shard, which forwards the others'.")
+def main(port, shards, senders, msg_num, window, batch_size, codec, misroute):
+    """Run the shard scaling benchmark."""
+    options = {"window": window, "batch_size": batch_size, "codec": codec,
+               "misroute": misroute}
+    print("{} cores".format(os.cpu_count()))
+    baseline = None
+    for count in (int(n) for n in shards.split(",")):
+        result = run_scenario(count, senders, msg_num, port, options)
+        baseline = baseline or result["msgs_per_sec"]
+        print("{:>3d} shards {:>8.0f} msgs/sec ({:.2f}x)  producers {} cpu secs".format(
+            count, result["msgs_per_sec"], result["msgs_per_sec"] / baseline,
+            "/".join("{:.2f}".format(secs) for secs in result["producer_cpu_secs"])))
+        # the next scenario gets fresh ports, lingering sockets may still hold the old ones
+        port += 10 + 3 * count + senders
+
+
+if __name__ == '__main__':
+    main()
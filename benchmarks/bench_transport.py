@@ -0,0 +1,103 @@
+"""Compare per-msg latency and msgs/sec of loopback TCP against Unix domain sockets.
+
+A sink serves both transports on one port, as a component started with
+--socket-dir does. Latency is timed one msg at a time from send until the sink
+dispatched it, throughput by streaming msgs over one pooled connection.
+
+Run from the repo root:
+> python benchmarks/bench_transport.py --msg-num 20000
+"""
+import tempfile
+import threading
+import time
+import click
+
+from system.histogram import PERCENTILES, Histogram
+from system.utils import ConnectionPool, serve_tcp
+
+
+class Sink:
+    """Count msgs received on port, over TCP and the Unix socket in socket_dir."""
+
+    def __init__(self, port, socket_dir):
+        self.port = port
+        self.count = 0
+        self.shut_down = False
+        self.done = threading.Condition()
+        ready = threading.Event()
+        self.thread = threading.Thread(
+            target=serve_tcp,
+            args=(port, self.dispatch, lambda: self.shut_down, ready, None, socket_dir),
+        )
+        self.thread.start()
+        ready.wait(5)
+
+    def dispatch(self, msg_dict):
+        with self.done:
+            self.count += 1
+            self.done.notify_all()
+
+    def wait_for(self, count):
+        with self.done:
+            self.done.wait_for(lambda: self.count >= count)
+
+    def stop(self):
+        self.shut_down = True
+        self.thread.join()
+
+
+def latency(pool, sink, msg_num):
+    """Return a histogram of send to dispatched times, one msg in flight at a time."""
+    histogram = Histogram()
+    msg = {"message_type": "sendmsg", "msg_id": 0, "phone": "123456789", "msg": "x" * 50}
+    for msg_id in range(msg_num):
+        msg["msg_id"] = msg_id
+        target = sink.count + 1
+        start = time.perf_counter()
+        pool.send(sink.port, msg)
+        sink.wait_for(target)
+        histogram.record(time.perf_counter() - start)
+    return histogram
+
+
+def throughput(pool, sink, msg_num):
+    """Return msgs/sec streaming msg_num msgs over one connection."""
+    target = sink.count + msg_num
+    msg = {"message_type": "sendmsg", "msg_id": 0, "phone": "123456789", "msg": "x" * 50}
+    start = time.perf_counter()
+    for msg_id in range(msg_num):
+        msg["msg_id"] = msg_id
+        pool.send(sink.port, msg)
+    sink.wait_for(target)
+    return msg_num / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--port", "port", default=7200)
+@click.option("--msg-num", "msg_num", default=20000, type=click.IntRange(min=1))
+@click.option("--codec", "codec", default="binary")
+def main(port, msg_num, codec):
+    """Run the transport benchmark."""
+    with tempfile.TemporaryDirectory() as socket_dir:
+        sink = Sink(port, socket_dir)
+        try:
+            print("{:<6} {:>12} {}".format(
+                "", "msgs/sec", "latency " + "/".join("p{:g}".format(p) for p in PERCENTILES)
+            ))
+            for label, pool in (("tcp", ConnectionPool(codec=codec)),
+                                ("uds", ConnectionPool(codec=codec, socket_dir=socket_dir))):
+                # open the connection outside the timings
+                latency(pool, sink, 100)
+                percentiles = latency(pool, sink, msg_num // 10).percentiles()
+                rate = throughput(pool, sink, msg_num)
+                print("{:<6} {:>12.0f} {} usecs".format(
+                    label, rate, " / ".join("{:.1f}".format(percentiles[p] * 1e6)
+                                            for p in PERCENTILES)
+                ))
+                pool.close()
+        finally:
+            sink.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,12 +10,16 @@ setup(
         'pytest',
         'pytest-mock',
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'system-producer = system.producer.__main__:main',
             'system-sender = system.sender.__main__:main',
             'system-monitor = system.monitor.__main__:main',
+            'system-trace = system.tracing:main',
+            'system-simulate = system.simulation:main',
+            'system-history = system.history:main',
+            'system = system.supervisor:main',
         ]
     },
 )
@@ -1,3 +1,14 @@
-from system.monitor import Monitor
-from system.producer import Producer
-from system.sender import Sender
+import importlib
+
+# imported on first use, so a component process only loads the modules it runs
+COMPONENTS = {
+    "Monitor": "system.monitor",
+    "Producer": "system.producer",
+    "Sender": "system.sender",
+}
+
+
+def __getattr__(name):
+    if name not in COMPONENTS:
+        raise AttributeError("module 'system' has no attribute " + repr(name))
+    return getattr(importlib.import_module(COMPONENTS[name]), name)
@@ -0,0 +1,79 @@
+import collections
+import math
+
+# weight of the latest reading in the smoothed arrival rate
+SMOOTHING = 0.3
+
+
+def sender_rate(histogram, window):
+    """Return the msgs/sec a Sender with window manages at its median send time, None before it sent."""
+    if histogram is None or histogram.count == 0:
+        return None
+    median = histogram.percentile(50)
+    return window / median if median else None
+
+
+class Autoscaler:
+    """Decide how many Senders a fleet needs from the backlog, drain rate and send times.
+
+    The fleet has to keep up with the msgs arriving and drain the backlog
+    within target secs on top. It grows as soon as it falls short but only
+    shrinks to the most Senders it wanted within the last scale_down_delay
+    secs, so a lull between two bursts does not retire Senders needed again
+    right after.
+    """
+
+    def __init__(self, min_senders, max_senders, target=10.0, scale_down_delay=30.0):
+        if not 0 <= min_senders <= max_senders:
+            raise ValueError("expected 0 <= min <= max Senders")
+        self.min_senders = min_senders
+        self.max_senders = max_senders
+        self.target = target
+        self.scale_down_delay = scale_down_delay
+        # (time, backlog, finished) as of the previous decision
+        self.last = None
+        self.arrival_rate = None
+        # (time, Senders wanted) of the decisions within scale_down_delay
+        self.wanted = collections.deque()
+        # time of the first decision, the fleet never shrinks sooner than delay secs after
+        self.first = None
+
+    def decide(self, now, senders, backlog, finished, rates):
+        """Return how many Senders to run instead of senders.
+
+        finished counts the sends finished so far and rates holds the msgs/sec
+        of every running Sender, None for those that have not sent yet.
+        """
+        last = self.last
+        self.last = (now, backlog, finished)
+        known = [rate for rate in rates if rate]
+        if last is None or now <= last[0] or not known:
+            # nothing to size the fleet on yet
+            return self.clamp(senders)
+        elapsed = now - last[0]
+        drain_rate = (finished - last[2]) / elapsed
+        # what was drained plus what the backlog grew by must have arrived,
+        # give or take the msgs Senders took in flight meanwhile
+        arrival_rate = max(0.0, drain_rate + (backlog - last[1]) / elapsed)
+        if self.arrival_rate is None:
+            self.arrival_rate = arrival_rate
+        else:
+            self.arrival_rate += SMOOTHING * (arrival_rate - self.arrival_rate)
+        needed = self.arrival_rate + backlog / self.target
+        wanted = self.clamp(math.ceil(needed / (sum(known) / len(known))))
+        history = self.wanted
+        history.append((now, wanted))
+        while history[0][0] < now - self.scale_down_delay:
+            history.popleft()
+        if self.first is None:
+            self.first = now
+        if wanted >= senders:
+            return wanted
+        if now - self.first < self.scale_down_delay:
+            # not wanted fewer for long enough
+            return senders
+        return min(senders, max(count for _, count in history))
+
+    def clamp(self, senders):
+        """Bound senders by the min and max Senders."""
+        return min(self.max_senders, max(self.min_senders, senders))
@@ -0,0 +1,108 @@
+import collections
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Batcher:
+    """Group items per key and hand them to flush once a batch is full or has lingered."""
+
+    def __init__(self, flush, max_items=1, max_bytes=None, linger=0.0, size_of=len, lock=None):
+        self.flush = flush
+        # held around the flushes of lingering batches, which run on the flusher thread
+        self.flush_lock = lock
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.size_of = size_of
+        self.batches = {}
+        self.batch_bytes = {}
+        # every batch lingers equally long, so creation order is deadline order
+        self.deadlines = collections.OrderedDict()
+        self.closed = False
+        self.cond = threading.Condition()
+        self.flusher = None
+        if linger > 0:
+            self.flusher = threading.Thread(target=self.flush_expired_forever)
+            self.flusher.start()
+
+    def add(self, key, item):
+        """Queue an item for key, flushing the batch right away if it is full."""
+        if self.max_items == 1:
+            # every batch is full at once, which is the default
+            self.flush(key, [item])
+            return
+        full = None
+        with self.cond:
+            batch = self.batches.get(key)
+            if batch is None:
+                batch = self.batches[key] = []
+                self.batch_bytes[key] = 0
+                if self.linger > 0:
+                    self.deadlines[key] = time.monotonic() + self.linger
+                    self.cond.notify()
+            batch.append(item)
+            if self.max_bytes is not None:
+                self.batch_bytes[key] += self.size_of(item)
+            if (len(batch) >= self.max_items or
+                    (self.max_bytes is not None and self.batch_bytes[key] >= self.max_bytes)):
+                full = self.take(key)
+        # flushes go over the network, adds on other threads must not wait for them
+        if full:
+            self.flush(key, full)
+
+    def take(self, key):
+        """Remove and return the batch of key. Caller holds the lock."""
+        self.batch_bytes.pop(key, None)
+        self.deadlines.pop(key, None)
+        return self.batches.pop(key, None)
+
+    def flush_all(self):
+        """Flush every pending batch regardless of its deadline."""
+        with self.cond:
+            batches = [(key, self.take(key)) for key in list(self.batches)]
+        for key, batch in batches:
+            if batch:
+                self.flush(key, batch)
+
+    def release(self):
+        """End of a burst of adds: flush partial batches unless they may linger."""
+        # a batch added meanwhile is flushed by the release following its add
+        if self.linger <= 0 and self.batches:
+            self.flush_all()
+
+    def flush_expired_forever(self):
+        """Flush batches as their linger time runs out until closed."""
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+                if not self.deadlines:
+                    self.cond.wait()
+                    continue
+                key, deadline = next(iter(self.deadlines.items()))
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                batch = self.take(key)
+            try:
+                if self.flush_lock is None:
+                    self.flush(key, batch)
+                else:
+                    with self.flush_lock:
+                        self.flush(key, batch)
+            except Exception:
+                # a failed flush loses its batch, not the flusher
+                LOGGER.exception("Flushing %d items to %s failed", len(batch), key)
+
+    def close(self):
+        """Drop pending batches and stop the flusher."""
+        with self.cond:
+            self.closed = True
+            self.batches.clear()
+            self.batch_bytes.clear()
+            self.deadlines.clear()
+            self.cond.notify()
@@ -0,0 +1,385 @@
+import json
+import struct
+
+from system.dedup import DEDUP_COUNTERS
+from system.histogram import KINDS
+from system.source import RETRY_COUNTERS
+
+# JSON msgs are newline-delimited so many of them can share one connection.
+FRAME_DELIMITER = b'\n'
+# Largest frame a server will buffer for a single msg.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# A binary connection opens with MAGIC and its codec version. JSON text never
+# starts with a NUL byte, so servers tell the two apart from the first byte.
+MAGIC = b'\x00SMS'
+BINARY_VERSIONS = (1,)
+PREAMBLE_SIZE = len(MAGIC) + 1
+# codecs a peer can speak, advertised in its registration, best first
+SUPPORTED_CODECS = ["binary/1", "json"]
+
+# every binary frame is its body length, then a tag byte and a fixed payload
+LENGTH = struct.Struct("<I")
+TAG = struct.Struct("<B")
+TASK = struct.Struct("<q H I")
+FINISHED = struct.Struct("<H q ? d I")
+FINISHED_BATCH = struct.Struct("<H I I")
+RESULT = struct.Struct("<q ? d")
+STATS = struct.Struct("<q q q d q H")
+RETRIES = struct.Struct("<q q q")
+DEDUP = struct.Struct("<q q")
+PORT = struct.Struct("<H")
+
+# msg tags, anything without a fixed layout travels as a JSON body
+GENERIC = 0
+SENDMSG = 1
+SENDMSG_BATCH = 2
+FINISHED_TAG = 3
+FINISHED_BATCH_TAG = 4
+STATUS_QUERY = 5
+SHUTDOWN = 6
+STATS_TAG = 7
+SNAPSHOT_TAG = 8
+
+
+def encode_msg(msg_dict):
+    """Encode a msg dict into a single JSON wire frame."""
+    return json.dumps(msg_dict).encode('utf-8') + FRAME_DELIMITER
+
+
+def decode_msg(frame):
+    """Decode a single JSON wire frame, return None if it is not a valid msg."""
+    try:
+        return json.loads(frame.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+
+
+def pack_task(msg_id, phone, msg):
+    phone, msg = phone.encode("utf-8"), msg.encode("utf-8")
+    return TASK.pack(msg_id, len(phone), len(msg)) + phone + msg
+
+
+def unpack_task(data, offset):
+    """Return ([msg_id, phone, msg], offset after the task)."""
+    msg_id, phone_len, msg_len = TASK.unpack_from(data, offset)
+    offset += TASK.size
+    phone = data[offset:offset + phone_len].decode("utf-8")
+    offset += phone_len
+    msg = data[offset:offset + msg_len].decode("utf-8")
+    return [msg_id, phone, msg], offset + msg_len
+
+
+def pack_tasks(tasks):
+    """Pack tasks as an array of msg ids plus their text joined by NULs."""
+    count = len(tasks)
+    text = "\0".join([text for _, phone, msg in tasks for text in (phone, msg)])
+    # one split decodes every string at once, so the text itself must be NUL free
+    if text.count("\0") != 2 * count - 1:
+        raise ValueError("NUL inside a task")
+    return b''.join([
+        LENGTH.pack(count),
+        struct.pack("<%dq" % count, *[task[0] for task in tasks]),
+        text.encode("utf-8"),
+    ])
+
+
+def unpack_tasks(data, offset, end):
+    """Return the (msg_id, phone, msg) tasks packed by pack_tasks."""
+    (count,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    msg_ids = struct.unpack_from("<%dq" % count, data, offset)
+    offset += 8 * count
+    strings = data[offset:end].decode("utf-8").split("\0")
+    return list(zip(msg_ids, strings[::2], strings[1::2]))
+
+
+def pack_pairs(pairs):
+    """Pack histogram [index, count] pairs as an index array and a count array."""
+    count = len(pairs)
+    return b''.join([
+        LENGTH.pack(count),
+        struct.pack("<%dI" % count, *[pair[0] for pair in pairs]),
+        struct.pack("<%dq" % count, *[pair[1] for pair in pairs]),
+    ])
+
+
+def unpack_pairs(data, offset):
+    """Return (pairs, offset after them)."""
+    (count,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    indexes = struct.unpack_from("<%dI" % count, data, offset)
+    offset += 4 * count
+    counts = struct.unpack_from("<%dq" % count, data, offset)
+    return list(zip(indexes, counts)), offset + 8 * count
+
+
+def pack_histograms(msg_dict):
+    """Pack the global histograms in KINDS order, then the per-Sender ones."""
+    histograms, senders = msg_dict["histograms"], msg_dict["senders"]
+    if len(histograms) != len(KINDS):
+        raise KeyError("histograms")
+    parts = [pack_pairs(histograms[kind]) for kind in KINDS]
+    parts.append(LENGTH.pack(len(senders)))
+    for port, pairs in senders.items():
+        parts.append(PORT.pack(int(port)))
+        parts.append(pack_pairs(pairs))
+    return b''.join(parts)
+
+
+def unpack_histograms(data, offset, msg_dict):
+    """Unpack what pack_histograms packed into msg_dict."""
+    histograms = msg_dict["histograms"] = {}
+    for kind in KINDS:
+        histograms[kind], offset = unpack_pairs(data, offset)
+    (count,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    senders = msg_dict["senders"] = {}
+    for _ in range(count):
+        (port,) = PORT.unpack_from(data, offset)
+        senders[str(port)], offset = unpack_pairs(data, offset + PORT.size)
+    return msg_dict
+
+
+def encode_body(msg_dict):
+    """Encode a msg as a tag byte plus its fixed layout."""
+    message_type = msg_dict["message_type"]
+    size = len(msg_dict)
+    if message_type == "sendmsg" and size == 4:
+        return TAG.pack(SENDMSG) + pack_task(
+            msg_dict["msg_id"], msg_dict["phone"], msg_dict["msg"]
+        )
+    if message_type == "sendmsg_batch" and size == 2:
+        return TAG.pack(SENDMSG_BATCH) + pack_tasks(msg_dict["tasks"])
+    if message_type == "finished" and size == 6:
+        return TAG.pack(FINISHED_TAG) + FINISHED.pack(
+            msg_dict["sender_port"], msg_dict["msg_id"], msg_dict["success"],
+            msg_dict["send_time"], msg_dict["credits"],
+        )
+    if message_type == "finished_batch" and size == 4:
+        results = msg_dict["results"]
+        return b''.join(
+            [TAG.pack(FINISHED_BATCH_TAG),
+             FINISHED_BATCH.pack(msg_dict["sender_port"], msg_dict["credits"], len(results))] +
+            [RESULT.pack(*result) for result in results]
+        )
+    if message_type == "status" and size == 1:
+        return TAG.pack(STATUS_QUERY)
+    if message_type in ("stats", "stats_snapshot") and size == 11:
+        retries, dedup = msg_dict["retries"], msg_dict["dedup"]
+        if len(retries) != len(RETRY_COUNTERS) or len(dedup) != len(DEDUP_COUNTERS):
+            raise KeyError("retries")
+        return b''.join([
+            TAG.pack(STATS_TAG if message_type == "stats" else SNAPSHOT_TAG),
+            STATS.pack(msg_dict["seq"], msg_dict["num_sent"], msg_dict["num_fail"],
+                       msg_dict["total_time"], msg_dict["backlog"], msg_dict["producer_port"]),
+            RETRIES.pack(*[retries[key] for key in RETRY_COUNTERS]),
+            DEDUP.pack(*[dedup[key] for key in DEDUP_COUNTERS]),
+            pack_histograms(msg_dict),
+        ])
+    if message_type == "shutdown" and size == 1:
+        return TAG.pack(SHUTDOWN)
+    raise KeyError(message_type)
+
+
+def decode_body(data, offset, end):
+    """Decode the tagged body in data[offset:end] back into a msg dict.
+
+    Tasks, results and histogram pairs come back as tuples rather than lists.
+    """
+    tag = data[offset]
+    offset += 1
+    if tag == SENDMSG:
+        (msg_id, phone, msg), _ = unpack_task(data, offset)
+        return {"message_type": "sendmsg", "msg_id": msg_id, "phone": phone, "msg": msg}
+    if tag == SENDMSG_BATCH:
+        return {"message_type": "sendmsg_batch", "tasks": unpack_tasks(data, offset, end)}
+    if tag == FINISHED_TAG:
+        sender_port, msg_id, success, send_time, credits = FINISHED.unpack_from(data, offset)
+        return {
+            "message_type": "finished", "sender_port": sender_port, "msg_id": msg_id,
+            "success": success, "send_time": send_time, "credits": credits,
+        }
+    if tag == FINISHED_BATCH_TAG:
+        sender_port, credits, count = FINISHED_BATCH.unpack_from(data, offset)
+        offset += FINISHED_BATCH.size
+        results = list(RESULT.iter_unpack(data[offset:offset + count * RESULT.size]))
+        return {
+            "message_type": "finished_batch", "sender_port": sender_port,
+            "results": results, "credits": credits,
+        }
+    if tag == STATUS_QUERY:
+        return {"message_type": "status"}
+    if tag == STATS_TAG or tag == SNAPSHOT_TAG:
+        seq, num_sent, num_fail, total_time, backlog, producer_port = \
+            STATS.unpack_from(data, offset)
+        offset += STATS.size
+        retries = dict(zip(RETRY_COUNTERS, RETRIES.unpack_from(data, offset)))
+        offset += RETRIES.size
+        dedup = dict(zip(DEDUP_COUNTERS, DEDUP.unpack_from(data, offset)))
+        return unpack_histograms(data, offset + DEDUP.size, {
+            "message_type": "stats" if tag == STATS_TAG else "stats_snapshot", "seq": seq,
+            "num_sent": num_sent, "num_fail": num_fail, "total_time": total_time,
+            "retries": retries, "dedup": dedup, "backlog": backlog,
+            "producer_port": producer_port,
+        })
+    if tag == SHUTDOWN:
+        return {"message_type": "shutdown"}
+    return json.loads(data[offset:end].decode("utf-8"))
+
+
+class JsonCodec:
+    """Newline-delimited JSON, spoken by every peer and by hand with `nc`."""
+
+    name = "json"
+    preamble = b''
+
+    def encode(self, msg_dict):
+        return encode_msg(msg_dict)
+
+    def decoder(self):
+        return JsonDecoder()
+
+
+class BinaryCodec:
+    """Length-prefixed frames with a struct layout per msg type."""
+
+    name = "binary"
+    version = 1
+    preamble = MAGIC + bytes([version])
+
+    def encode(self, msg_dict):
+        try:
+            body = encode_body(msg_dict)
+        except (KeyError, TypeError, AttributeError, ValueError, struct.error):
+            # unusual shapes, e.g. a msg_id of None, keep their JSON form
+            body = TAG.pack(GENERIC) + json.dumps(msg_dict).encode("utf-8")
+        return LENGTH.pack(len(body)) + body
+
+    def decoder(self):
+        return BinaryDecoder()
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), BinaryCodec())}
+
+
+def codec_id(name):
+    """Return the name a codec is advertised under, with its version if any."""
+    codec = CODECS[name]
+    version = getattr(codec, "version", None)
+    return name if version is None else "{}/{}".format(name, version)
+
+
+def negotiate(offered, preferred):
+    """Pick preferred if the peer offered it, else fall back to JSON."""
+    return preferred if codec_id(preferred) in offered else "json"
+
+
+class JsonDecoder:
+    """Split a byte stream into newline-delimited JSON msgs."""
+
+    def __init__(self):
+        # grown in place, copying it for every chunk of a large frame is quadratic
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Return every msg completed by data."""
+        buffer = self.buffer
+        last = data.rfind(FRAME_DELIMITER)
+        if last < 0:
+            buffer += data
+            if len(buffer) > MAX_FRAME_SIZE:
+                raise ValueError("frame larger than {} bytes".format(MAX_FRAME_SIZE))
+            return []
+        # only data can hold delimiters, the buffer is the start of its first frame
+        if buffer:
+            buffer += data[:last]
+            complete = buffer
+        else:
+            complete = data[:last]
+        self.buffer = bytearray(data[last + len(FRAME_DELIMITER):])
+        frames = complete.split(FRAME_DELIMITER)
+        return [msg_dict for msg_dict in map(decode_msg, frames) if msg_dict is not None]
+
+    def finish(self):
+        """Return the msg left unterminated at EOF, if any."""
+        # peers such as `nc` may close the stream without a trailing delimiter
+        if self.buffer.strip():
+            msg_dict = decode_msg(self.buffer)
+            if msg_dict is not None:
+                return [msg_dict]
+        return []
+
+
+class BinaryDecoder:
+    """Split a byte stream into length-prefixed binary msgs."""
+
+    def __init__(self):
+        # grown in place and consumed from the front, never copied whole per chunk
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Return every msg completed by data."""
+        buffer = self.buffer
+        if buffer:
+            buffer += data
+        else:
+            # the common case, whole frames straight from data
+            buffer = data
+        msgs = []
+        offset, end = 0, len(buffer)
+        while offset + LENGTH.size <= end:
+            (length,) = LENGTH.unpack_from(buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError("frame larger than {} bytes".format(MAX_FRAME_SIZE))
+            start = offset + LENGTH.size
+            if start + length > end:
+                break
+            try:
+                msgs.append(decode_body(buffer, start, start + length))
+            except (struct.error, IndexError, ValueError):
+                raise ValueError("malformed binary frame") from None
+            offset = start + length
+        if buffer is data:
+            self.buffer += data[offset:]
+        else:
+            del buffer[:offset]
+        return msgs
+
+    def finish(self):
+        """A torn binary frame at EOF is dropped."""
+        return []
+
+
+class FrameDecoder:
+    """Decode a connection with whichever codec its first bytes announce."""
+
+    def __init__(self):
+        self.decoder = None
+        self.head = b''
+
+    def feed(self, data):
+        """Return every msg completed by data, raise ValueError for an unknown codec."""
+        if self.decoder is not None:
+            return self.decoder.feed(data)
+        head = self.head = self.head + data
+        if not head:
+            return []
+        if head[0] != MAGIC[0]:
+            self.decoder = JsonDecoder()
+            return self.decoder.feed(head)
+        if len(head) < PREAMBLE_SIZE:
+            return []
+        if head[:len(MAGIC)] != MAGIC:
+            raise ValueError("unknown wire preamble")
+        version = head[len(MAGIC)]
+        if version not in BINARY_VERSIONS:
+            raise ValueError("unsupported binary codec version {}".format(version))
+        self.decoder = BinaryDecoder()
+        return self.decoder.feed(head[PREAMBLE_SIZE:])
+
+    def finish(self):
+        """Return the msg left unterminated at EOF, if any."""
+        if self.decoder is None:
+            return []
+        return self.decoder.finish()
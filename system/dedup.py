@@ -0,0 +1,86 @@
+import collections
+
+# alerts dropped as repeats of one seen within the window, alerts merged into
+# another one still queued for the same phone
+DEDUP_COUNTERS = ("suppressed", "coalesced")
+# most alerts a single coalesced send carries
+COALESCE_MAX = 10
+COALESCE_SEPARATOR = "\n"
+
+
+class DedupIndex:
+    """Remember the (phone, msg) pairs seen in the last window secs, at most max_entries.
+
+    Every key lives for the same window, so insertion order is expiry order and
+    one OrderedDict is both the TTL and the LRU index: expired and overflowing
+    keys are dropped from its front. Msgs are keyed by their hash, so the index
+    holds no msg text.
+    """
+
+    def __init__(self, window, max_entries=1000000):
+        self.window = window
+        self.max_entries = max_entries
+        # (phone, hash of msg) -> expiry
+        self.seen = collections.OrderedDict()
+
+    def is_duplicate(self, phone, msg, now):
+        """Return True if the pair was seen in the window, else remember it from now."""
+        seen = self.seen
+        while seen and next(iter(seen.values())) <= now:
+            seen.popitem(last=False)
+        key = (phone, hash(msg))
+        # the window counts from the first alert, so a storm is let through once per window
+        if key in seen:
+            return True
+        seen[key] = now + self.window
+        if len(seen) > self.max_entries:
+            seen.popitem(last=False)
+        return False
+
+    def __len__(self):
+        return len(self.seen)
+
+
+class Coalescer:
+    """Merge alerts to a phone into one still queued for it that was enqueued within window secs.
+
+    Only queued alerts of the same priority lane are merged into, so nothing
+    waits longer than it would have anyway.
+    """
+
+    def __init__(self, window, max_msgs=COALESCE_MAX):
+        self.window = window
+        self.max_msgs = max_msgs
+        # (phone, lane) -> (msg_id, enqueue time, msg) of the latest alert queued for it
+        self.open = {}
+        # msg_id -> msgs merged so far, its own first
+        self.merged = {}
+
+    def merge(self, phone, lane, msg, now):
+        """Merge msg into the alert queued for phone, return (msg_id, merged msg) or None."""
+        entry = self.open.get((phone, lane))
+        if entry is None or now - entry[1] > self.window:
+            return None
+        msg_id = entry[0]
+        msgs = self.merged.get(msg_id)
+        if msgs is None:
+            msgs = self.merged[msg_id] = [entry[2]]
+        if len(msgs) >= self.max_msgs:
+            return None
+        msgs.append(msg)
+        return msg_id, COALESCE_SEPARATOR.join(msgs)
+
+    def track(self, msg_id, phone, lane, msg, now):
+        """Let later alerts to phone merge into msg_id, just queued."""
+        self.open[(phone, lane)] = (msg_id, now, msg)
+
+    def take(self, task, lane):
+        """Return the task leaving the queue with every msg merged into it, and close it."""
+        key = (task[1], lane)
+        entry = self.open.get(key)
+        if entry is not None and entry[0] == task[0]:
+            del self.open[key]
+        msgs = self.merged.pop(task[0], None)
+        if msgs is None:
+            return task
+        return task[0], task[1], COALESCE_SEPARATOR.join(msgs)
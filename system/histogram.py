@@ -0,0 +1,110 @@
+import math
+
+from system.source import PRIORITIES
+
+# every recorded value is counted in whole UNITs (microsecs)
+UNIT = 1e-6
+# values below 2**SUB_BITS units get a bucket of their own, above that every
+# power of two is split into 2**(SUB_BITS - 1) buckets, about 3% wide each
+SUB_BITS = 6
+SUB_COUNT = 1 << SUB_BITS
+HALF_COUNT = SUB_COUNT >> 1
+# values past 2**(MAX_SHIFT + SUB_BITS) units (about 800 days) share the last bucket
+MAX_SHIFT = 40
+NUM_BUCKETS = (MAX_SHIFT + 2) * HALF_COUNT
+
+PERCENTILES = (50, 90, 99, 99.9)
+# queue waits of every priority lane on its own, in PRIORITIES order
+LANE_KINDS = tuple("queue_" + priority for priority in PRIORITIES)
+# what the Producer keeps histograms of: a Sender's send_time, the time a msg
+# waited in the queue until assigned, and enqueue to delivered
+KINDS = ("send", "queue", "e2e") + LANE_KINDS
+
+
+def bucket_index(units):
+    """Return the bucket counting a value of units."""
+    if units < SUB_COUNT:
+        return units
+    shift = units.bit_length() - SUB_BITS
+    if shift > MAX_SHIFT:
+        return NUM_BUCKETS - 1
+    return (shift << (SUB_BITS - 1)) + (units >> shift)
+
+
+def bucket_upper(index):
+    """Return the largest value, in secs, counted by bucket index."""
+    if index < SUB_COUNT:
+        return index * UNIT
+    shift = (index >> (SUB_BITS - 1)) - 1
+    sub = index - (shift << (SUB_BITS - 1))
+    return (((sub + 1) << shift) - 1) * UNIT
+
+
+class Histogram:
+    """Fixed-size, log-bucketed histogram of durations in secs.
+
+    Recording is O(1) and histograms with the same layout merge bucket by
+    bucket, so they can be kept per Sender, shipped in msgs and added up.
+    """
+
+    __slots__ = ("counts", "count")
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+
+    def record(self, value):
+        """Count a single duration."""
+        units = int(value / UNIT) if value > 0 else 0
+        self.counts[bucket_index(units)] += 1
+        self.count += 1
+
+    def merge(self, other):
+        """Add every count of other."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+
+    def merge_list(self, pairs):
+        """Add the sparse [index, count] pairs of to_list()."""
+        counts = self.counts
+        for index, count in pairs:
+            counts[index] += count
+            self.count += count
+
+    def to_list(self):
+        """Return the non-empty buckets as [index, count] pairs."""
+        return [[index, count] for index, count in enumerate(self.counts) if count]
+
+    @classmethod
+    def from_list(cls, pairs):
+        histogram = cls()
+        histogram.merge_list(pairs)
+        return histogram
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        return histogram
+
+    def delta(self, since):
+        """Return the [index, count] pairs recorded after the copy since was taken."""
+        return [[index, count - before]
+                for index, (count, before) in enumerate(zip(self.counts, since.counts))
+                if count != before]
+
+    def percentile(self, percent):
+        """Return the value percent of the recorded values are at most, None if empty."""
+        if not self.count:
+            return None
+        target = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return bucket_upper(index)
+        return bucket_upper(NUM_BUCKETS - 1)
+
+    def percentiles(self, percents=PERCENTILES):
+        """Return {percent: value} for every percent."""
+        return {percent: self.percentile(percent) for percent in percents}
@@ -0,0 +1,224 @@
+import array
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import click
+
+# what every sample holds: the totals so far and the backlog gauge
+FIELDS = ("num_sent", "num_fail", "total_time", "backlog")
+FIELD_INDEX = {field: index for index, field in enumerate(FIELDS)}
+# (secs per sample, samples kept) from the finest tier to the coarsest:
+# 15 mins by the sec, 4 hours by 15 secs and a week by 5 mins, 150 KB in all
+TIERS = ((1.0, 900), (15.0, 960), (300.0, 2016))
+QUERIES = ("rate", "delta", "average", "failure_rate", "series")
+
+
+class Series:
+    """The latest capacity samples, one per resolution secs, in a ring of arrays.
+
+    A sample is the state as of the last record within its slot, so a coarse
+    tier holds the same totals a fine one does at its slot boundaries.
+    """
+
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.times = array.array("d", bytes(8 * capacity))
+        self.columns = [array.array("d", bytes(8 * capacity)) for _ in FIELDS]
+        # logical sample 0, the oldest, is at physical slot start
+        self.start = 0
+        self.count = 0
+
+    def slot(self, index):
+        """Return the physical slot of logical sample index."""
+        return (self.start + index) % self.capacity
+
+    def record(self, now, values):
+        """Keep values of FIELDS as of now, replacing the sample of the same slot."""
+        if self.count:
+            last = self.slot(self.count - 1)
+            # a clock stepping back stays in the slot it left
+            now = max(now, self.times[last])
+        if self.count and now // self.resolution == self.times[last] // self.resolution:
+            slot = last
+        elif self.count < self.capacity:
+            self.count += 1
+            slot = self.slot(self.count - 1)
+        else:
+            # the oldest sample makes room
+            slot = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[slot] = now
+        for column, value in zip(self.columns, values):
+            column[slot] = value
+
+    def oldest(self):
+        """Return the time of the oldest sample, None if there is none."""
+        return self.times[self.start] if self.count else None
+
+    def find(self, when):
+        """Return the index of the last sample at or before when, -1 if none is."""
+        times, low, high = self.times, 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if times[self.slot(middle)] <= when:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1
+
+    def sample(self, index, field):
+        """Return (time, value of field) of logical sample index."""
+        slot = self.slot(index)
+        return self.times[slot], self.columns[FIELD_INDEX[field]][slot]
+
+
+class History:
+    """Stats samples over time at several resolutions, in memory that never grows.
+
+    Every query looks at the window secs up to now, on the finest tier that
+    reaches back that far, or over what the coarsest one still holds.
+    """
+
+    def __init__(self, tiers=TIERS):
+        self.tiers = [Series(resolution, capacity) for resolution, capacity in tiers]
+
+    def record(self, now, status, backlog):
+        """Keep the totals in status and the backlog as of now."""
+        values = [status["num_sent"], status["num_fail"], status["total_time"], backlog]
+        for tier in self.tiers:
+            tier.record(now, values)
+
+    def tier(self, since):
+        """Return the finest tier holding a sample from since or before."""
+        for tier in self.tiers:
+            if tier.count and tier.oldest() <= since:
+                return tier
+        return self.tiers[-1]
+
+    def bounds(self, window, now):
+        """Return the tier, the index of the first sample, the start and the end of a window.
+
+        The window starts at its first sample if it reaches back past
+        every one kept. None if there is no sample before now.
+        """
+        since = now - window
+        tier = self.tier(since)
+        first = tier.find(since)
+        if first < 0:
+            if not tier.count or tier.oldest() > now:
+                return None
+            first, since = 0, tier.oldest()
+        return tier, first, since, now
+
+    def delta(self, field, window, now=None):
+        """Return how much field grew over the window, None without samples."""
+        now = time.time() if now is None else now
+        bounds = self.bounds(window, now)
+        if bounds is None:
+            return None
+        tier, first, _, _ = bounds
+        last = tier.find(now)
+        return tier.sample(last, field)[1] - tier.sample(first, field)[1]
+
+    def rate(self, field, window, now=None):
+        """Return the growth of field per sec over the window, None without samples."""
+        now = time.time() if now is None else now
+        bounds = self.bounds(window, now)
+        if bounds is None or bounds[3] <= bounds[2]:
+            return None
+        tier, first, since, _ = bounds
+        last = tier.find(now)
+        return (tier.sample(last, field)[1] - tier.sample(first, field)[1]) / (now - since)
+
+    def failure_rate(self, window, now=None):
+        """Return the share of the sends within the window that failed, None without any."""
+        now = time.time() if now is None else now
+        sent, failed = self.delta("num_sent", window, now), self.delta("num_fail", window, now)
+        if sent is None or sent + failed <= 0:
+            return None
+        return failed / (sent + failed)
+
+    def average(self, field, window, now=None):
+        """Return the time weighted mean of field over the window, None without samples."""
+        now = time.time() if now is None else now
+        bounds = self.bounds(window, now)
+        if bounds is None:
+            return None
+        tier, first, since, _ = bounds
+        last = tier.find(now)
+        if now <= since:
+            return tier.sample(last, field)[1]
+        total = 0.0
+        # every sample holds until the next one
+        for index in range(first, last + 1):
+            start, value = tier.sample(index, field)
+            end = tier.sample(index + 1, field)[0] if index < last else now
+            total += value * (end - max(start, since))
+        return total / (now - since)
+
+    def series(self, field, window, now=None):
+        """Return the (time, value) samples of field within the window."""
+        now = time.time() if now is None else now
+        bounds = self.bounds(window, now)
+        if bounds is None:
+            return []
+        tier, first, _, _ = bounds
+        return [tier.sample(index, field) for index in range(first, tier.find(now) + 1)]
+
+    def query(self, query, field, window, now=None):
+        """Answer one of QUERIES about field over window secs up to now."""
+        if query not in QUERIES:
+            raise ValueError("unknown query {!r}, expected one of {}".format(
+                query, ", ".join(QUERIES)))
+        if field not in FIELD_INDEX:
+            raise ValueError("unknown field {!r}, expected one of {}".format(
+                field, ", ".join(FIELDS)))
+        if not window > 0:
+            raise ValueError("expected a window of more than 0 secs")
+        if query == "failure_rate":
+            return self.failure_rate(window, now)
+        return getattr(self, query)(field, window, now)
+
+
+def parse_query(params):
+    """Return the (query, field, window) of the query string params of a /history request."""
+    try:
+        window = float(params.get("window", ["60"])[0])
+    except ValueError:
+        raise ValueError("expected a window in secs")
+    return params.get("query", ["rate"])[0], params.get("field", ["num_sent"])[0], window
+
+
+@click.command()
+@click.argument("query", type=click.Choice(QUERIES))
+@click.argument("field", default="num_sent", type=click.Choice(FIELDS))
+@click.option("--port", "port", required=True, type=int,
+              help="Metrics port of the Monitor, which serves its history there too.")
+@click.option("--window", "window", default=60.0, type=click.FloatRange(min=0, min_open=True),
+              help="Secs up to now the query looks at.")
+def main(query, field, port, window):
+    """Ask a running Monitor about its stats history, e.g. rate num_sent --window 60."""
+    url = "http://localhost:{}/history?{}".format(port, urllib.parse.urlencode(
+        {"query": query, "field": field, "window": window}))
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            answer = json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as error:
+        raise click.ClickException("Monitor answered {}: {}".format(error.code, error.reason))
+    except OSError as error:
+        raise click.ClickException("Monitor unreachable: {}".format(error))
+    value = answer["value"]
+    if query == "series":
+        for when, sample in value:
+            click.echo("{} {:g}".format(
+                time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(when)), sample))
+    else:
+        click.echo("-" if value is None else "{:g}".format(value))
+
+
+if __name__ == '__main__':
+    main()
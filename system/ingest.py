@@ -0,0 +1,132 @@
+import csv
+import json
+import logging
+import socket
+import threading
+import time
+
+from system.source import LANE_INDEX
+
+LOGGER = logging.getLogger(__name__)
+
+# rows are handed to the sink this many at a time
+INGEST_BATCH = 1000
+
+
+def with_priority(phone, msg, priority):
+    """Return the row, with its priority if it has one, None if the priority is unknown."""
+    if not priority:
+        return phone, msg
+    if priority not in LANE_INDEX:
+        return None
+    return phone, msg, priority
+
+
+def parse_ndjson(lines):
+    """Yield (phone, msg[, priority]) from newline-delimited JSON objects, None for bad rows."""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            yield with_priority(str(row["phone"]), str(row["msg"]), row.get("priority"))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            yield None
+
+
+def parse_csv(lines):
+    """Yield (phone, msg[, priority]) from CSV rows, skipping a header, None for bad rows."""
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if not 2 <= len(row) <= 3:
+            yield None
+        elif row[:2] != ["phone", "msg"]:
+            yield with_priority(row[0], row[1], row[2] if len(row) == 3 else None)
+
+
+def parse_rows(lines):
+    """Sniff the stream format from its first line and parse it incrementally."""
+    for first in lines:
+        if first.strip():
+            break
+    else:
+        return
+    parse = parse_ndjson if first.lstrip().startswith("{") else parse_csv
+    yield from parse(prepend(first, lines))
+
+
+def prepend(first, lines):
+    """Put an already consumed line back in front of the stream."""
+    yield first
+    yield from lines
+
+
+class IngestServer:
+    """Accept bulk (phone, msg) streams and feed them to sink in batches.
+
+    Every connection is read on its own thread. sink blocks while the queue is
+    above its high-water mark, which stops reading the socket and lets TCP flow
+    control push back on the client.
+    """
+
+    def __init__(self, port, sink, is_shut_down):
+        self.port = port
+        self.sink = sink
+        self.is_shut_down = is_shut_down
+        self.ready = threading.Event()
+        self.conns = set()
+
+    def serve_forever(self):
+        """Accept ingest connections until is_shut_down() turns True."""
+        workers = []
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("localhost", self.port))
+            sock.listen()
+            self.ready.set()
+
+            sock.settimeout(1)
+            while not self.is_shut_down():
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    continue
+                self.conns.add(conn)
+                worker = threading.Thread(target=self.ingest_connection, args=(conn,))
+                worker.start()
+                workers.append(worker)
+                workers = [w for w in workers if w.is_alive()]
+
+        # hand idle clients an EOF so their threads finish
+        for conn in list(self.conns):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.join()
+
+    def ingest_connection(self, conn):
+        """Parse one bulk stream until EOF and hand its rows over to sink."""
+        start = time.monotonic()
+        num_rows, num_rejected = 0, 0
+        with conn, conn.makefile("r", encoding="utf-8", errors="replace", newline="") as lines:
+            batch = []
+            for row in parse_rows(lines):
+                if row is None:
+                    num_rejected += 1
+                    continue
+                batch.append(row)
+                if len(batch) >= INGEST_BATCH:
+                    if not self.sink(batch):
+                        break
+                    num_rows += len(batch)
+                    batch = []
+            if batch and self.sink(batch):
+                num_rows += len(batch)
+        self.conns.discard(conn)
+        LOGGER.info(
+            "Ingested %d rows (%d rejected) in %.2fs",
+            num_rows, num_rejected, time.monotonic() - start,
+        )
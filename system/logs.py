@@ -0,0 +1,202 @@
+import collections
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+
+import click
+
+LOG_FORMATS = ("text", "json")
+# records waiting for the writer at most, further ones are dropped and counted
+QUEUE_SIZE = 10000
+# records formatted and written in one go at most
+BATCH_SIZE = 512
+# secs closing waits for the writer to flush what is queued
+CLOSE_TIMEOUT = 5.0
+
+
+class EventFilter(logging.Filter):
+    """Sample and rate limit records by the event they were logged with.
+
+    Log a record with extra={"event": name} to make it subject to the sample
+    rate and limit of name. A sample rate keeps that fraction of the records
+    at random, a limit lets through that many per sec, with bursts of as
+    many. Records without an event, or of events without either, all pass.
+    """
+
+    def __init__(self, samples=None, limits=None):
+        super().__init__()
+        self.samples = dict(samples or {})
+        self.limits = dict(limits or {})
+        # event -> [tokens, time of the last take]
+        self.buckets = {}
+        # event -> records sampled out or over the limit
+        self.dropped = collections.Counter()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        if event is None:
+            return True
+        rate = self.samples.get(event)
+        if rate is not None and random.random() >= rate:
+            with self.lock:
+                self.dropped[event] += 1
+            return False
+        limit = self.limits.get(event)
+        if limit is None:
+            return True
+        with self.lock:
+            if self.take(event, limit, record.created):
+                return True
+            self.dropped[event] += 1
+            return False
+
+    def take(self, event, limit, now):
+        """Take a token from the bucket of event if it has one, refilling limit per sec."""
+        bucket = self.buckets.get(event)
+        if bucket is None:
+            bucket = self.buckets[event] = [limit, now]
+        tokens = min(limit, bucket[0] + max(0.0, now - bucket[1]) * limit)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as compact JSON lines."""
+
+    def __init__(self, component):
+        super().__init__()
+        self.component = component
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "component": self.component,
+            "msg": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event is not None:
+            entry["event"] = event
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+class AsyncHandler(logging.Handler):
+    """Hand records to a background thread that formats and writes them in batches.
+
+    Logging never waits on the stream: once queue_size records are waiting
+    for the writer further ones are dropped, and the writer logs how many
+    with its next batch.
+    """
+
+    def __init__(self, stream=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        super().__init__()
+        self.stream = sys.stdout if stream is None else stream
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.reported = 0
+        self.drop_lock = threading.Lock()
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_forever, name="log-writer", daemon=True)
+        self.writer.start()
+
+    def handle(self, record):
+        # emit only enqueues, it needs none of the handler lock the base class takes
+        if not self.filter(record):
+            return False
+        self.emit(record)
+        return True
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+
+    def write_forever(self):
+        """Write the queued records until closed."""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # closing queues a None after the last record
+            stop = batch[-1] is None
+            lines = [self.format_record(record) for record in batch if record is not None]
+            dropped = self.dropped - self.reported
+            if dropped:
+                self.reported += dropped
+                lines.append(self.format_record(logging.makeLogRecord({
+                    "name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": "Dropped %d log records, the log writer fell behind",
+                    "args": (dropped,), "event": "log_dropped",
+                })))
+            lines = [line for line in lines if line is not None]
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    # stdout went away, nobody is left to read the log
+                    pass
+            if stop:
+                return
+
+    def format_record(self, record):
+        """Return record formatted, None if it does not format."""
+        try:
+            return self.format(record)
+        except Exception:
+            # reports it on stderr, the writer must keep going
+            self.handleError(record)
+            return None
+
+    def close(self):
+        """Write what is queued and stop the writer."""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.writer.join(CLOSE_TIMEOUT)
+        super().close()
+
+
+def parse_event_values(ctx, param, values):
+    """Turn repeated EVENT=NUMBER options into a dict."""
+    parsed = {}
+    for value in values:
+        event, _, number = value.partition("=")
+        try:
+            parsed[event] = float(number)
+        except ValueError:
+            raise click.BadParameter("expected EVENT=NUMBER: " + value)
+        if not event or parsed[event] < 0:
+            raise click.BadParameter("expected EVENT=NUMBER with NUMBER >= 0: " + value)
+    return parsed
+
+
+def setup_logging(component, log_format="text", samples=None, limits=None,
+                  queue_size=QUEUE_SIZE, stream=None):
+    """Log everything of this process through an AsyncHandler, tagged with component."""
+    handler = AsyncHandler(stream, queue_size)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter(component))
+    else:
+        handler.setFormatter(logging.Formatter(component + " [%(levelname)s] %(message)s"))
+    handler.addFilter(EventFilter(samples, limits))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    return handler
@@ -1,111 +1,397 @@
-import socket
-import json
 import logging
 import time
 import threading
-import sys
 import click
 
-from system.utils import send_msg_tcp
+from system.codec import CODECS, SUPPORTED_CODECS
+from system.dedup import DEDUP_COUNTERS
+from system.history import History, parse_query
+from system.histogram import KINDS, LANE_KINDS, PERCENTILES, Histogram
+from system.logs import LOG_FORMATS, QUEUE_SIZE, parse_event_values, setup_logging
+from system.metrics import Metrics, MetricsServer
+from system.sharding import port_list
+from system.source import PRIORITIES, RETRY_COUNTERS
+from system.utils import LISTEN_TIMEOUT, SERVER_MODES, ConnectionPool, create_server, notify
 
 LOGGER = logging.getLogger(__name__)
 
+# secs over which the report gives the msgs sent per sec
+THROUGHPUT_WINDOWS = (60, 300, 900)
+HISTOGRAM_LABELS = {
+    "send": "Send time",
+    "queue": "Queue wait",
+    "e2e": "End-to-end time",
+}
+HISTOGRAM_LABELS.update(
+    (kind, "Queue wait " + priority) for kind, priority in zip(LANE_KINDS, PRIORITIES)
+)
+
+
+def format_percentiles(histogram):
+    """Format the reported percentiles of histogram as one line."""
+    values = histogram.percentiles()
+    return " / ".join("-" if values[p] is None else "{:.3f}".format(values[p])
+                      for p in PERCENTILES)
+
+
+def report_lines(status, histograms, sender_histograms, retries=None, dedup=None, backlog=None,
+                 shards=None, throughput=None):
+    """Return the lines of a report on the totals, latency percentiles and per Sender send times.
+
+    shards maps the port of every Producer shard to its Totals, reported
+    each on a line of its own if there are several. throughput holds the
+    msgs sent per sec over each of THROUGHPUT_WINDOWS.
+    """
+    num_sent, num_fail = status["num_sent"], status["num_fail"]
+    if num_sent == 0:
+        avg_time = 0
+    else:
+        avg_time = status["total_time"] / num_sent
+
+    lines = ["==========================================="]
+    lines.append("Number of messages sent : {}".format(num_sent))
+    lines.append("Number of messages failed : {}".format(num_fail))
+    lines.append("Average time per message : {:.3f}".format(avg_time))
+    if backlog is not None:
+        lines.append("Messages waiting for a Sender : {}".format(backlog))
+    if throughput is not None:
+        lines.append("Messages sent per sec over {} min : {}".format(
+            " / ".join("{:g}".format(window / 60) for window in THROUGHPUT_WINDOWS),
+            " / ".join("-" if rate is None else "{:.2f}".format(rate) for rate in throughput)
+        ))
+    if retries is not None:
+        lines.append("Messages delivered first try / after retries / given up : {}".format(
+            " / ".join(str(retries[key]) for key in RETRY_COUNTERS)
+        ))
+    if dedup is not None:
+        lines.append("Alerts suppressed as duplicates / coalesced : {}".format(
+            " / ".join(str(dedup[key]) for key in DEDUP_COUNTERS)
+        ))
+    percentiles = "/".join("p{:g}".format(p) for p in PERCENTILES)
+    for kind in KINDS:
+        lines.append("{} {} : {}".format(
+            HISTOGRAM_LABELS[kind], percentiles, format_percentiles(histograms[kind])
+        ))
+    for port, histogram in sorted(sender_histograms.items()):
+        lines.append("Sender {} send time {} : {} ({} sends)".format(
+            port, percentiles, format_percentiles(histogram), histogram.count
+        ))
+    if shards is not None and len(shards) > 1:
+        for port, totals in sorted(shards.items()):
+            lines.append("Producer {} sent / failed / waiting : {} / {} / {}".format(
+                port, totals.status["num_sent"], totals.status["num_fail"], totals.backlog
+            ))
+    lines.append("===========================================")
+    return lines
+
+
+class Totals:
+    """The totals and histograms of one Producer, or of every shard added up."""
+
+    def __init__(self):
+        # of the last stats delta applied, None until a snapshot arrived
+        self.seq = None
+        self.status = {"num_sent": 0, "num_fail": 0, "total_time": 0}
+        self.histograms = {kind: Histogram() for kind in KINDS}
+        self.sender_histograms = {}
+        self.retries = dict.fromkeys(RETRY_COUNTERS, 0)
+        self.dedup = dict.fromkeys(DEDUP_COUNTERS, 0)
+        # msgs the Producer has yet to assign, as of the last stats
+        self.backlog = 0
+
+    def sender_histogram(self, port):
+        """Return the send time histogram of the Sender on port, created empty."""
+        histogram = self.sender_histograms.get(port)
+        if histogram is None:
+            histogram = self.sender_histograms[port] = Histogram()
+        return histogram
+
+    def add(self, stats_info):
+        """Add a pushed stats delta."""
+        for key in self.status:
+            self.status[key] += stats_info[key]
+        for kind, pairs in stats_info["histograms"].items():
+            self.histograms[kind].merge_list(pairs)
+        for port, pairs in stats_info["senders"].items():
+            self.sender_histogram(int(port)).merge_list(pairs)
+        for key, count in stats_info.get("retries", {}).items():
+            self.retries[key] += count
+        for key, count in stats_info.get("dedup", {}).items():
+            self.dedup[key] += count
+        self.backlog = stats_info.get("backlog", self.backlog)
+
+    def load(self, totals):
+        """Replace the totals and histograms with those of a snapshot or status reply."""
+        for key in self.status:
+            self.status[key] = totals[key]
+        for kind, pairs in totals.get("histograms", {}).items():
+            self.histograms[kind] = Histogram.from_list(pairs)
+        self.sender_histograms = {
+            int(port): Histogram.from_list(pairs)
+            for port, pairs in totals.get("senders", {}).items()
+        }
+        self.retries = dict.fromkeys(RETRY_COUNTERS, 0)
+        self.retries.update(totals.get("retries", {}))
+        self.dedup = dict.fromkeys(DEDUP_COUNTERS, 0)
+        self.dedup.update(totals.get("dedup", {}))
+        self.backlog = totals.get("backlog", self.backlog)
+
+    def merge(self, other):
+        """Add the totals and histograms of other."""
+        for key in self.status:
+            self.status[key] += other.status[key]
+        for kind, histogram in other.histograms.items():
+            self.histograms[kind].merge(histogram)
+        for port, histogram in other.sender_histograms.items():
+            self.sender_histogram(port).merge(histogram)
+        for key in self.retries:
+            self.retries[key] += other.retries[key]
+        for key in self.dedup:
+            self.dedup[key] += other.dedup[key]
+        self.backlog += other.backlog
+
+
 class Monitor:
-    def __init__(self, port, producer_port, N):
-        """Construct a Monitor instance and start listening for messages."""
+    def __init__(self, port, producer_port, N, server_mode="thread", codec="json",
+                 metrics_port=None, socket_dir=None):
+        """Construct a Monitor instance and start listening for messages.
+
+        producer_port may list the ports of several Producer shards, whose
+        totals are added up. With N None it only keeps the totals for others
+        to read, never reporting them.
+        """
         self.monitor_interval = N
         self.port = port
-        self.producer_port = producer_port
+        self.producer_ports = port_list(producer_port)
+        self.producer_port = self.producer_ports[0]
         self.shut_down = False
-        self.query_thread = threading.Thread(target=self.query_update)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.pool = ConnectionPool(codec=codec, socket_dir=socket_dir)
+        # totals of every shard kept current by the stats deltas it pushes
+        self.shards = {producer_port: Totals() for producer_port in self.producer_ports}
+        # and of all of them, the same as a single Producer's
+        self.totals = self.merge_shards()
+        # the totals over time, queried on the metrics port
+        self.history = History()
+        self.metrics = None
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics = Metrics()
+            self.metrics_server = MetricsServer(metrics_port, self.metrics,
+                                                {"/history": self.query_history})
+            self.instrument()
+        self.server = create_server(
+            server_mode, port, self.dispatch, lambda: self.shut_down, self.metrics, socket_dir
+        )
+        self.report_thread = threading.Thread(target=self.report_forever)
         self.create_listen_thread()
+        # a Monitor started after the Producer never gets its start msg
+        self.subscribe()
+
+    @property
+    def status(self):
+        return self.totals.status
+
+    @property
+    def histograms(self):
+        return self.totals.histograms
+
+    @property
+    def sender_histograms(self):
+        return self.totals.sender_histograms
+
+    @property
+    def retries(self):
+        return self.totals.retries
+
+    @property
+    def dedup(self):
+        return self.totals.dedup
+
+    @property
+    def backlog(self):
+        return self.totals.backlog
+
+    @property
+    def seq(self):
+        """Return the stats deltas applied, None until every shard sent its snapshot."""
+        seqs = [totals.seq for totals in self.shards.values()]
+        return None if None in seqs else sum(seqs)
+
+    def merge_shards(self):
+        """Return the totals of every shard added up, those of the only one if just one."""
+        if len(self.shards) == 1:
+            return next(iter(self.shards.values()))
+        totals = Totals()
+        for shard in self.shards.values():
+            totals.merge(shard)
+        return totals
+
+    def shard(self, msg_dict):
+        """Return the Totals of the shard that sent msg_dict, None if it is none of mine."""
+        return self.shards.get(msg_dict.get("producer_port", self.producer_port))
+
+    def instrument(self):
+        """Time the msgs to the Producer."""
+        metrics = self.metrics
+        self.pool.instrument(metrics)
+        metrics.gauge("sms_stats_seq", "Sequence number of the last stats delta applied.",
+                      lambda: self.seq or 0)
 
     def create_listen_thread(self):
         """Create thread running for listening msgs."""
         listen_thread = threading.Thread(target=self.listen_on_tcp)
         listen_thread.start()
+        # do not talk to peers before they are able to talk back
+        self.server.ready.wait(LISTEN_TIMEOUT)
+        if self.metrics_server is not None:
+            metrics_thread = threading.Thread(target=self.metrics_server.serve_forever)
+            metrics_thread.start()
 
     def listen_on_tcp(self):
         """Set up TCP Socket Server to listen for msgs."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            # Bind the socket to the server
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(("localhost", self.port))
-            sock.listen()
-
-            sock.settimeout(1)
-            while not self.shut_down:
-                try:
-                    producersocket, _ = sock.accept()
-                except socket.timeout:
-                    continue
-
-                with producersocket:
-                    msg_chunks = []
-                    while not self.shut_down:
-                        try:
-                            data = producersocket.recv(4096)
-                        except socket.timeout:
-                            continue
-                        if not data:
-                            break
-                        msg_chunks.append(data)
-                # Decode list-of-byte-strings to UTF8 and parse JSON data
-                msg_bytes = b''.join(msg_chunks)
-                msg_str = msg_bytes.decode("utf-8")
-                try:
-                    msg_dict = json.loads(msg_str)
-                except json.JSONDecodeError:
-                    continue
-
-                if msg_dict["message_type"] == "status":
-                    self.handle_update(msg_dict)
-                elif msg_dict["message_type"] == "start":
-                    self.query_thread.start()
-                elif msg_dict["message_type"] == "shutdown":
-                    self.handle_shutdown()
-
-    def query_update(self):
-        """Query the Producer every N secs for the updated status."""
+        self.server.serve_forever()
+
+    def dispatch(self, msg_dict):
+        """Route a single msg to its handler."""
+        with self.lock:
+            if msg_dict["message_type"] == "stats":
+                self.handle_stats(msg_dict)
+            elif msg_dict["message_type"] == "stats_snapshot":
+                self.handle_snapshot(msg_dict)
+            elif msg_dict["message_type"] == "status":
+                self.handle_update(msg_dict)
+            elif msg_dict["message_type"] == "start":
+                producer_port = msg_dict.get("producer_port")
+                self.subscribe(None if producer_port is None else [producer_port])
+            elif msg_dict["message_type"] == "shutdown":
+                self.handle_shutdown()
+
+    def subscribe(self, producer_ports=None):
+        """Ask the Producers, every shard unless given, to push stats to me from now on.
+
+        Their deltas are ignored until the snapshot answering this arrived.
+        """
+        subscribe_msg = {
+            "message_type": "subscribe",
+            "monitor_port": self.port,
+            "codecs": SUPPORTED_CODECS
+        }
+        for producer_port in producer_ports or self.producer_ports:
+            shard = self.shards.get(producer_port)
+            if shard is None:
+                continue
+            shard.seq = None
+            try:
+                self.pool.send(producer_port, subscribe_msg)
+            except OSError:
+                # a shard started later sends its start msg
+                pass
+
+    def handle_snapshot(self, snapshot_info):
+        """Reset the totals of a shard to the snapshot sent when subscribing."""
+        shard = self.shard(snapshot_info)
+        if shard is None:
+            return
+        shard.seq = snapshot_info["seq"]
+        shard.load(snapshot_info)
+        self.totals = self.merge_shards()
+        self.history.record(time.time(), self.status, self.backlog)
+        if (self.report_thread.ident is None and not self.shut_down and
+                self.monitor_interval is not None):
+            self.report_thread.start()
+
+    def handle_stats(self, stats_info):
+        """Add a pushed stats delta to the totals of its shard and of all."""
+        shard = self.shard(stats_info)
+        if shard is None or shard.seq is None or stats_info["seq"] <= shard.seq:
+            return
+        if stats_info["seq"] != shard.seq + 1:
+            # a delta got lost, start over from a fresh snapshot
+            shard.seq = None
+            self.subscribe([stats_info.get("producer_port", self.producer_port)])
+            return
+        shard.seq = stats_info["seq"]
+        shard.add(stats_info)
+        totals = self.totals
+        if totals is not shard:
+            totals.add(stats_info)
+            # a gauge of every shard rather than a delta
+            totals.backlog = sum(each.backlog for each in self.shards.values())
+        self.history.record(time.time(), self.status, self.backlog)
+
+    def query_history(self, params):
+        """Answer GET /history?query=rate&field=num_sent&window=60 from the history."""
+        query, field, window = parse_query(params)
+        with self.lock:
+            value = self.history.query(query, field, window)
+        return {"query": query, "field": field, "window": window, "value": value}
+
+    def report_forever(self):
+        """Display the latest totals every N secs."""
         while not self.shut_down:
-            update_msg = {"message_type": "status"}
-            send_msg_tcp(self.producer_port, update_msg)
-            time.sleep(self.monitor_interval)
+            with self.lock:
+                self.report()
+            # wakes up as soon as shutdown arrives instead of sleeping it out
+            self.stopped.wait(self.monitor_interval)
 
     def handle_update(self, update_info):
-        """Display the result of updated status from the Producer."""
-        num_sent, num_fail = update_info["num_sent"], update_info["num_fail"]
-        if update_info["num_sent"] == 0:
-            avg_time = 0
-        else:
-            avg_time = update_info["total_time"] // update_info["num_sent"]
-        
-        LOGGER.info("===========================================")
-        LOGGER.info("Number of messages sent : {}".format(num_sent))
-        LOGGER.info("Number of messages failed : {}".format(num_fail))
-        LOGGER.info("Average time per message : {}".format(avg_time))
-        LOGGER.info("===========================================")
+        """Display the status a Producer sent back to a status query."""
+        shard = self.shard(update_info)
+        if shard is None:
+            return
+        shard.load(update_info)
+        self.totals = self.merge_shards()
+        self.history.record(time.time(), self.status, self.backlog)
+        self.report()
+
+    def report(self):
+        """Display the totals, latency percentiles and per Sender send times."""
+        throughput = [self.history.rate("num_sent", window) for window in THROUGHPUT_WINDOWS]
+        for line in report_lines(self.status, self.histograms, self.sender_histograms,
+                                 self.retries, self.dedup, self.backlog, self.shards,
+                                 throughput):
+            LOGGER.info(line)
 
     def handle_shutdown(self):
         """Handle Producer request to shutdown."""
         self.shut_down = True
+        self.stopped.set()
+        self.server.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.pool.close()
 
     
 @click.command()
 @click.option("--port", "port", default=5999)
-@click.option("--producer-port", "producer_port", default=6000)
+@click.option("--producer-port", "producer_ports", default=[6000], multiple=True, type=int,
+              help="Port of every Producer shard, repeatable.")
 @click.option("--N", "N", default=15)
-def main(port, producer_port, N):
+@click.option("--server-mode", "server_mode", default="thread",
+              type=click.Choice(SERVER_MODES))
+@click.option("--codec", "codec", default="json", type=click.Choice(list(CODECS)),
+              help="Wire codec for msgs sent to the Producer.")
+@click.option("--metrics-port", "metrics_port", default=None, type=int,
+              help="Serve Prometheus metrics on http://localhost:PORT/metrics.")
+@click.option("--socket-dir", "socket_dir", default=None, type=click.Path(file_okay=False),
+              help="Also serve a Unix socket here, reach peers through theirs.")
+@click.option("--log-format", "log_format", default="text", type=click.Choice(LOG_FORMATS),
+              help="json logs a compact JSON object per line.")
+@click.option("--log-sample", "log_samples", multiple=True, callback=parse_event_values,
+              help="EVENT=RATE, log that fraction of the records of EVENT, repeatable.")
+@click.option("--log-limit", "log_limits", multiple=True, callback=parse_event_values,
+              help="EVENT=N, log at most N records of EVENT per sec, repeatable.")
+@click.option("--log-queue-size", "log_queue_size", default=QUEUE_SIZE,
+              type=click.IntRange(min=1),
+              help="Log records waiting to be written at most, further ones are dropped.")
+def main(port, producer_ports, N, server_mode, codec, metrics_port, socket_dir,
+         log_format, log_samples, log_limits, log_queue_size):
     """Run Monitor."""
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter(
-        f"Monitor:{port} [%(levelname)s] %(message)s"
-    )
-    handler.setFormatter(formatter)
-    root_logger = logging.getLogger()
-    root_logger.addHandler(handler)
-    root_logger.setLevel(logging.INFO)
-    Monitor(port, producer_port, N)
+    setup_logging(f"Monitor:{port}", log_format, log_samples, log_limits, log_queue_size)
+    Monitor(port, list(producer_ports), N, server_mode, codec, metrics_port, socket_dir)
+    notify("READY")
 
 
 if __name__ == '__main__':
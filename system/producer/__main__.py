@@ -1,168 +1,936 @@
-from email.policy import default
+import collections
 import random
 import time
-import socket
-import json
 import os
 import logging
+import queue
 import threading
-import sys
-from system.utils import send_msg_tcp
+from system.batching import Batcher
+from system.codec import CODECS, negotiate
+from system.dedup import DEDUP_COUNTERS, Coalescer, DedupIndex
+from system.histogram import KINDS, LANE_KINDS, Histogram
+from system.scheduler import SCHEDULERS, create_scheduler
+from system.sharding import first_id, port_list, shard_msgs, split_rows
+from system.ingest import IngestServer
+from system.logs import LOG_FORMATS, QUEUE_SIZE, parse_event_values, setup_logging
+from system.metrics import Metrics, MetricsServer
+from system.source import (
+    BULK_LANE, DEFAULT_LANE, LANE_INDEX, LANE_POLICIES, PRIORITIES, RETRY_COUNTERS, IterSource,
+    LaneQueue, RetryQueue,
+)
+from system.tracing import SAMPLE_RATE, Tracer
+from system.utils import LISTEN_TIMEOUT, SERVER_MODES, ConnectionPool, create_server, notify
+from system.wal import WriteAheadLog
 import click
 # Configure logging
 LOGGER = logging.getLogger(__name__)
 
 class Producer:
-    def __init__(self, port, monitor_port, msg_num = 1000):
-        """Construct a Producer instance and start listening for messages."""
-        self.msg_num = msg_num
-        self.available_senders = []
-        self.senders = set()
-        self.msg_queue = []
+    def __init__(self, port, monitor_port, msg_num = 1000, server_mode="thread",
+                 batch_size=1, batch_bytes=None, linger=0.0, scheduler="fifo", source=None,
+                 ingest_port=None, high_water=100000, wal_dir=None, codec="json",
+                 stats_interval=0.1, metrics_port=None, trace_dir=None,
+                 trace_sample=SAMPLE_RATE, lease_timeout=5.0, msg_timeout=60.0, max_attempts=3,
+                 retry_backoff=1.0, retry_backoff_max=60.0, lane_policy="strict",
+                 lane_weights=None, lane_deadlines=None, dedup_window=None,
+                 dedup_max_entries=1000000, coalesce_window=None, socket_dir=None,
+                 shard_ports=None):
+        """Construct a Producer instance and start listening for messages.
+
+        shard_ports lists the ports of every Producer sharing the work, port
+        among them, in the same order for all of them.
+        """
+        self.init_state(port, msg_num, shard_ports=shard_ports, high_water=high_water,
+                        scheduler=scheduler, lease_timeout=lease_timeout,
+                        msg_timeout=msg_timeout, max_attempts=max_attempts,
+                        retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max,
+                        lane_policy=lane_policy, lane_weights=lane_weights,
+                        lane_deadlines=lane_deadlines, dedup_window=dedup_window,
+                        dedup_max_entries=dedup_max_entries, coalesce_window=coalesce_window)
+        # (shard port, rows) of alerts other shards own, passed on off the lock
+        self.outbox = queue.Queue()
+        # rows other shards passed on, queued once this one is below high water
+        self.inbox = queue.Queue()
+        self.forwarder = self.intake = None
+        if self.shards > 1:
+            self.forwarder = threading.Thread(target=self.forward_forever)
+            self.intake = threading.Thread(target=self.intake_forever)
+        next_generated_id = 0
+        if wal_dir is not None:
+            if self.shards > 1:
+                # shards of a fleet may share a dir, each logs in its own
+                wal_dir = os.path.join(wal_dir, str(port))
+            self.wal = WriteAheadLog(wal_dir)
+            next_generated_id = self.recover()
+        self.init_source(source, next_generated_id)
         self.shut_down = False
+        # set once a shutdown msg came in, shut_down once the others had time to stop
+        self.shutting_down = False
+        self.stopped = threading.Event()
+        # Monitors that get stats deltas pushed, at most every stats_interval secs
+        self.subscribers = set()
+        self.stats_interval = stats_interval
+        self.stats_seq = 0
+        # totals and histograms as of the last stats pushed to the subscribers
+        self.published = dict(self.status)
+        self.published_histograms = {kind: Histogram() for kind in KINDS}
+        self.published_senders = {}
+        self.published_retries = dict(self.retries)
+        self.published_dedup = dict(self.dedup_counts)
+        self.published_backlog = None
+        self.publisher = None
+        self.reaper = threading.Thread(target=self.reap_forever)
         self.port = port
         self.monitor_port = monitor_port
-        self.status = {"num_sent": 0, "num_fail": 0, "total_time": 0}
+        self.codec = codec
+        self.pool = ConnectionPool(codec=codec, socket_dir=socket_dir)
+        # tasks for one sender are packed into a single sendmsg_batch, sent under the lock
+        # like those flushed by assign_messages
+        self.batcher = Batcher(
+            self.send_tasks, max_items=batch_size, max_bytes=batch_bytes,
+            linger=linger, size_of=lambda task: len(task[1]) + len(task[2]), lock=self.lock,
+        )
+        self.metrics = None
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics = Metrics()
+            self.metrics_server = MetricsServer(metrics_port, self.metrics)
+            self.instrument()
+        if trace_dir is not None:
+            self.tracer = Tracer(trace_dir, "Producer", port, trace_sample)
+        self.server = create_server(
+            server_mode, port, self.dispatch, lambda: self.shut_down, self.metrics, socket_dir
+        )
+        self.ingest_server = None
+        if ingest_port is not None:
+            self.ingest_server = IngestServer(ingest_port, self.ingest, lambda: self.shut_down)
         self.create_listen_thread()
         self.start_producer()
 
+    def init_state(self, port, msg_num, clock=time.monotonic, shard_ports=None,
+                   high_water=100000, scheduler="fifo", lease_timeout=5.0, msg_timeout=60.0,
+                   max_attempts=3, retry_backoff=1.0, retry_backoff_max=60.0,
+                   lane_policy="strict", lane_weights=None, lane_deadlines=None,
+                   dedup_window=None, dedup_max_entries=1000000, coalesce_window=None):
+        """Set up the queue, scheduling and stats state, everything but sockets and threads."""
+        # every latency is measured on this clock, simulations swap in a virtual one
+        self.clock = clock
+        self.msg_num = msg_num
+        # a shard owns the alerts to the phones hashing to it and the msg ids
+        # congruent to its index, so Senders can tell which shard a msg came from
+        self.shard_ports = port_list(shard_ports or port)
+        if port not in self.shard_ports:
+            raise ValueError("shard ports {} miss the Producer's own {}".format(
+                self.shard_ports, port))
+        self.shard = self.shard_ports.index(port)
+        self.shards = len(self.shard_ports)
+        # real alerts pushed in by clients, one lane per priority, sent ahead of the generated ones
+        self.queue = LaneQueue(lane_policy, lane_weights, lane_deadlines)
+        self.next_msg_id = first_id(msg_num, self.shard, self.shards)
+        self.high_water = high_water
+        self.status = {"num_sent": 0, "num_fail": 0, "total_time": 0}
+        # latency histograms, overall and per Sender
+        self.histograms = {kind: Histogram() for kind in KINDS}
+        self.sender_histograms = {}
+        # generated and recovered msgs count as enqueued when the Producer started
+        self.started = self.clock()
+        # msg_id -> (task, sender_port, enqueue time, deadline, lane) in assignment order,
+        # which is deadline order as every assignment gets the same msg_timeout
+        self.in_flight = collections.OrderedDict()
+        # Sender -> msg_ids it holds in flight, in assignment order
+        self.sender_msgs = {}
+        self.msg_timeout = msg_timeout
+        # Sender that heartbeats -> lease expiry, in renewal order which is expiry order
+        self.leases = collections.OrderedDict()
+        self.lease_timeout = lease_timeout
+        # Senders a send failed to, left for the reaper to evict
+        self.unreachable = set()
+        # the supervisor times cold starts to the first msg handed to a Sender
+        self.dispatched = False
+        # failed msgs wait here for their next attempt, then go back to the head of their lane
+        self.retry_queue = RetryQueue(self.clock)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        # msg_id -> (failed attempts, port of the Sender that failed it last) while retried
+        self.attempts = {}
+        # msgs delivered on the first attempt, delivered after retries, failed every attempt
+        self.retries = dict.fromkeys(RETRY_COUNTERS, 0)
+        # repeats of a recent alert are dropped, alerts to a phone merged into a queued one
+        self.dedup = None if not dedup_window else DedupIndex(dedup_window, dedup_max_entries)
+        self.coalescer = None if not coalesce_window else Coalescer(coalesce_window)
+        self.dedup_counts = dict.fromkeys(DEDUP_COUNTERS, 0)
+        self.wal = None
+        # picks the Sender for every msg out of those with free credits
+        self.scheduler = create_scheduler(scheduler)
+        self.senders = set()
+        # Senders no longer assigned msgs, shut down once those they hold are finished
+        self.retiring = set()
+        # Senders told to shut down, whose last heartbeats must not take them back
+        self.retired = set()
+        self.lock = threading.Lock()
+        # bulk ingestion waits on this while the queue is above high water
+        self.drained = threading.Condition(self.lock)
+        self.tracer = None
+        # msg_id -> wall clock time tracing picked it, until its result is in
+        self.traced = {}
+
+    def init_source(self, source=None, next_generated_id=0, rng=None):
+        """Set up where msgs come from once the queue is empty, the generated ones by default."""
+        # msgs are pulled lazily as senders free up, never materialized up front
+        self.source = source or IterSource(shard_msgs(
+            self.msg_num, self.shard, self.shards, first=next_generated_id, rng=rng))
+        # generated msgs not pulled from the source yet, part of the backlog
+        self.generated_left = 0 if source is not None else len(range(
+            first_id(next_generated_id, self.shard, self.shards), self.msg_num, self.shards))
+
+    def recover(self):
+        """Rebuild the queue and stats from the write-ahead log, return the next generated msg id."""
+        start = time.monotonic()
+        state = self.wal.recover()
+        for task in state.pending.values():
+            self.queue.put(task, state.lanes.get(task[0], DEFAULT_LANE), self.started)
+        self.status = state.status
+        self.next_msg_id = max(self.next_msg_id,
+                               first_id(state.next_msg_id, self.shard, self.shards))
+        LOGGER.info(
+            "Recovered %d pending msgs (%d were in flight) in %.2fs",
+            len(state.pending), state.requeued, time.monotonic() - start,
+        )
+        return state.next_generated_id
+
+    def instrument(self):
+        """Time assigning and sending msgs, and expose queue and Senders as gauges."""
+        metrics = self.metrics
+        metrics.sampled(self, "assign_messages", "sms_assign_seconds",
+                        "Time spent assigning msgs to Senders.")
+        self.pool.instrument(metrics)
+        metrics.gauge("sms_queue_depth", "Alerts waiting to be assigned.",
+                      lambda: len(self.queue))
+        for lane, priority in enumerate(PRIORITIES):
+            metrics.gauge("sms_queue_depth_" + priority,
+                          "{} alerts waiting to be assigned.".format(priority.capitalize()),
+                          lambda lane=lane: self.queue.depth(lane))
+        metrics.gauge("sms_in_flight", "Msgs assigned to Senders and not finished yet.",
+                      lambda: len(self.in_flight))
+        metrics.gauge("sms_senders", "Registered Senders.", lambda: len(self.senders))
+        metrics.gauge("sms_senders_available", "Senders with a free credit.",
+                      self.scheduler.num_available)
+
     def start_producer(self):
-        """Generate all msgs and tell monitor to start monitoring."""
-        self.generate_all_msgs()
-        send_msg_tcp(self.monitor_port, {"message_type": "start"})
+        """Hand msgs to already registered senders and tell monitor to start monitoring."""
+        with self.lock:
+            self.assign_messages()
+        self.pool.send(self.monitor_port, {"message_type": "start", "producer_port": self.port})
     
     def create_listen_thread(self):
         """Create thread running for listening msgs."""
         listen_thread = threading.Thread(target=self.listen_on_tcp)
         listen_thread.start()
+        # do not talk to peers before they are able to talk back
+        self.server.ready.wait(LISTEN_TIMEOUT)
+        self.reaper.start()
+        if self.forwarder is not None:
+            self.forwarder.start()
+            self.intake.start()
+        if self.ingest_server is not None:
+            ingest_thread = threading.Thread(target=self.ingest_server.serve_forever)
+            ingest_thread.start()
+            self.ingest_server.ready.wait(LISTEN_TIMEOUT)
+        if self.metrics_server is not None:
+            metrics_thread = threading.Thread(target=self.metrics_server.serve_forever)
+            metrics_thread.start()
 
     def listen_on_tcp(self):
         """Set up TCP Socket Server to listen for msgs."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            # Bind the socket to the server
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(("localhost", self.port))
-            sock.listen()
-
-            sock.settimeout(1)
-            while not self.shut_down:
-                try:
-                    clientsocket, address = sock.accept()
-                except socket.timeout:
-                    continue
-
-                with clientsocket:
-                    message_chunks = []
-                    while not self.shut_down:
-                        try:
-                            data = clientsocket.recv(4096)
-                        except socket.timeout:
-                            continue
-                        if not data:
-                            break
-                        message_chunks.append(data)
-
-                message_bytes = b''.join(message_chunks)
-                message_str = message_bytes.decode("utf-8")
-                try:
-                    message_dict = json.loads(message_str)
-                except json.JSONDecodeError:
-                    continue
+        self.server.serve_forever()
 
-                if message_dict["message_type"] == "register":
-                    self.handle_sender_registration(message_dict)
-                elif message_dict["message_type"] == "finished":
-                    self.handle_send_finished(message_dict)
-                elif message_dict["message_type"] == "status":
-                    self.handle_status_update()
-                elif message_dict["message_type"] == "shutdown":
-                    self.handle_shutdown()
+    def dispatch(self, message_dict):
+        """Route a single msg to its handler."""
+        if message_dict["message_type"] == "enqueue" and message_dict.get("forwarded"):
+            # waits out high water like bulk ingestion, without holding up the connection
+            self.inbox.put(message_dict["msgs"])
+            return
+        if message_dict["message_type"] == "shutdown":
+            # takes the lock itself, msgs keep being handled while the others shut down
+            self.handle_shutdown()
+            return
+        with self.lock:
+            if message_dict["message_type"] == "register":
+                self.handle_sender_registration(message_dict)
+            elif message_dict["message_type"] == "finished":
+                self.handle_send_finished(message_dict)
+            elif message_dict["message_type"] == "finished_batch":
+                self.handle_batch_finished(message_dict)
+            elif message_dict["message_type"] == "enqueue":
+                self.handle_enqueue(message_dict)
+            elif message_dict["message_type"] == "heartbeat":
+                self.handle_heartbeat(message_dict)
+            elif message_dict["message_type"] == "retire":
+                self.handle_retire(message_dict)
+            elif message_dict["message_type"] == "subscribe":
+                self.handle_subscribe(message_dict)
+            elif message_dict["message_type"] == "status":
+                self.handle_status_update()
 
     def handle_sender_registration(self, register_info):
         """Handle the Sender registration. Assign msgs to Sender if having msgs in queue."""
         sender_port = register_info["sender_port"]
-        self.available_senders.append(sender_port)
+        # a Sender registering afresh is a new process on the port of a retired one
+        self.retiring.discard(sender_port)
+        self.retired.discard(sender_port)
+        # Senders that predate the binary codec offer nothing and keep JSON
+        self.pool.set_codec(sender_port, negotiate(register_info.get("codecs", []), self.codec))
+        # every credit is one msg the Sender is willing to have in flight
+        self.scheduler.add_sender(sender_port, register_info.get("credits", 1))
         self.senders.add(sender_port)
-        self.assign_messages()    
+        self.unreachable.discard(sender_port)
+        # Senders that predate heartbeats are never evicted for being silent
+        if register_info.get("heartbeat"):
+            self.leases[sender_port] = self.clock() + self.lease_timeout
+            self.leases.move_to_end(sender_port)
+        self.assign_messages()
+
+    def handle_heartbeat(self, heartbeat_info):
+        """Renew the Sender's lease, or take it back if it was evicted but is alive after all."""
+        sender_port = heartbeat_info["sender_port"]
+        if sender_port in self.leases:
+            self.renew_lease(sender_port)
+        elif sender_port in self.retiring or sender_port in self.retired:
+            # sent before it was told to go, it is not coming back
+            pass
+        elif sender_port not in self.senders:
+            LOGGER.info("Sender %s is back", sender_port)
+            self.handle_sender_registration(heartbeat_info)
+
+    def handle_retire(self, retire_info):
+        """Stop assigning msgs to a Sender and shut it down once the msgs it holds are finished."""
+        sender_port = retire_info["sender_port"]
+        LOGGER.info("Retiring Sender %s", sender_port)
+        self.retiring.add(sender_port)
+        self.leases.pop(sender_port, None)
+        self.unreachable.discard(sender_port)
+        self.scheduler.remove_sender(sender_port)
+        self.senders.discard(sender_port)
+        self.finish_retiring(sender_port)
+
+    def finish_retiring(self, sender_port):
+        """Shut a retiring Sender down if it holds no more msgs."""
+        if self.sender_msgs.get(sender_port):
+            return
+        self.sender_msgs.pop(sender_port, None)
+        self.retiring.discard(sender_port)
+        self.retired.add(sender_port)
+        self.shutdown_sender(sender_port)
+
+    def shutdown_sender(self, sender_port):
+        """Tell a drained Sender to shut down."""
+        try:
+            self.pool.send(sender_port, {"message_type": "shutdown"})
+        except OSError:
+            pass
+
+    def renew_lease(self, sender_port):
+        """Extend the lease of a Sender that heartbeats, as it was just heard from."""
+        if sender_port in self.leases:
+            self.leases[sender_port] = self.clock() + self.lease_timeout
+            self.leases.move_to_end(sender_port)
 
     def handle_send_finished(self, finish_info):
         """Handle the Sender finish. Collect the statistics and assgin new msg to the Sender."""
         success, send_time = finish_info["success"], finish_info["send_time"]
         sender_port = finish_info["sender_port"]
+        self.renew_lease(sender_port)
+        received = time.time() if self.traced else None
+        self.record_send_result(
+            sender_port, finish_info.get("msg_id"), success, send_time, self.clock()
+        )
+
+        self.scheduler.release(sender_port, finish_info.get("credits", 1))
+        if sender_port in self.retiring:
+            self.finish_retiring(sender_port)
+        self.assign_messages()
+        if received is not None:
+            self.trace_finished([finish_info.get("msg_id")], finish_info, received)
+
+    def handle_batch_finished(self, finish_info):
+        """Handle the results of a whole batch reported by a Sender at once."""
+        results = finish_info["results"]
+        sender_port = finish_info["sender_port"]
+        self.renew_lease(sender_port)
+        received = time.time() if self.traced else None
+        now = self.clock()
+        for msg_id, success, send_time in results:
+            self.record_send_result(sender_port, msg_id, success, send_time, now)
+
+        self.scheduler.release(sender_port, finish_info.get("credits", len(results)))
+        if sender_port in self.retiring:
+            self.finish_retiring(sender_port)
+        self.assign_messages()
+        if received is not None:
+            trace = finish_info.get("trace")
+            msg_ids = trace["ids"] if trace else [result[0] for result in results]
+            self.trace_finished(msg_ids, finish_info, received)
+
+    def trace_finished(self, msg_ids, finish_info, received):
+        """Record the trip back from the Sender and the handling of the traced msg_ids."""
+        tracer = self.tracer
+        trace = finish_info.get("trace")
+        handled = time.time()
+        for msg_id in msg_ids:
+            if self.traced.pop(msg_id, None) is None:
+                continue
+            # Senders without tracing do not send the context back
+            if trace is not None:
+                tracer.span("wire", msg_id, trace["sent"], received,
+                            {"sender": finish_info["sender_port"]})
+            tracer.span("finished", msg_id, received, handled)
+
+    def record_send_result(self, sender_port, msg_id, success, send_time, now):
+        """Collect the statistics of a single send, finished at monotonic time now."""
+        self.scheduler.record(sender_port, success, send_time)
+        entry = self.in_flight.get(msg_id)
+        if entry is None or entry[1] != sender_port:
+            # a late result of an assignment that expired or of a Sender the msg was taken
+            # from, the copy requeued counts instead, or already did
+            return
+        del self.in_flight[msg_id]
+        del self.sender_msgs[sender_port][msg_id]
+        self.histograms["send"].record(send_time)
+        sender_histogram = self.sender_histograms.get(sender_port)
+        if sender_histogram is None:
+            sender_histogram = self.sender_histograms[sender_port] = Histogram()
+        sender_histogram.record(send_time)
+        if success:
+            self.histograms["e2e"].record(now - entry[2])
+        done = self.count_attempt(msg_id, entry, success, sender_port, now)
+        if self.wal is not None and msg_id is not None:
+            if done:
+                self.wal.log_finished(msg_id, success, send_time)
+            else:
+                # still pending should the Producer restart, but the failure counts
+                self.wal.log_retried(msg_id, send_time)
         if not success:
             self.status["num_fail"] += 1
         else:
             self.status["num_sent"] += 1
             self.status["total_time"] += send_time
 
-        self.available_senders.append(sender_port)
-        self.assign_messages() 
+    def count_attempt(self, msg_id, entry, success, sender_port, now):
+        """Count how a msg fared and schedule its retry if it failed. Return True if it is done."""
+        attempts = self.attempts.pop(msg_id, None)
+        if success:
+            self.retries["first_try" if attempts is None else "retried"] += 1
+            return True
+        failed = 1 if attempts is None else attempts[0] + 1
+        if failed >= self.max_attempts:
+            self.retries["exhausted"] += 1
+            return True
+        self.attempts[msg_id] = (failed, sender_port)
+        self.schedule_retry((entry[4], entry[2], entry[0]), now + self.backoff(failed))
+        return False
+
+    def backoff(self, failed):
+        """Return the secs to wait after failed attempts, doubling each time, with jitter."""
+        delay = min(self.retry_backoff_max, self.retry_backoff * 2 ** (failed - 1))
+        # msgs that failed together do not all come back at once
+        return delay * random.uniform(0.5, 1.0)
+
+    def schedule_retry(self, queued, due):
+        """Hold the (lane, enqueued, task) of a failed msg until its retry is due."""
+        self.retry_queue.put(queued, due)
+
+    def handle_enqueue(self, enqueue_info):
+        """Handle a client pushing one alert, or a list of [phone, msg(, priority)] alerts."""
+        if "msgs" in enqueue_info:
+            rows = enqueue_info["msgs"]
+        else:
+            rows = [(enqueue_info["phone"], enqueue_info["msg"], enqueue_info.get("priority"))]
+        valid = [row for row in rows if len(row) < 3 or not row[2] or row[2] in LANE_INDEX]
+        if len(valid) < len(rows):
+            LOGGER.warning("Dropped %d alerts of unknown priority", len(rows) - len(valid))
+        self.enqueue(valid)
+        self.assign_messages()
+
+    def enqueue(self, rows):
+        """Queue (phone, msg[, priority]) rows under fresh msg ids. Caller holds the lock.
+
+        Rows of phones another shard owns are passed on to it.
+        """
+        if self.shards > 1:
+            rows = self.forward(rows)
+        self.queue_rows(rows)
+
+    def queue_rows(self, rows):
+        """Queue (phone, msg[, priority]) rows this shard owns. Caller holds the lock."""
+        now = self.clock()
+        dedup, coalescer = self.dedup, self.coalescer
+        for row in rows:
+            phone, msg = row[0], row[1]
+            if dedup is not None and dedup.is_duplicate(phone, msg, now):
+                self.dedup_counts["suppressed"] += 1
+                continue
+            lane = LANE_INDEX[row[2]] if len(row) > 2 and row[2] else DEFAULT_LANE
+            if coalescer is not None:
+                merged = coalescer.merge(phone, lane, msg, now)
+                if merged is not None:
+                    self.dedup_counts["coalesced"] += 1
+                    # replaces the queued msg on replay, keeping its place
+                    if self.wal is not None:
+                        self.wal.log_enqueued(merged[0], phone, merged[1], lane=lane)
+                    continue
+                coalescer.track(self.next_msg_id, phone, lane, msg, now)
+            if self.wal is not None:
+                self.wal.log_enqueued(self.next_msg_id, phone, msg, lane=lane)
+            self.queue.put((self.next_msg_id, phone, msg), lane, now)
+            self.next_msg_id += self.shards
+
+    def forward(self, rows):
+        """Hand rows to the forwarder for the shards owning their phones, return this shard's."""
+        split = split_rows(rows, self.shards)
+        for shard, shard_rows in enumerate(split):
+            if shard != self.shard and shard_rows:
+                self.outbox.put((self.shard_ports[shard], shard_rows))
+        return split[self.shard]
+
+    def forward_forever(self):
+        """Pass alerts on to the shards owning them until shut down."""
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                return
+            port, rows = item
+            try:
+                self.pool.send(port, {"message_type": "enqueue", "msgs": rows, "forwarded": True})
+            except OSError:
+                # better sent from here than lost, only repeats to them may slip through
+                LOGGER.warning("Shard %s unreachable, queued its %d alerts here", port, len(rows))
+                with self.lock:
+                    if not self.shut_down:
+                        self.queue_rows(rows)
+                        self.assign_messages()
+
+    def intake_forever(self):
+        """Queue the alerts other shards pass on until shut down."""
+        while True:
+            rows = self.inbox.get()
+            if rows is None or not self.ingest(rows):
+                return
+
+    def ingest(self, rows):
+        """Queue a batch of bulk-ingested rows, blocking from high water until half of it.
+
+        Return False once the Producer shuts down and the rows were dropped.
+        """
+        with self.drained:
+            if len(self.queue) >= self.high_water:
+                # resuming at every dip under high water would wake up for a batch at a time
+                while len(self.queue) > self.high_water // 2 and not self.shut_down:
+                    self.drained.wait(1)
+            if self.shut_down:
+                return False
+            self.enqueue(rows)
+            self.assign_messages()
+            return True
 
     def handle_status_update(self):
         """Handle the Monitor request. Send back the current status."""
-        update_msg = {"message_type": "status"}
+        update_msg = {"message_type": "status", "producer_port": self.port}
         update_msg.update(self.status)
-        send_msg_tcp(self.monitor_port, update_msg)
+        update_msg["histograms"] = {
+            kind: histogram.to_list() for kind, histogram in self.histograms.items()
+        }
+        update_msg["senders"] = {
+            str(port): histogram.to_list() for port, histogram in self.sender_histograms.items()
+        }
+        update_msg["retries"] = dict(self.retries)
+        update_msg["dedup"] = dict(self.dedup_counts)
+        self.pool.send(self.monitor_port, update_msg)
         
+    def handle_subscribe(self, subscribe_info):
+        """Handle a Monitor subscribing to stats. Send it the totals the next delta builds on."""
+        monitor_port = subscribe_info["monitor_port"]
+        self.pool.set_codec(monitor_port, negotiate(subscribe_info.get("codecs", []), self.codec))
+        self.subscribers.add(monitor_port)
+        snapshot = {"message_type": "stats_snapshot", "seq": self.stats_seq,
+                    "producer_port": self.port}
+        snapshot.update(self.published)
+        snapshot["histograms"] = {
+            kind: histogram.to_list() for kind, histogram in self.published_histograms.items()
+        }
+        snapshot["senders"] = {
+            str(port): histogram.to_list() for port, histogram in self.published_senders.items()
+        }
+        snapshot["retries"] = dict(self.published_retries)
+        snapshot["dedup"] = dict(self.published_dedup)
+        snapshot["backlog"] = self.published_backlog or 0
+        self.pool.send(monitor_port, snapshot)
+        if self.publisher is None:
+            self.publisher = threading.Thread(target=self.publish_forever)
+            self.publisher.start()
+
+    def publish_forever(self):
+        """Push the stats delta to every subscriber, coalescing changes within stats_interval."""
+        while not self.stopped.wait(self.stats_interval):
+            with self.lock:
+                if self.shut_down:
+                    return
+                stats_msg = self.stats_delta()
+                if stats_msg is None:
+                    continue
+                subscribers = list(self.subscribers)
+            # every subscriber gets the same frame, encoded only once
+            unreachable = self.pool.broadcast(subscribers, stats_msg)
+            if unreachable:
+                with self.lock:
+                    self.subscribers.difference_update(unreachable)
+
+    def stats_delta(self):
+        """Return the stats msg for everything since the last push, None if nothing changed."""
+        delta = {key: self.status[key] - self.published[key] for key in self.status}
+        retries = {key: self.retries[key] - self.published_retries[key] for key in self.retries}
+        dedup = {key: self.dedup_counts[key] - self.published_dedup[key]
+                 for key in self.dedup_counts}
+        queue = self.histograms["queue"]
+        backlog = self.backlog()
+        if (not any(delta.values()) and not any(retries.values()) and
+                not any(dedup.values()) and backlog == self.published_backlog and
+                queue.count == self.published_histograms["queue"].count):
+            return None
+        self.published = dict(self.status)
+        self.published_backlog = backlog
+        self.published_retries = dict(self.retries)
+        self.published_dedup = dict(self.dedup_counts)
+        self.stats_seq += 1
+        stats_msg = {"message_type": "stats", "seq": self.stats_seq, "producer_port": self.port}
+        stats_msg.update(delta)
+        # only histograms that changed are diffed, and shipped as their changed buckets
+        stats_msg["histograms"] = histograms = {}
+        for kind, histogram in self.histograms.items():
+            histograms[kind] = self.diff_histogram(histogram, self.published_histograms, kind)
+        stats_msg["senders"] = senders = {}
+        for port, histogram in self.sender_histograms.items():
+            changes = self.diff_histogram(histogram, self.published_senders, port)
+            if changes:
+                senders[str(port)] = changes
+        stats_msg["retries"] = retries
+        stats_msg["dedup"] = dedup
+        # a gauge rather than a delta, the latest value is all that counts
+        stats_msg["backlog"] = backlog
+        return stats_msg
+
+    def backlog(self):
+        """Count the msgs waiting for a Sender: queued, waiting to be retried and not generated yet."""
+        return len(self.queue) + len(self.retry_queue) + self.generated_left
+
+    @staticmethod
+    def diff_histogram(histogram, published, key):
+        """Return the buckets of histogram changed since published[key], then publish it."""
+        before = published.get(key)
+        if before is None:
+            before = published[key] = Histogram()
+        if histogram.count == before.count:
+            return []
+        changes = histogram.delta(before)
+        published[key] = histogram.copy()
+        return changes
+
+    def reap_forever(self):
+        """Evict dead Senders and requeue stuck msgs until shut down."""
+        interval = min(1.0, self.lease_timeout / 4, self.msg_timeout / 4)
+        timeout = interval
+        while not self.stopped.wait(timeout):
+            with self.lock:
+                if self.shut_down:
+                    return
+                now = self.clock()
+                self.reap(now)
+                due = self.retry_queue.next_due()
+            # wake up for the next retry, those already due wait for a free credit
+            timeout = interval if due is None or due <= now else min(interval, due - now)
+
+    def reap(self, now):
+        """Evict dead Senders, requeue expired msgs and assign the retries that are due."""
+        requeued = []
+        for sender_port in list(self.unreachable):
+            requeued.extend(self.evict_sender(sender_port))
+        leases = self.leases
+        while leases:
+            sender_port, expiry = next(iter(leases.items()))
+            if expiry > now:
+                break
+            LOGGER.warning("Sender %s missed its heartbeats", sender_port)
+            requeued.extend(self.evict_sender(sender_port))
+        in_flight = self.in_flight
+        while in_flight:
+            entry = next(iter(in_flight.values()))
+            if entry[3] > now:
+                break
+            in_flight.popitem(last=False)
+            del self.sender_msgs[entry[1]][entry[0][0]]
+            # the Sender keeps the credit until the result shows up, but counts as failing
+            self.scheduler.record(entry[1], False, self.msg_timeout)
+            requeued.append(entry)
+        if requeued:
+            LOGGER.warning("Requeued %d msgs", len(requeued))
+            self.requeue(requeued)
+            # retiring Senders whose msgs were requeued have nothing left to wait for
+            for sender_port in list(self.retiring):
+                self.finish_retiring(sender_port)
+        due = self.retry_queue.next_due()
+        if requeued or (due is not None and due <= now):
+            self.assign_messages()
+
+    def evict_sender(self, sender_port):
+        """Stop assigning msgs to a Sender, return the in-flight entries it held."""
+        self.unreachable.discard(sender_port)
+        self.leases.pop(sender_port, None)
+        self.scheduler.remove_sender(sender_port)
+        self.senders.discard(sender_port)
+        held = self.sender_msgs.pop(sender_port, ())
+        return [self.in_flight.pop(msg_id) for msg_id in held]
+
+    def requeue(self, entries):
+        """Put the tasks of in-flight entries back at the head of their lanes."""
+        self.queue.requeue([(entry[4], entry[2], entry[0]) for entry in entries])
+
     def handle_shutdown(self):
-        """Handle the User shutdown. Send shutdown requests to Senders and Monitor."""
-        for sender_port in self.senders:
+        """Handle the User shutdown. Send shutdown requests to Senders, Monitors and other shards."""
+        with self.lock:
+            if self.shutting_down:
+                # the other shards pass it back
+                return
+            self.shutting_down = True
             shutdown_msg = {"message_type": "shutdown"}
-            send_msg_tcp(sender_port, shutdown_msg)
-        send_msg_tcp(self.monitor_port, shutdown_msg)
+            peers = set(self.shard_ports) - {self.port}
+            # Senders that died since they were last heard from are skipped
+            ports = self.senders | self.retiring | self.subscribers | {self.monitor_port} | peers
+            for port in ports:
+                try:
+                    self.pool.send(port, shutdown_msg)
+                except OSError:
+                    pass
         # wait for monitor and senders shutdown
         time.sleep(1)
-        self.shut_down= True
+        with self.lock:
+            self.shut_down= True
+            self.stopped.set()
+            self.drained.notify_all()
+            self.outbox.put(None)
+            self.inbox.put(None)
+            self.batcher.close()
+            if self.wal is not None:
+                self.wal.close()
+            self.server.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            if self.tracer is not None:
+                self.tracer.close()
+            self.pool.close()
 
     def assign_messages(self):
-        """Assign msg to available sender."""
-        while self.available_senders and self.msg_queue:
-            sender_port = self.available_senders.pop(0)
-            msg_id, phone, msg = self.msg_queue.pop(0)
+        """Assign msgs to available senders until their credits or the source run out."""
+        now = self.clock()
+        retry_queue = self.retry_queue
+        if retry_queue and retry_queue.next_due() <= now:
+            due = []
+            queued = retry_queue.pop_due()
+            while queued is not None:
+                due.append(queued)
+                queued = retry_queue.pop_due()
+            # retries jump the msgs of their own lane, not those of more urgent ones
+            self.queue.requeue(due)
+        histograms = self.histograms
+        while self.scheduler.has_capacity():
+            queued = self.queue.pop(now)
+            if queued is None:
+                task = self.source.next_msg()
+                if task is None:
+                    break
+                if self.generated_left:
+                    self.generated_left -= 1
+                if self.wal is not None:
+                    self.wal.log_enqueued(*task, generated=True)
+                # generated msgs are the bulkiest of all, served once every lane is empty
+                lane, enqueued = BULK_LANE, self.started
+            else:
+                lane, enqueued, task = queued
+                if self.coalescer is not None:
+                    task = self.coalescer.take(task, lane)
+            histograms["queue"].record(now - enqueued)
+            histograms[LANE_KINDS[lane]].record(now - enqueued)
+            # a retry goes to another Sender than the one it failed on if it can
+            attempts = self.attempts.get(task[0]) if self.attempts else None
+            sender_port = self.scheduler.acquire(None if attempts is None else attempts[1])
+            self.in_flight[task[0]] = (task, sender_port, enqueued, now + self.msg_timeout, lane)
+            held = self.sender_msgs.get(sender_port)
+            if held is None:
+                held = self.sender_msgs[sender_port] = {}
+            held[task[0]] = None
+            if self.tracer is not None and self.tracer.sample():
+                self.trace_queued(task[0], enqueued, now)
+            if self.wal is not None:
+                self.wal.log_assigned(task[0], sender_port)
+            self.batcher.add(sender_port, task)
+        self.batcher.release()
+        if len(self.queue) <= self.high_water // 2:
+            self.drained.notify_all()
+
+    def trace_queued(self, msg_id, enqueued, now):
+        """Pick msg_id for tracing and record how long it waited in the queue."""
+        tracer = self.tracer
+        assigned = tracer.wall(now)
+        tracer.span("queued", msg_id, tracer.wall(enqueued), assigned)
+        self.traced[msg_id] = assigned
+
+    def send_tasks(self, sender_port, tasks):
+        """Send a batch of (msg_id, phone, msg) tasks to a Sender. Caller holds the lock."""
+        if len(tasks) == 1:
+            msg_id, phone, msg = tasks[0]
             task = {
                 "message_type": "sendmsg",
                 "msg_id": msg_id,
                 "phone": phone,
                 "msg": msg
             }
-            send_msg_tcp(sender_port, task)
-
-    def generate_phone_number(self):
-        """Generate a valid phone number."""
-        phoneNumber = ""
-        for _ in range(9):
-            phoneNumber += str(random.randint(0, 9))
-        return phoneNumber
-
-    def generate_single_msg(self):
-        """Generate a valid msg."""
-        msg_len = random.randint(1, 100)
-        msg = ""
-        for _ in range(msg_len):
-            msg += chr(random.randint(0, 25)+ord('a'))
-        return msg
-    
-    def generate_all_msgs(self):
-        """Generate all msgs at once."""
-        for msg_id in range(self.msg_num):
-            self.msg_queue.append((msg_id, self.generate_phone_number(), self.generate_single_msg()))
-   
+        else:
+            task = {
+                "message_type": "sendmsg_batch",
+                "tasks": tasks
+            }
+        traced = None
+        if self.traced:
+            traced = [msg_id for msg_id, _, _ in tasks if msg_id in self.traced]
+        if traced:
+            # traced msgs carry their context, which the binary codec ships as JSON
+            task["trace"] = self.tracer.context(traced)
+        try:
+            self.pool.send(sender_port, task)
+        except OSError:
+            # the tasks stay in flight until the reaper evicts the Sender and requeues them
+            LOGGER.warning("Sender %s unreachable", sender_port, extra={"event": "unreachable"})
+            self.unreachable.add(sender_port)
+            return
+        if not self.dispatched:
+            self.dispatched = True
+            notify("DISPATCHED")
+        if not traced:
+            return
+        sent = time.time()
+        for msg_id in traced:
+            self.tracer.span("assign", msg_id, self.traced[msg_id], sent, {"sender": sender_port})
+
+
+def parse_lane_values(ctx, param, values):
+    """Turn repeated PRIORITY=NUMBER options into a dict."""
+    parsed = {}
+    for value in values:
+        priority, _, number = value.partition("=")
+        if priority not in LANE_INDEX:
+            raise click.BadParameter("unknown priority {!r}, expected one of {}".format(
+                priority, ", ".join(PRIORITIES)))
+        try:
+            parsed[priority] = float(number)
+        except ValueError:
+            raise click.BadParameter("expected PRIORITY=NUMBER: " + value)
+    return parsed
+
 
 @click.command()
 @click.option("--port", "port", default=6000)
 @click.option("--monitor-port", "monitor_port", default=5999)
 @click.option("--msg-num", "msg_num", default=1000)
-def main(port, monitor_port, msg_num):
+@click.option("--server-mode", "server_mode", default="thread",
+              type=click.Choice(SERVER_MODES))
+@click.option("--batch-size", "batch_size", default=1, type=click.IntRange(min=1),
+              help="Max tasks packed into one msg to a Sender.")
+@click.option("--batch-bytes", "batch_bytes", default=None, type=click.IntRange(min=1),
+              help="Flush a batch once its phone and msg text reach this many bytes.")
+@click.option("--linger", "linger", default=0.0, type=click.FloatRange(min=0),
+              help="Secs a partial batch may wait for more tasks.")
+@click.option("--scheduler", "scheduler", default="fifo",
+              type=click.Choice(list(SCHEDULERS)),
+              help="Policy picking the Sender for every msg.")
+@click.option("--ingest-port", "ingest_port", default=None, type=int,
+              help="Accept bulk NDJSON/CSV streams of (phone, msg) on this port.")
+@click.option("--high-water", "high_water", default=100000, type=click.IntRange(min=1),
+              help="Queued alerts at which bulk ingestion pushes back on clients.")
+@click.option("--wal-dir", "wal_dir", default=None, type=click.Path(file_okay=False),
+              help="Log the queue here and recover it on restart.")
+@click.option("--codec", "codec", default="json", type=click.Choice(list(CODECS)),
+              help="Wire codec for Senders and Monitors that support it.")
+@click.option("--stats-interval", "stats_interval", default=0.1,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Min secs between two stats deltas pushed to Monitors.")
+@click.option("--metrics-port", "metrics_port", default=None, type=int,
+              help="Serve Prometheus metrics on http://localhost:PORT/metrics.")
+@click.option("--trace-dir", "trace_dir", default=None, type=click.Path(file_okay=False),
+              help="Write sampled msg lifecycle traces here.")
+@click.option("--trace-sample", "trace_sample", default=SAMPLE_RATE,
+              type=click.FloatRange(min=0, max=1),
+              help="Fraction of msgs traced.")
+@click.option("--lease-timeout", "lease_timeout", default=5.0,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Secs without a heartbeat after which a Sender is evicted.")
+@click.option("--msg-timeout", "msg_timeout", default=60.0,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Secs a Sender may hold a msg before it is requeued.")
+@click.option("--max-attempts", "max_attempts", default=3, type=click.IntRange(min=1),
+              help="Attempts at a msg before it is given up, 1 never retries.")
+@click.option("--retry-backoff", "retry_backoff", default=1.0,
+              type=click.FloatRange(min=0),
+              help="Secs before the first retry, doubling for every further one.")
+@click.option("--retry-backoff-max", "retry_backoff_max", default=60.0,
+              type=click.FloatRange(min=0),
+              help="Max secs between two attempts.")
+@click.option("--lane-policy", "lane_policy", default="strict",
+              type=click.Choice(LANE_POLICIES),
+              help="Serve the most urgent priority first, or every priority by its weight.")
+@click.option("--lane-weight", "lane_weights", multiple=True, callback=parse_lane_values,
+              help="PRIORITY=WEIGHT for the weighted policy, repeatable.")
+@click.option("--lane-deadline", "lane_deadlines", multiple=True, callback=parse_lane_values,
+              help="PRIORITY=SECS after which a queued alert jumps ahead, repeatable.")
+@click.option("--dedup-window", "dedup_window", default=None,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Drop alerts repeating a (phone, msg) pushed within this many secs.")
+@click.option("--dedup-max-entries", "dedup_max_entries", default=1000000,
+              type=click.IntRange(min=1),
+              help="Most (phone, msg) pairs remembered for --dedup-window.")
+@click.option("--coalesce-window", "coalesce_window", default=None,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Merge alerts to a phone into one queued for it within this many secs.")
+@click.option("--socket-dir", "socket_dir", default=None, type=click.Path(file_okay=False),
+              help="Also serve a Unix socket here, reach peers through theirs.")
+@click.option("--shard-port", "shard_ports", multiple=True, type=int,
+              help="Port of every Producer shard in order, this one's included, repeatable.")
+@click.option("--log-format", "log_format", default="text", type=click.Choice(LOG_FORMATS),
+              help="json logs a compact JSON object per line.")
+@click.option("--log-sample", "log_samples", multiple=True, callback=parse_event_values,
+              help="EVENT=RATE, log that fraction of the records of EVENT, repeatable.")
+@click.option("--log-limit", "log_limits", multiple=True, callback=parse_event_values,
+              help="EVENT=N, log at most N records of EVENT per sec, repeatable.")
+@click.option("--log-queue-size", "log_queue_size", default=QUEUE_SIZE,
+              type=click.IntRange(min=1),
+              help="Log records waiting to be written at most, further ones are dropped.")
+def main(port, monitor_port, msg_num, server_mode, batch_size, batch_bytes, linger,
+         scheduler, ingest_port, high_water, wal_dir, codec, stats_interval, metrics_port,
+         trace_dir, trace_sample, lease_timeout, msg_timeout, max_attempts, retry_backoff,
+         retry_backoff_max, lane_policy, lane_weights, lane_deadlines, dedup_window,
+         dedup_max_entries, coalesce_window, socket_dir, shard_ports,
+         log_format, log_samples, log_limits, log_queue_size):
     """Run Producer."""
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter(
-        f"Producer:{port} [%(levelname)s] %(message)s"
-    )
-    handler.setFormatter(formatter)
-    root_logger = logging.getLogger()
-    root_logger.addHandler(handler)
-    root_logger.setLevel(logging.INFO)
-    Producer(port, monitor_port, msg_num)
+    setup_logging(f"Producer:{port}", log_format, log_samples, log_limits, log_queue_size)
+    Producer(port, monitor_port, msg_num, server_mode, batch_size, batch_bytes, linger,
+             scheduler, ingest_port=ingest_port, high_water=high_water, wal_dir=wal_dir,
+             codec=codec, stats_interval=stats_interval, metrics_port=metrics_port,
+             trace_dir=trace_dir, trace_sample=trace_sample, lease_timeout=lease_timeout,
+             msg_timeout=msg_timeout, max_attempts=max_attempts, retry_backoff=retry_backoff,
+             retry_backoff_max=retry_backoff_max, lane_policy=lane_policy,
+             lane_weights=lane_weights, lane_deadlines=lane_deadlines,
+             dedup_window=dedup_window, dedup_max_entries=dedup_max_entries,
+             coalesce_window=coalesce_window, socket_dir=socket_dir,
+             shard_ports=list(shard_ports) or None)
+    notify("READY")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,314 @@
+import collections
+import heapq
+import itertools
+import random
+
+# weight of the newest sample in the per-sender moving averages
+EWMA_ALPHA = 0.2
+# a sender that always fails still gets a finite expected cost
+MIN_SUCCESS_RATE = 0.05
+
+
+class SenderStats:
+    """Credits, load and EWMA send_time / failure rate of a single Sender."""
+
+    __slots__ = ("port", "window", "free", "in_flight", "ewma_time", "ewma_fail")
+
+    def __init__(self, port, window):
+        self.port = port
+        self.window = window
+        self.free = window
+        self.in_flight = 0
+        # unknown senders look fast so they get probed right away
+        self.ewma_time = 0.0
+        self.ewma_fail = 0.0
+
+    def record(self, success, send_time):
+        """Fold a finished send into the moving averages."""
+        self.ewma_time += EWMA_ALPHA * (send_time - self.ewma_time)
+        self.ewma_fail += EWMA_ALPHA * ((0.0 if success else 1.0) - self.ewma_fail)
+
+    def expected_time(self):
+        """Expected secs until a new msg on this Sender is delivered successfully."""
+        success_rate = max(1.0 - self.ewma_fail, MIN_SUCCESS_RATE)
+        # the window's slots share the load of everything already in flight
+        return self.ewma_time * (self.in_flight + 1) / self.window / success_rate
+
+
+class LazyHeap:
+    """Min-heap of ports whose keys can be updated or removed in O(log n)."""
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def push(self, port, key):
+        """Insert port with key, replacing its previous key if any."""
+        self.remove(port)
+        entry = [key, next(self.counter), port, True]
+        self.entries[port] = entry
+        heapq.heappush(self.heap, entry)
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.compact()
+
+    def remove(self, port):
+        """Forget port, its stale heap entry is skipped lazily."""
+        entry = self.entries.pop(port, None)
+        if entry is not None:
+            entry[3] = False
+
+    def peek(self):
+        """Return the port with the smallest key, or None if empty."""
+        heap = self.heap
+        while heap and not heap[0][3]:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def compact(self):
+        """Drop stale entries so the heap stays proportional to live ports."""
+        self.heap = [entry for entry in self.heap if entry[3]]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Scheduler:
+    """Track Sender credits and stats, and pick the Sender for the next msg."""
+
+    name = None
+
+    def __init__(self):
+        self.stats = {}
+
+    def add_sender(self, port, credits):
+        """Register a Sender, or reset it if it registers again."""
+        self.stats[port] = SenderStats(port, credits)
+        self.update(port)
+
+    def remove_sender(self, port):
+        """Stop scheduling msgs to a Sender."""
+        self.stats.pop(port, None)
+        self.discard(port)
+
+    def release(self, port, credits=1):
+        """Give back credits of finished msgs."""
+        stats = self.stats.get(port)
+        if stats is None:
+            return
+        credits = min(credits, stats.in_flight)
+        stats.free += credits
+        stats.in_flight -= credits
+        self.update(port)
+
+    def record(self, port, success, send_time):
+        """Update the Sender's stats with a finished send."""
+        stats = self.stats.get(port)
+        if stats is not None:
+            stats.record(success, send_time)
+            self.update(port)
+
+    def acquire(self, avoid=None):
+        """Take a credit from the best Sender, return its port or None if all are busy.
+
+        Any other Sender with a free credit is preferred over avoid.
+        """
+        port = self.pick()
+        if port is None:
+            return None
+        if port == avoid:
+            port = self.pick_other(avoid)
+        stats = self.stats[port]
+        stats.free -= 1
+        stats.in_flight += 1
+        self.update(port)
+        return port
+
+    def has_capacity(self):
+        """Check whether any Sender has a free credit."""
+        return self.pick() is not None
+
+    def num_available(self):
+        """Count the Senders with a free credit."""
+        return sum(1 for stats in list(self.stats.values()) if stats.free > 0)
+
+    def pick(self):
+        """Return the port of the Sender to use next without taking its credit."""
+        raise NotImplementedError
+
+    def pick_other(self, avoid):
+        """Return the best Sender but avoid, or avoid if no other has a free credit."""
+        self.discard(avoid)
+        port = self.pick()
+        self.update(avoid)
+        return avoid if port is None else port
+
+    def update(self, port):
+        """Re-index port after its credits or stats changed."""
+        raise NotImplementedError
+
+    def discard(self, port):
+        """Drop port from the index."""
+        raise NotImplementedError
+
+
+class FifoScheduler(Scheduler):
+    """Hand credits out in the order they were given back."""
+
+    name = "fifo"
+
+    def __init__(self):
+        super().__init__()
+        self.credits = collections.deque()
+
+    def add_sender(self, port, credits):
+        self.stats[port] = SenderStats(port, credits)
+        self.credits.extend([port] * credits)
+
+    def release(self, port, credits=1):
+        stats = self.stats.get(port)
+        if stats is None:
+            return
+        credits = min(credits, stats.in_flight)
+        stats.free += credits
+        stats.in_flight -= credits
+        self.credits.extend([port] * credits)
+
+    def pick(self):
+        credits = self.credits
+        while credits:
+            stats = self.stats.get(credits[0])
+            # credits of removed or re-registered senders are skipped lazily
+            if stats is not None and stats.free > 0:
+                return credits[0]
+            credits.popleft()
+        return None
+
+    def acquire(self, avoid=None):
+        port = self.pick()
+        if port is None:
+            return None
+        if port == avoid:
+            port = self.pick_other(avoid)
+        if port == self.credits[0]:
+            self.credits.popleft()
+        else:
+            self.credits.remove(port)
+        stats = self.stats[port]
+        stats.free -= 1
+        stats.in_flight += 1
+        return port
+
+    def pick_other(self, avoid):
+        # rare enough, only retries avoid a Sender, to scan the credits
+        for port in self.credits:
+            stats = self.stats.get(port)
+            if port != avoid and stats is not None and stats.free > 0:
+                return port
+        return avoid
+
+    def update(self, port):
+        pass
+
+    def discard(self, port):
+        pass
+
+
+class HeapScheduler(Scheduler):
+    """Keep Senders with free credits in a heap ordered by key()."""
+
+    def __init__(self):
+        super().__init__()
+        self.ready = LazyHeap()
+
+    def key(self, stats):
+        """Sort key of a Sender, smaller is better."""
+        raise NotImplementedError
+
+    def pick(self):
+        return self.ready.peek()
+
+    def update(self, port):
+        stats = self.stats[port]
+        if stats.free > 0:
+            self.ready.push(port, self.key(stats))
+        else:
+            self.ready.remove(port)
+
+    def discard(self, port):
+        self.ready.remove(port)
+
+
+class LeastLoadedScheduler(HeapScheduler):
+    """Pick the Sender using the smallest share of its window."""
+
+    name = "least-loaded"
+
+    def key(self, stats):
+        return stats.in_flight / stats.window
+
+
+class FastestExpectedScheduler(HeapScheduler):
+    """Pick the Sender with the best expected completion time."""
+
+    name = "fastest"
+
+    def key(self, stats):
+        return stats.expected_time()
+
+
+class PowerOfTwoScheduler(Scheduler):
+    """Sample two Senders with free credits and pick the faster one."""
+
+    name = "p2c"
+
+    def __init__(self, rng=None):
+        super().__init__()
+        self.rng = rng or random.Random()
+        # ports with free credits, plus their index for O(1) removal
+        self.ready = []
+        self.positions = {}
+
+    def has_capacity(self):
+        return bool(self.ready)
+
+    def pick(self):
+        ready = self.ready
+        if not ready:
+            return None
+        first = ready[self.rng.randrange(len(ready))]
+        second = ready[self.rng.randrange(len(ready))]
+        if self.stats[second].expected_time() < self.stats[first].expected_time():
+            return second
+        return first
+
+    def update(self, port):
+        if self.stats[port].free > 0:
+            if port not in self.positions:
+                self.positions[port] = len(self.ready)
+                self.ready.append(port)
+        else:
+            self.discard(port)
+
+    def discard(self, port):
+        index = self.positions.pop(port, None)
+        if index is None:
+            return
+        last = self.ready.pop()
+        if last != port:
+            self.ready[index] = last
+            self.positions[last] = index
+
+
+SCHEDULERS = {
+    scheduler.name: scheduler
+    for scheduler in (
+        FifoScheduler, LeastLoadedScheduler, FastestExpectedScheduler, PowerOfTwoScheduler
+    )
+}
+
+
+def create_scheduler(name):
+    """Build the scheduler registered under name."""
+    return SCHEDULERS[name]()
@@ -1,98 +1,213 @@
 import random
-import socket
-import json
 import logging
 import time
 import threading
 import click
-import sys
-from system.utils import send_msg_tcp
+from concurrent.futures import ThreadPoolExecutor
+from system.batching import Batcher
+from system.codec import CODECS, SUPPORTED_CODECS
+from system.logs import LOG_FORMATS, QUEUE_SIZE, parse_event_values, setup_logging
+from system.metrics import Metrics, MetricsServer
+from system.sharding import owner_of, port_list
+from system.tracing import Tracer
+from system.utils import LISTEN_TIMEOUT, SERVER_MODES, ConnectionPool, create_server, notify
 
 LOGGER = logging.getLogger(__name__)
 
 class Sender:
-    def __init__(self, port, producer_port, mean_time, failure_rate):
-        """Construct a Sender instance and start listening for messages."""
+    def __init__(self, port, producer_port, mean_time, failure_rate, server_mode="thread",
+                 window=1, batch_size=1, linger=0.0, codec="json", metrics_port=None,
+                 trace_dir=None, std_time=1, heartbeat_interval=1.0, socket_dir=None):
+        """Construct a Sender instance and start listening for messages.
+
+        producer_port may list the ports of every Producer shard in order, to
+        take msgs from all of them.
+        """
         self.mean_time = mean_time
+        self.std_time = std_time
+        self.window = window
         self.failure_rate = failure_rate
         self.port = port
-        self.producer_port = producer_port
+        self.producer_ports = port_list(producer_port)
+        self.producer_port = self.producer_ports[0]
         self.shut_down = False
+        self.stopped = threading.Event()
+        # lets the Producer tell a dead Sender from a slow one, 0 never heartbeats
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat_forever)
+        self.lock = threading.Lock()
+        self.pool = ConnectionPool(codec=codec, socket_dir=socket_dir)
+        # sends run off the listener so a slow send never stalls incoming msgs,
+        # up to window of them at once
+        self.executor = ThreadPoolExecutor(max_workers=window)
+        # results are reported back to the Producer in finished_batch msgs
+        self.batcher = Batcher(self.send_results, max_items=batch_size, linger=linger)
+        self.metrics = None
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics = Metrics()
+            self.metrics_server = MetricsServer(metrics_port, self.metrics)
+            self.instrument()
+        self.tracer = None
+        # msg_id -> wall clock time a traced msg arrived, until its result is sent
+        self.traced = {}
+        if trace_dir is not None:
+            self.tracer = Tracer(trace_dir, "Sender", port)
+        self.server = create_server(
+            server_mode, port, self.dispatch, lambda: self.shut_down, self.metrics, socket_dir
+        )
         self.create_listen_thread()
         self.start_sender()
     
+    def instrument(self):
+        """Time every send and the msgs to the Producer."""
+        metrics = self.metrics
+        metrics.sampled(self, "send_msg", "sms_send_msg_seconds",
+                        "Time spent delivering a single msg.")
+        self.pool.instrument(metrics)
+        metrics.gauge("sms_window", "Msgs this Sender takes in flight at once.",
+                      lambda: self.window)
+
     def start_sender(self):
-        """Send registration msgs to Producer along with my port."""
+        """Send registration msgs to every Producer along with my port, window and codecs."""
+        for producer_port, credits in self.credits():
+            self.pool.send(producer_port, self.register_msg("register", credits))
+        if self.heartbeat_interval > 0:
+            self.heartbeat_thread.start()
+
+    def credits(self):
+        """Return (port, credits) of every Producer, the window split among them."""
+        shares, extra = divmod(self.window, len(self.producer_ports))
+        # every shard gets at least one credit, or it could never hand me a msg
+        return [(producer_port, max(1, shares + (n < extra)))
+                for n, producer_port in enumerate(self.producer_ports)]
+
+    def register_msg(self, message_type, credits):
+        """Build the msg telling the Producer who I am, how many msgs I take and how."""
         register_msg = {
-            "message_type": "register",
-            "sender_port": self.port
+            "message_type": message_type,
+            "sender_port": self.port,
+            "credits": credits,
+            "codecs": SUPPORTED_CODECS
         }
-        send_msg_tcp(self.producer_port, register_msg)
+        if self.heartbeat_interval > 0:
+            register_msg["heartbeat"] = self.heartbeat_interval
+        return register_msg
+
+    def heartbeat_forever(self):
+        """Tell every Producer I am alive every heartbeat_interval secs until shut down."""
+        # carries the registration, so a Producer that evicted me can take me back
+        heartbeats = [(producer_port, self.register_msg("heartbeat", credits))
+                      for producer_port, credits in self.credits()]
+        while not self.stopped.wait(self.heartbeat_interval):
+            for producer_port, heartbeat_msg in heartbeats:
+                try:
+                    self.pool.send(producer_port, heartbeat_msg)
+                except OSError:
+                    pass
 
     def create_listen_thread(self):
         """Create thread running for listening msgs."""
-        listen_thread = threading.Thread(target=self.listen_on_tcp)
-        listen_thread.start()
+        self.listen_thread = threading.Thread(target=self.listen_on_tcp)
+        self.listen_thread.start()
+        # do not talk to peers before they are able to talk back
+        self.server.ready.wait(LISTEN_TIMEOUT)
+        if self.metrics_server is not None:
+            metrics_thread = threading.Thread(target=self.metrics_server.serve_forever)
+            metrics_thread.start()
 
     def listen_on_tcp(self):
         """Set up TCP Socket Server to listen for msgs."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            # Bind the socket to the server
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(("localhost", self.port))
-            sock.listen()
+        self.server.serve_forever()
 
-            sock.settimeout(1)
-            while not self.shut_down:
+    def dispatch(self, msg_dict):
+        """Route a single msg to its handler."""
+        with self.lock:
+            # the Producer picks the msgs to trace, Senders follow
+            if "trace" in msg_dict and self.tracer is not None:
+                self.trace_received(msg_dict["trace"])
+            if msg_dict["message_type"] == "sendmsg" and not self.shut_down:
+                self.executor.submit(self.handle_msg_send, msg_dict)
+            elif msg_dict["message_type"] == "sendmsg_batch" and not self.shut_down:
+                for msg_id, phone, msg in msg_dict["tasks"]:
+                    self.executor.submit(self.send_msg, msg_id, phone, msg)
+            elif msg_dict["message_type"] == "shutdown":
+                self.handle_shutdown()
 
-                try:
-                    producersocket, _ = sock.accept()
-                except socket.timeout:
-                    continue
-
-                with producersocket:
-                    msg_chunks = []
-                    while not self.shut_down:
-                        try:
-                            data = producersocket.recv(4096)
-                        except socket.timeout:
-                            continue
-                        if not data:
-                            break
-                        msg_chunks.append(data)
-                # Decode list-of-byte-strings to UTF8 and parse JSON data
-                msg_bytes = b''.join(msg_chunks)
-                msg_str = msg_bytes.decode("utf-8")
-                try:
-                    msg_dict = json.loads(msg_str)
-                except json.JSONDecodeError:
-                    continue
-
-                if msg_dict["message_type"] == "sendmsg":
-                    self.handle_msg_send(msg_dict)
-                elif msg_dict["message_type"] == "shutdown":
-                    self.handle_shutdown()
+    def trace_received(self, trace):
+        """Record the trip of traced msgs from the Producer."""
+        received = time.time()
+        for msg_id in trace["ids"]:
+            self.tracer.span("wire", msg_id, trace["sent"], received)
+            self.traced[msg_id] = received
 
     def handle_msg_send(self, msg_info):
         """Handle Producer request to send msgs."""
-        wait_time = random.gauss(self.mean_time, 1)
+        self.send_msg(msg_info.get("msg_id"), msg_info["phone"], msg_info["msg"])
+
+    def send_msg(self, msg_id, phone, msg):
+        """Send a single msg and queue its result for the Producer."""
+        received = self.traced.get(msg_id) if self.traced else None
+        if received is not None:
+            started = time.time()
+        wait_time = max(0, random.gauss(self.mean_time, self.std_time))
         time.sleep(wait_time)
         success = self.send_success()
-        send_result = {
-            "message_type": "finished",
-            "sender_port": self.port,
-            "success": success,
-            "send_time": wait_time
-        }
         if success:
-            LOGGER.info("Send {%s} --> phone number: %s", msg_info["msg"], msg_info["phone"])
+            LOGGER.info("Send {%s} --> phone number: %s", msg, phone, extra={"event": "sent"})
+        if received is not None:
+            self.tracer.span("waiting", msg_id, received, started)
+            self.tracer.span("send", msg_id, started, time.time(), {"success": success})
 
         if not self.shut_down:
-            send_msg_tcp(self.producer_port, send_result)        
+            # results go back to the shard that handed the msg out
+            self.batcher.add(owner_of(msg_id, self.producer_ports), (msg_id, success, wait_time))
+            self.batcher.release()
+
+    def send_results(self, producer_port, results):
+        """Report a batch of (msg_id, success, send_time) results, returning their credits."""
+        if len(results) == 1:
+            msg_id, success, send_time = results[0]
+            send_result = {
+                "message_type": "finished",
+                "sender_port": self.port,
+                "msg_id": msg_id,
+                "success": success,
+                "send_time": send_time,
+                "credits": 1
+            }
+        else:
+            send_result = {
+                "message_type": "finished_batch",
+                "sender_port": self.port,
+                "results": results,
+                "credits": len(results)
+            }
+        if self.traced:
+            # popped, not looked up then deleted, as executor threads flush results concurrently
+            traced = [result[0] for result in results
+                      if self.traced.pop(result[0], None) is not None]
+            if traced:
+                send_result["trace"] = self.tracer.context(traced)
+        try:
+            self.pool.send(producer_port, send_result)
+        except OSError:
+            # the Producer requeues their msgs once they time out
+            LOGGER.warning("Producer %s unreachable, dropped %d results", producer_port,
+                           len(results), extra={"event": "unreachable"})
 
     def handle_shutdown(self):
         """Handle Producer request to shutdown."""
         self.shut_down = True
+        self.stopped.set()
+        self.server.stop()
+        self.executor.shutdown(wait=False)
+        self.batcher.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.tracer is not None:
+            self.tracer.close()
+        self.pool.close()
 
     def send_success(self):
         """Calculate the success rate."""
@@ -102,20 +217,51 @@ class Sender:
 
 @click.command()
 @click.option("--port", "port", default=6001)
-@click.option("--producer-port", "producer_port", default=6000)
-@click.option("--mean-time", "mean_time", default=10)
+@click.option("--producer-port", "producer_ports", default=[6000], multiple=True, type=int,
+              help="Port of every Producer shard in order, repeatable.")
+@click.option("--mean-time", "mean_time", default=10.0, type=click.FloatRange(min=0))
+@click.option("--std-time", "std_time", default=1.0, type=click.FloatRange(min=0),
+              help="Standard deviation of the simulated send time, 0 sends in exactly mean time.")
 @click.option("--failure-rate", "failure_rate", default=0.2)
-def main(port, producer_port, mean_time, failure_rate):
+@click.option("--server-mode", "server_mode", default="thread",
+              type=click.Choice(SERVER_MODES))
+@click.option("--window", "window", default=1, type=click.IntRange(min=1))
+@click.option("--batch-size", "batch_size", default=1, type=click.IntRange(min=1),
+              help="Max results reported in one msg to the Producer.")
+@click.option("--linger", "linger", default=0.0, type=click.FloatRange(min=0),
+              help="Secs a partial batch of results may wait for more.")
+@click.option("--codec", "codec", default="json", type=click.Choice(list(CODECS)),
+              help="Wire codec for results sent to the Producer.")
+@click.option("--metrics-port", "metrics_port", default=None, type=int,
+              help="Serve Prometheus metrics on http://localhost:PORT/metrics.")
+@click.option("--trace-dir", "trace_dir", default=None, type=click.Path(file_okay=False),
+              help="Write traces of the msgs the Producer samples here.")
+@click.option("--heartbeat-interval", "heartbeat_interval", default=1.0,
+              type=click.FloatRange(min=0),
+              help="Secs between heartbeats to the Producer, 0 turns them off.")
+@click.option("--socket-dir", "socket_dir", default=None, type=click.Path(file_okay=False),
+              help="Also serve a Unix socket here, reach peers through theirs.")
+@click.option("--log-format", "log_format", default="text", type=click.Choice(LOG_FORMATS),
+              help="json logs a compact JSON object per line.")
+@click.option("--log-sample", "log_samples", multiple=True, callback=parse_event_values,
+              help="EVENT=RATE, log that fraction of the records of EVENT, repeatable.")
+@click.option("--log-limit", "log_limits", multiple=True, callback=parse_event_values,
+              help="EVENT=N, log at most N records of EVENT per sec, repeatable.")
+@click.option("--log-queue-size", "log_queue_size", default=QUEUE_SIZE,
+              type=click.IntRange(min=1),
+              help="Log records waiting to be written at most, further ones are dropped.")
+def main(port, producer_ports, mean_time, failure_rate, server_mode, window, batch_size,
+         linger, codec, metrics_port, trace_dir, std_time, heartbeat_interval, socket_dir,
+         log_format, log_samples, log_limits, log_queue_size):
     """Run Sender."""
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter(
-        f"Sender:{port} [%(levelname)s] %(message)s"
-    )
-    handler.setFormatter(formatter)
-    root_logger = logging.getLogger()
-    root_logger.addHandler(handler)
-    root_logger.setLevel(logging.INFO)
-    Sender(port, producer_port, mean_time, failure_rate)
+    setup_logging(f"Sender:{port}", log_format, log_samples, log_limits, log_queue_size)
+    sender = Sender(port, list(producer_ports), mean_time, failure_rate, server_mode, window,
+                    batch_size, linger, codec, metrics_port, trace_dir, std_time,
+                    heartbeat_interval, socket_dir)
+    notify("READY")
+    # the executor refuses sends once the interpreter starts shutting down,
+    # so the main thread must not return before the Sender is shut down
+    sender.listen_thread.join()
 
 
 if __name__ == '__main__':
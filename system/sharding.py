@@ -0,0 +1,48 @@
+import zlib
+
+from system.source import synthetic_msgs
+
+
+def port_list(ports):
+    """Return ports as a list, a single port as a list of one."""
+    if isinstance(ports, int):
+        return [ports]
+    return list(ports)
+
+
+def shard_of(phone, shards):
+    """Return the index of the shard owning alerts to phone, the same in every process."""
+    if shards == 1:
+        return 0
+    return zlib.crc32(phone.encode("utf-8")) % shards
+
+
+def split_rows(rows, shards):
+    """Split (phone, msg[, priority]) rows into one list per shard."""
+    split = [[] for _ in range(shards)]
+    for row in rows:
+        split[shard_of(row[0], shards)].append(row)
+    return split
+
+
+def owner_of(msg_id, ports):
+    """Return the port of the shard that handed out msg_id, out of every shard's port in order."""
+    if msg_id is None or len(ports) == 1:
+        return ports[0]
+    return ports[msg_id % len(ports)]
+
+
+def first_id(msg_id, shard, shards):
+    """Return the lowest msg id from msg_id on that belongs to shard."""
+    return msg_id + (shard - msg_id) % shards
+
+
+def shard_msgs(msg_num, shard, shards, first=0, rng=None):
+    """Lazily yield the random msgs of shard out of msg_num, with ids shard, shard + shards, ...
+
+    Msgs with ids below first were already generated and are skipped.
+    """
+    count = len(range(shard, msg_num, shards))
+    skip = len(range(shard, min(first, msg_num), shards))
+    for n, phone, msg in synthetic_msgs(count, rng, first=skip):
+        yield shard + n * shards, phone, msg
@@ -0,0 +1,286 @@
+import heapq
+import itertools
+import random
+import time
+
+import click
+
+from system.autoscaler import Autoscaler, sender_rate
+from system.batching import Batcher
+from system.monitor.__main__ import report_lines
+from system.producer.__main__ import Producer
+from system.scheduler import SCHEDULERS
+from system.source import synthetic_msgs
+
+PRODUCER_PORT = 6000
+FIRST_SENDER_PORT = 6001
+
+
+class SenderProfile:
+    """How a simulated Sender behaves, like the flags of a real one."""
+
+    def __init__(self, mean_time, failure_rate, window=1, std_time=1.0):
+        self.mean_time = mean_time
+        self.failure_rate = failure_rate
+        self.window = window
+        self.std_time = std_time
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse "MEAN,FAILURE_RATE,WINDOW[,STD]" optionally followed by "xCOUNT".
+
+        Return the profile and how many Senders share it.
+        """
+        spec, _, count = spec.partition("x")
+        fields = spec.split(",")
+        if not 3 <= len(fields) <= 4:
+            raise ValueError("expected MEAN,FAILURE_RATE,WINDOW[,STD][xCOUNT]: " + spec)
+        profile = cls(float(fields[0]), float(fields[1]), int(fields[2]),
+                      float(fields[3]) if len(fields) == 4 else 1.0)
+        return profile, int(count) if count else 1
+
+
+class SimulatedProducer(Producer):
+    """The Producer's queue, scheduling and stats, handing msgs to a Simulation."""
+
+    def __init__(self, simulation, msg_num, scheduler="fifo", batch_size=1, rng=None,
+                 max_attempts=3, retry_backoff=1.0, retry_backoff_max=60.0,
+                 lane_policy="strict"):
+        # only the state assign_messages and the finished handlers work on, no sockets
+        self.simulation = simulation
+        # simulated Senders never die or hang
+        self.init_state(PRODUCER_PORT, msg_num, clock=simulation.clock,
+                        high_water=float("inf"), scheduler=scheduler,
+                        msg_timeout=float("inf"), max_attempts=max_attempts,
+                        retry_backoff=retry_backoff, retry_backoff_max=retry_backoff_max,
+                        lane_policy=lane_policy)
+        self.init_source(rng=rng)
+        self.port = PRODUCER_PORT
+        self.batcher = Batcher(self.send_tasks, max_items=batch_size)
+
+    def send_tasks(self, sender_port, tasks):
+        self.simulation.deliver(sender_port, tasks)
+
+    def shutdown_sender(self, sender_port):
+        self.simulation.retired(sender_port)
+
+    def schedule_retry(self, task, due):
+        # no reaper ticks here, the retry wakes the Producer itself
+        super().schedule_retry(task, due)
+        self.simulation.schedule(due - self.clock(), self.simulation.retry_due)
+
+
+class Simulation:
+    """Run the Producer's scheduling against simulated Senders on a virtual clock.
+
+    Nothing sleeps: sends are events on a heap ordered by virtual time, so
+    millions of msgs take secs. With rate set, msg_num alerts arrive as a
+    Poisson stream of rate per sec instead of being queued up front.
+    """
+
+    def __init__(self, profiles, msg_num, scheduler="fifo", batch_size=1, rate=None,
+                 latency=0.0, seed=None, max_attempts=3, retry_backoff=1.0,
+                 retry_backoff_max=60.0):
+        self.now = 0.0
+        self.rng = random.Random(seed)
+        if seed is not None:
+            # schedulers break ties with the global random
+            random.seed(seed)
+        # (time, seq, handler, arg), seq keeps events at the same time in order
+        self.events = []
+        self.seq = itertools.count()
+        self.latency = latency
+        self.rate = rate
+        self.msg_num = msg_num
+        self.profiles = dict(zip(itertools.count(FIRST_SENDER_PORT), profiles))
+        # Senders the autoscaler starts get the ports after those
+        self.ports = itertools.count(FIRST_SENDER_PORT + len(profiles))
+        self.autoscaler = None
+        self.finished_at = 0.0
+        # Senders started but not registered yet
+        self.spawning = 0
+        self.most_senders = len(profiles)
+        generated = msg_num if rate is None else 0
+        self.producer = SimulatedProducer(self, generated, scheduler, batch_size, self.rng,
+                                          max_attempts, retry_backoff, retry_backoff_max)
+        self.arrivals = None
+        if rate is not None:
+            self.arrivals = ((phone, msg) for _, phone, msg in synthetic_msgs(msg_num, self.rng))
+
+    def clock(self):
+        return self.now
+
+    def autoscale(self, autoscaler, profile, interval=1.0, spawn_delay=0.5):
+        """Have autoscaler size the fleet every interval secs, starting Senders like profile.
+
+        A started Sender registers spawn_delay secs later, as a process would.
+        """
+        self.autoscaler = autoscaler
+        self.spawn_profile = profile
+        self.autoscale_interval = interval
+        self.spawn_delay = spawn_delay
+
+    def schedule(self, delay, handler, arg=None):
+        heapq.heappush(self.events, (self.now + delay, next(self.seq), handler, arg))
+
+    def deliver(self, sender_port, tasks):
+        """Have the Sender send tasks, all at once as its window allows."""
+        profile = self.profiles[sender_port]
+        gauss, uniform = self.rng.gauss, self.rng.random
+        # a msg travels to the Sender and its result travels back
+        latency = 2 * self.latency
+        for msg_id, _, _ in tasks:
+            send_time = max(0, gauss(profile.mean_time, profile.std_time))
+            success = uniform() > profile.failure_rate
+            self.schedule(latency + send_time, self.finish,
+                          (sender_port, msg_id, success, send_time))
+
+    def finish(self, result):
+        sender_port, msg_id, success, send_time = result
+        self.producer.handle_send_finished({
+            "message_type": "finished",
+            "sender_port": sender_port,
+            "msg_id": msg_id,
+            "success": success,
+            "send_time": send_time,
+            "credits": 1
+        })
+        self.finished_at = self.now
+
+    def retry_due(self, _):
+        self.producer.assign_messages()
+
+    def register(self, port):
+        producer = self.producer
+        producer.scheduler.add_sender(port, self.profiles[port].window)
+        producer.senders.add(port)
+
+    def spawned(self, port):
+        self.spawning -= 1
+        self.profiles[port] = self.spawn_profile
+        self.most_senders = max(self.most_senders, len(self.profiles))
+        self.register(port)
+        self.producer.assign_messages()
+
+    def retired(self, port):
+        del self.profiles[port]
+
+    def busy(self):
+        """Check whether msgs are still to arrive, queued or in flight."""
+        producer = self.producer
+        return bool(producer.backlog() or producer.in_flight or self.arrivals is not None)
+
+    def scale(self, _):
+        """Start or retire Senders as the autoscaler decides, until every msg is finished."""
+        producer = self.producer
+        if not self.busy():
+            return
+        running = sorted(port for port in self.profiles if port in producer.senders)
+        rates = [sender_rate(producer.sender_histograms.get(port), self.profiles[port].window)
+                 for port in running]
+        finished = producer.status["num_sent"] + producer.status["num_fail"]
+        count = len(running) + self.spawning
+        wanted = self.autoscaler.decide(self.now, count, producer.backlog(), finished, rates)
+        if wanted > count:
+            for _ in range(wanted - count):
+                self.spawning += 1
+                self.schedule(self.spawn_delay, self.spawned, next(self.ports))
+        elif wanted < count:
+            # the newest go first
+            for port in running[::-1][:count - wanted]:
+                producer.handle_retire({"sender_port": port})
+        self.schedule(self.autoscale_interval, self.scale)
+
+    def arrive(self, _):
+        row = next(self.arrivals, None)
+        if row is None:
+            # every alert arrived
+            self.arrivals = None
+            return
+        self.producer.handle_enqueue({"phone": row[0], "msg": row[1]})
+        self.schedule(self.rng.expovariate(self.rate), self.arrive)
+
+    def run(self):
+        """Run until every msg is finished, return the Producer holding the stats."""
+        producer = self.producer
+        events = self.events
+        pop = heapq.heappop
+        with producer.lock:
+            for port in self.profiles:
+                self.register(port)
+            producer.assign_messages()
+            if self.arrivals is not None:
+                self.schedule(0.0, self.arrive)
+            if self.autoscaler is not None:
+                self.schedule(self.autoscale_interval, self.scale)
+            while events:
+                self.now, _, handler, arg = pop(events)
+                handler(arg)
+        # the last autoscaler tick may come after the last msg finished
+        self.now = self.finished_at
+        return producer
+
+
+@click.command()
+@click.option("--sender", "senders", multiple=True, required=True,
+              help="Sender profile MEAN,FAILURE_RATE,WINDOW[,STD][xCOUNT], repeatable.")
+@click.option("--msg-num", "msg_num", default=1000000, type=click.IntRange(min=1))
+@click.option("--scheduler", "schedulers", multiple=True, default=["fifo"],
+              type=click.Choice(list(SCHEDULERS)),
+              help="Policy to simulate, repeat it to compare several.")
+@click.option("--batch-size", "batch_size", default=1, type=click.IntRange(min=1))
+@click.option("--rate", "rate", default=None, type=click.FloatRange(min=0, min_open=True),
+              help="Alerts arriving per sec, all are queued at the start if not given.")
+@click.option("--latency", "latency", default=0.0, type=click.FloatRange(min=0),
+              help="One way network latency between the Producer and a Sender in secs.")
+@click.option("--seed", "seed", default=None, type=int)
+@click.option("--max-attempts", "max_attempts", default=3, type=click.IntRange(min=1),
+              help="Attempts at a msg before it is given up, 1 never retries.")
+@click.option("--retry-backoff", "retry_backoff", default=1.0, type=click.FloatRange(min=0),
+              help="Secs before the first retry, doubling for every further one.")
+@click.option("--autoscale", "autoscale", default=None,
+              help="MIN,MAX Senders to scale the fleet between, started like the first profile.")
+@click.option("--autoscale-target", "autoscale_target", default=10.0,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Secs the autoscaled fleet should take to drain the backlog.")
+def main(senders, msg_num, schedulers, batch_size, rate, latency, seed, max_attempts,
+         retry_backoff, autoscale, autoscale_target):
+    """Simulate a Sender fleet working through msg-num alerts and report what a Monitor would."""
+    try:
+        profiles = []
+        for spec in senders:
+            profile, count = SenderProfile.parse(spec)
+            profiles.extend([profile] * count)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--sender")
+    bounds = None
+    if autoscale is not None:
+        try:
+            bounds = [int(bound) for bound in autoscale.split(",")]
+            Autoscaler(*bounds)
+        except (TypeError, ValueError):
+            raise click.BadParameter("expected MIN,MAX with 0 <= MIN <= MAX: " + autoscale,
+                                     param_hint="--autoscale")
+    for scheduler in schedulers:
+        start = time.perf_counter()
+        simulation = Simulation(profiles, msg_num, scheduler, batch_size, rate, latency,
+                                seed, max_attempts, retry_backoff)
+        if bounds is not None:
+            simulation.autoscale(Autoscaler(*bounds, target=autoscale_target), profiles[0])
+        producer = simulation.run()
+        elapsed = time.perf_counter() - start
+        virtual = producer.clock()
+        click.echo("{}: {} msgs over {} Senders in {:.1f} virtual secs "
+                   "({:.1f} msgs/sec), simulated in {:.1f}s".format(
+                       scheduler, msg_num,
+                       len(profiles) if bounds is None else "up to {}".format(
+                           simulation.most_senders),
+                       virtual,
+                       msg_num / virtual if virtual else float("inf"), elapsed))
+        for line in report_lines(producer.status, producer.histograms,
+                                 producer.sender_histograms, producer.retries):
+            click.echo(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import collections
+import heapq
+import itertools
+import random
+
+PHONE_LEN = 9
+MAX_MSG_LEN = 100
+# msgs are generated this many at a time from one bulk draw of random bytes
+CHUNK_SIZE = 1024
+# how msgs fared: delivered on the first attempt, delivered after retries, failed every attempt
+RETRY_COUNTERS = ("first_try", "retried", "exhausted")
+# priority classes of pushed alerts, most urgent first, each queued in a lane of its own
+PRIORITIES = ("critical", "normal", "bulk")
+LANE_INDEX = {priority: lane for lane, priority in enumerate(PRIORITIES)}
+DEFAULT_LANE = LANE_INDEX["normal"]
+BULK_LANE = LANE_INDEX["bulk"]
+LANE_POLICIES = ("strict", "weighted")
+DEFAULT_WEIGHTS = {"critical": 8, "normal": 4, "bulk": 1}
+
+
+def symbol_table(symbols):
+    """Build a translate table mapping random bytes uniformly onto symbols."""
+    usable = 256 - 256 % len(symbols)
+    table = bytes(symbols[b % len(symbols)] for b in range(256))
+    # bytes past the last full cycle of symbols would bias the draw
+    return table, bytes(range(usable, 256))
+
+
+DIGITS = symbol_table(b"0123456789")
+LETTERS = symbol_table(b"abcdefghijklmnopqrstuvwxyz")
+LENGTHS = symbol_table(bytes(range(1, MAX_MSG_LEN + 1)))
+
+
+def random_symbols(rng, n, symbols):
+    """Return n random bytes drawn uniformly from symbols."""
+    table, rejected = symbols
+    out = b''
+    while len(out) < n:
+        # oversample a little so rejected bytes rarely need a second draw
+        size = (n - len(out)) * 5 // 4 + 16
+        raw = rng.getrandbits(8 * size).to_bytes(size, 'little')
+        out += raw.translate(table, rejected)
+    return out[:n]
+
+
+def synthetic_msgs(msg_num, rng=None, chunk_size=CHUNK_SIZE, first=0):
+    """Lazily yield random (msg_id, phone, msg) tuples with msg ids first..msg_num-1."""
+    rng = rng or random.Random()
+    for start in range(first, msg_num, chunk_size):
+        count = min(chunk_size, msg_num - start)
+        lengths = random_symbols(rng, count, LENGTHS)
+        phones = random_symbols(rng, count * PHONE_LEN, DIGITS).decode('ascii')
+        letters = random_symbols(rng, sum(lengths), LETTERS).decode('ascii')
+        offset = 0
+        for i, length in enumerate(lengths):
+            phone = phones[i * PHONE_LEN:(i + 1) * PHONE_LEN]
+            yield start + i, phone, letters[offset:offset + length]
+            offset += length
+
+
+class MessageSource:
+    """Where the Producer pulls the next msg to send from."""
+
+    def next_msg(self):
+        """Return the next (msg_id, phone, msg) tuple, or None if there is none yet."""
+        raise NotImplementedError
+
+
+class IterSource(MessageSource):
+    """Pull msgs on demand from any iterable, so only in-flight msgs live in memory."""
+
+    def __init__(self, msgs):
+        self.msgs = iter(msgs)
+
+    def next_msg(self):
+        return next(self.msgs, None)
+
+
+class LaneQueue(MessageSource):
+    """Queue msgs in one FIFO lane per priority and pick the lane to serve next.
+
+    strict always serves the most urgent lane holding msgs, weighted serves the
+    lanes holding msgs in proportion to their weights (smooth weighted round
+    robin) so bulk never starves. A lane with a deadline is served first once
+    its head waited that long. Lanes are FIFO and share a deadline, so only
+    their heads are ever looked at and every pick is O(lanes).
+    """
+
+    def __init__(self, policy="strict", weights=None, deadlines=None):
+        if policy not in LANE_POLICIES:
+            raise ValueError("unknown lane policy: " + policy)
+        self.weighted = policy == "weighted"
+        # (enqueued, msg) pairs per lane, in PRIORITIES order
+        self.lanes = [collections.deque() for _ in PRIORITIES]
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.weights = [weights[priority] for priority in PRIORITIES]
+        self.current = [0] * len(PRIORITIES)
+        deadlines = deadlines or {}
+        self.deadlines = [(lane, deadlines[priority]) for lane, priority in enumerate(PRIORITIES)
+                          if deadlines.get(priority) is not None]
+        self.size = 0
+
+    def put(self, msg, lane=DEFAULT_LANE, enqueued=0.0):
+        """Queue a (msg_id, phone, msg) tuple enqueued at time enqueued at the tail of lane."""
+        self.lanes[lane].append((enqueued, msg))
+        self.size += 1
+
+    def requeue(self, entries):
+        """Put (lane, enqueued, msg) entries back at the head of their lanes, in order."""
+        lanes = self.lanes
+        for lane, enqueued, msg in reversed(entries):
+            lanes[lane].appendleft((enqueued, msg))
+        self.size += len(entries)
+
+    def pop(self, now=None):
+        """Return (lane, enqueued, msg) to serve next at time now, None if all lanes are empty."""
+        if not self.size:
+            return None
+        lane = None
+        if self.deadlines and now is not None:
+            lane = self.overdue(now)
+        if lane is None:
+            lane = self.pick()
+        enqueued, msg = self.lanes[lane].popleft()
+        self.size -= 1
+        return lane, enqueued, msg
+
+    def overdue(self, now):
+        """Return the lane whose head is furthest past its deadline, None if none is."""
+        best, best_due = None, now
+        for lane, deadline in self.deadlines:
+            queue = self.lanes[lane]
+            if queue:
+                due = queue[0][0] + deadline
+                if due <= best_due and (best is None or due < best_due):
+                    best, best_due = lane, due
+        return best
+
+    def pick(self):
+        """Return the lane to serve next by policy. Caller made sure one holds msgs."""
+        lanes = self.lanes
+        if not self.weighted:
+            for lane, queue in enumerate(lanes):
+                if queue:
+                    return lane
+        current, weights = self.current, self.weights
+        best, total = None, 0
+        for lane, queue in enumerate(lanes):
+            if not queue:
+                # an idle lane does not save up turns for later
+                current[lane] = 0
+                continue
+            current[lane] += weights[lane]
+            total += weights[lane]
+            if best is None or current[lane] > current[best]:
+                best = lane
+        current[best] -= total
+        return best
+
+    def next_msg(self):
+        entry = self.pop()
+        return None if entry is None else entry[2]
+
+    def depth(self, lane):
+        """Return the number of msgs queued in lane."""
+        return len(self.lanes[lane])
+
+    def __len__(self):
+        return self.size
+
+
+class RetryQueue:
+    """Hold msgs until their retry time, then hand them out earliest first.
+
+    A heap keeps scheduling and taking a retry O(log n) however many wait,
+    nothing is scanned while they are not due.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        # (due, seq, msg), seq keeps msgs due at the same time in order
+        self.heap = []
+        self.counter = itertools.count()
+
+    def put(self, msg, due):
+        """Hold msg until clock() reaches due."""
+        heapq.heappush(self.heap, (due, next(self.counter), msg))
+
+    def next_due(self):
+        """Return when the earliest msg is due, None if none is held."""
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self):
+        """Return the earliest msg if it is due, else None."""
+        heap = self.heap
+        if heap and heap[0][0] <= self.clock():
+            return heapq.heappop(heap)[2]
+        return None
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,470 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import click
+
+from system.autoscaler import Autoscaler, sender_rate
+from system.logs import setup_logging
+from system.monitor.__main__ import Monitor
+from system.utils import NOTIFY_FD, send_msg_tcp
+
+LOGGER = logging.getLogger(__name__)
+
+COMPONENTS = {
+    "monitor": "system.monitor.__main__",
+    "producer": "system.producer.__main__",
+    "sender": "system.sender.__main__",
+}
+# the fleet bin/system used to start, a config file replaces it section by section
+DEFAULT_CONFIG = {
+    "socket_dir": "/tmp/sms-alert-system",
+    "monitor": {"port": 5999, "N": 15, "codec": "binary"},
+    "producer": {"port": 6000, "msg_num": 50, "scheduler": "fastest", "codec": "binary"},
+    "senders": [
+        {"port": 6001, "mean_time": 3, "failure_rate": 0.2, "window": 4, "codec": "binary"},
+        {"port": 6004, "mean_time": 10, "failure_rate": 0.1, "window": 8, "codec": "binary"},
+        {"port": 6003, "mean_time": 15, "failure_rate": 0.3, "window": 8, "codec": "binary"},
+    ],
+    # a fixed fleet unless given, see AUTOSCALE_DEFAULTS
+    "autoscale": None,
+}
+# the Senders the autoscaler starts are like the first configured one unless "sender" is given
+AUTOSCALE_DEFAULTS = {
+    "min": 1,
+    "max": 10,
+    # secs the fleet should take to drain the backlog
+    "target": 10.0,
+    # secs between decisions
+    "interval": 1.0,
+    # the fleet only shrinks to the most Senders wanted within this many secs
+    "scale_down_delay": 30.0,
+    # Senders it starts take free ports from here on
+    "first_port": 6100,
+    # the supervisor subscribes to the Producer's stats on this port
+    "stats_port": 5998,
+    "sender": None,
+}
+# a component crashing more often than this within RESTART_PERIOD secs is given up
+MAX_RESTARTS = 5
+RESTART_PERIOD = 60.0
+# what the watcher of a child reports once it exited
+EXIT = "EXIT"
+# secs the supervisor sleeps at most before looking at due restarts and stop requests
+TICK = 0.1
+
+
+def load_config(path=None):
+    """Read a fleet config from a JSON file over the default fleet."""
+    config = dict(DEFAULT_CONFIG)
+    if path is None:
+        return config
+    with open(path) as config_file:
+        loaded = json.load(config_file)
+    for key in loaded:
+        if key not in DEFAULT_CONFIG:
+            raise ValueError("unknown config section: " + key)
+    config.update(loaded)
+    for entry in config["senders"]:
+        if "port" not in entry:
+            raise ValueError("every Sender needs a port")
+    if config["producer"].get("shards", 1) < 1:
+        raise ValueError("a fleet needs at least one Producer shard")
+    if config["autoscale"] is not None:
+        if config["producer"].get("shards", 1) > 1:
+            raise ValueError("autoscaling takes a single Producer, not shards")
+        for key in config["autoscale"]:
+            if key not in AUTOSCALE_DEFAULTS:
+                raise ValueError("unknown autoscale setting: " + key)
+        config["autoscale"] = dict(AUTOSCALE_DEFAULTS, **config["autoscale"])
+    return config
+
+
+def option_args(options):
+    """Turn a config section into command line flags, msg_num into --msg-num."""
+    args = []
+    for key, value in options.items():
+        flag = "--" + key.replace("_", "-")
+        # repeatable flags such as --lane-weight are given as lists
+        for item in value if isinstance(value, list) else [value]:
+            args += [flag, str(item)]
+    return args
+
+
+def build_children(config):
+    """Return the Monitor, the Producer shards and the Senders a config describes."""
+    socket_dir = config.get("socket_dir")
+    common = {} if socket_dir is None else {"socket_dir": socket_dir}
+    monitor = dict(config["monitor"])
+    producer = dict(config["producer"])
+    monitor_port = monitor.setdefault("port", 5999)
+    first_port = producer.pop("port", 6000)
+    # shards take consecutive ports, the Monitor and every Sender talk to all of them
+    producer_ports = list(range(first_port, first_port + producer.pop("shards", 1)))
+    monitor = Child("monitor", monitor_port,
+                    option_args(dict(monitor, producer_port=producer_ports, **common)))
+    producers = []
+    for port in producer_ports:
+        options = dict({"port": port}, **producer, monitor_port=monitor_port, **common)
+        if len(producer_ports) > 1:
+            options["shard_port"] = producer_ports
+        producers.append(Child("producer", port, option_args(options)))
+    senders = []
+    for entry in config["senders"]:
+        entry = dict(entry, producer_port=producer_ports, **common)
+        first_port = entry.pop("port")
+        # count Senders alike on consecutive ports
+        for port in range(first_port, first_port + entry.pop("count", 1)):
+            senders.append(sender_child(entry, port))
+    return monitor, producers, senders
+
+
+def sender_child(options, port):
+    """Return the Sender on port run with options, which include its producer_port."""
+    return Child("sender", port, option_args(dict(options, port=port)), options.get("window", 1))
+
+
+class Child:
+    """A component process the supervisor runs, restarted in place when it crashes."""
+
+    def __init__(self, kind, port, args, window=1):
+        self.kind = kind
+        self.port = port
+        self.args = args
+        self.window = window
+        # retired by the autoscaler, gone for good once it exits
+        self.retiring = False
+        self.name = "{}:{}".format(kind.capitalize(), port)
+        self.process = None
+        self.watcher = None
+        self.started = None
+        # secs from starting the process to its READY notification
+        self.ready = None
+        # when it was restarted within the last RESTART_PERIOD secs
+        self.restarts = collections.deque()
+
+    def start(self, events):
+        """Start the process, its notifications and exit go to events."""
+        read_fd, write_fd = os.pipe()
+        command = [sys.executable, "-c", "from {} import main; main()".format(COMPONENTS[self.kind])]
+        env = dict(os.environ)
+        env[NOTIFY_FD] = str(write_fd)
+        try:
+            # a new session keeps a Ctrl-C on the terminal for the supervisor alone
+            self.process = subprocess.Popen(command + self.args, env=env, pass_fds=(write_fd,),
+                                            start_new_session=True)
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        self.started = time.monotonic()
+        self.ready = None
+        self.watcher = threading.Thread(target=self.watch, args=(self.process, read_fd, events))
+        self.watcher.start()
+
+    def watch(self, process, read_fd, events):
+        """Relay every notification of process as (child, process, state, time), then its exit."""
+        # only the process holds the write end, so the pipe ends when it does
+        with os.fdopen(read_fd) as pipe:
+            for line in pipe:
+                events.put((self, process, line.strip(), time.monotonic()))
+        process.wait()
+        events.put((self, process, EXIT, time.monotonic()))
+
+    def alive(self):
+        """Return True while the process runs."""
+        return self.process is not None and self.process.poll() is None
+
+
+class Supervisor:
+    """Start a fleet on readiness signals, restart what crashes and stop it in bounded time."""
+
+    def __init__(self, config, ready_timeout=10.0, stop_timeout=5.0, restart_backoff=0.5,
+                 max_restarts=MAX_RESTARTS):
+        self.monitor, self.producers, self.senders = build_children(config)
+        # the shard the fleet is stopped through, the others pass it on
+        self.producer = self.producers[0]
+        self.children = [self.monitor] + self.producers + self.senders
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+        self.restart_backoff = restart_backoff
+        self.max_restarts = max_restarts
+        self.events = queue.Queue()
+        # (due time, child) of crashed children waiting out their backoff
+        self.restart_due = []
+        self.stopping = False
+        self.started = None
+        # secs from the start of the fleet to the first msg the Producer dispatched
+        self.dispatched = None
+        self.socket_dir = config.get("socket_dir")
+        self.stats_codec = config["monitor"].get("codec", "json")
+        self.autoscale = config.get("autoscale")
+        self.autoscaler = None
+        # the Producer's stats the autoscaler decides on, kept by a Monitor of our own
+        self.stats = None
+        self.next_scale = None
+        if self.autoscale is not None:
+            self.autoscaler = Autoscaler(self.autoscale["min"], self.autoscale["max"],
+                                         self.autoscale["target"],
+                                         self.autoscale["scale_down_delay"])
+            options = self.autoscale["sender"]
+            if options is None:
+                options = config["senders"][0] if config["senders"] else {}
+            self.sender_options = dict(options, producer_port=self.producer.port)
+            self.sender_options.pop("port", None)
+            self.sender_options.pop("count", None)
+            if self.socket_dir is not None:
+                self.sender_options["socket_dir"] = self.socket_dir
+
+    def start(self):
+        """Start the Monitor, the Producers once it is ready, then every Sender at once.
+
+        Return the secs until the whole fleet was ready.
+        """
+        self.started = time.monotonic()
+        for stage in ([self.monitor], self.producers, self.senders):
+            for child in stage:
+                child.start(self.events)
+            self.wait_ready(stage)
+        if self.autoscaler is not None:
+            self.stats = Monitor(self.autoscale["stats_port"], self.producer.port, None,
+                                 codec=self.stats_codec, socket_dir=self.socket_dir)
+            self.next_scale = time.monotonic() + self.autoscale["interval"]
+        elapsed = time.monotonic() - self.started
+        LOGGER.info("Fleet of %d ready in %.1f ms (%s)", len(self.children), elapsed * 1000,
+                    ", ".join("{} {:.1f}".format(child.name, child.ready * 1000)
+                              for child in self.children))
+        return elapsed
+
+    def wait_ready(self, children):
+        """Handle events until every one of children is ready."""
+        deadline = time.monotonic() + self.ready_timeout
+        while any(child.ready is None for child in children):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                pending = [child.name for child in children if child.ready is None]
+                raise TimeoutError("not ready after {}s: {}".format(
+                    self.ready_timeout, ", ".join(pending)))
+            try:
+                child, process, state, at = self.events.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if state == EXIT and child in children and process is child.process:
+                raise RuntimeError("{} exited with {} while starting".format(
+                    child.name, process.returncode))
+            self.handle(child, process, state, at)
+
+    def wait_dispatched(self, timeout):
+        """Handle events until the Producer dispatched its first msg, return the secs it took."""
+        deadline = time.monotonic() + timeout
+        while self.dispatched is None and time.monotonic() < deadline:
+            try:
+                self.handle(*self.events.get(timeout=TICK))
+            except queue.Empty:
+                pass
+        return self.dispatched
+
+    def handle(self, child, process, state, at):
+        """Act on a notification or the exit of a child."""
+        if process is not child.process:
+            # from an incarnation since replaced
+            return
+        if state == "READY":
+            child.ready = at - child.started
+            if child is self.producer and self.stats is not None:
+                self.resubscribe()
+        elif state == "DISPATCHED":
+            if self.dispatched is None:
+                self.dispatched = at - self.started
+                LOGGER.info("Cold start to first dispatched msg: %.1f ms", self.dispatched * 1000)
+        elif state == EXIT:
+            self.exited(child, process.returncode, at)
+
+    def exited(self, child, returncode, at):
+        """Schedule a crashed child for a restart after a backoff, unless it crashes too often."""
+        if self.stopping:
+            return
+        if child.retiring:
+            LOGGER.info("%s retired", child.name)
+            self.senders.remove(child)
+            self.children.remove(child)
+            return
+        if returncode == 0:
+            if child in self.producers:
+                # the Producer only exits cleanly once told to shut the fleet down
+                LOGGER.info("Producer shut down, stopping the fleet")
+                self.stopping = True
+            return
+        restarts = child.restarts
+        while restarts and restarts[0] <= at - RESTART_PERIOD:
+            restarts.popleft()
+        if len(restarts) >= self.max_restarts:
+            LOGGER.error("%s exited with %s, restarted %d times in %gs, giving up",
+                         child.name, returncode, len(restarts), RESTART_PERIOD)
+            return
+        delay = self.restart_backoff * 2 ** len(restarts)
+        LOGGER.warning("%s exited with %s, restarting in %.1fs", child.name, returncode, delay)
+        restarts.append(at)
+        self.restart_due.append((at + delay, child))
+
+    def restart_children(self):
+        """Restart the crashed children whose backoff is over."""
+        now = time.monotonic()
+        due = [entry for entry in self.restart_due if entry[0] <= now]
+        for entry in due:
+            self.restart_due.remove(entry)
+            entry[1].start(self.events)
+
+    def run(self):
+        """Supervise the fleet until asked to stop, then stop it."""
+        while not self.stopping:
+            try:
+                self.handle(*self.events.get(timeout=TICK))
+            except queue.Empty:
+                pass
+            self.restart_children()
+            if self.autoscaler is not None and time.monotonic() >= self.next_scale:
+                self.scale()
+        self.stop()
+
+    def scale(self):
+        """Start or retire Senders to reach the count the autoscaler decides on."""
+        now = time.monotonic()
+        self.next_scale = now + self.autoscale["interval"]
+        stats = self.stats
+        # crashed Senders waiting for their restart count as running
+        running = [child for child in self.senders if not child.retiring]
+        with stats.lock:
+            finished = stats.status["num_sent"] + stats.status["num_fail"]
+            rates = [sender_rate(stats.sender_histograms.get(child.port), child.window)
+                     for child in running]
+            backlog = stats.backlog
+        wanted = self.autoscaler.decide(now, len(running), backlog, finished, rates)
+        if wanted > len(running):
+            LOGGER.info("Scaling up to %d Senders, %d msgs waiting", wanted, backlog)
+            used = {child.port for child in self.children}
+            ports = (port for port in itertools.count(self.autoscale["first_port"])
+                     if port not in used)
+            for port in itertools.islice(ports, wanted - len(running)):
+                child = sender_child(self.sender_options, port)
+                self.senders.append(child)
+                self.children.append(child)
+                child.start(self.events)
+        elif wanted < len(running):
+            LOGGER.info("Scaling down to %d Senders, %d msgs waiting", wanted, backlog)
+            # the newest go first, those still starting are left alone
+            ready = [child for child in running if child.ready is not None and child.alive()]
+            for child in ready[::-1][:len(running) - wanted]:
+                self.retire(child)
+
+    def retire(self, child):
+        """Have the Producer drain a Sender and shut it down."""
+        try:
+            send_msg_tcp(self.producer.port, {"message_type": "retire", "sender_port": child.port})
+        except OSError:
+            LOGGER.warning("Producer unreachable, %s not retired", child.name)
+            return
+        child.retiring = True
+
+    def resubscribe(self):
+        """Subscribe to the stats of a restarted Producer."""
+        with self.stats.lock:
+            self.stats.subscribe()
+
+    def request_stop(self, *_):
+        """Have run stop the fleet, safe to call from a signal handler."""
+        self.stopping = True
+
+    def stop(self):
+        """Shut the fleet down through the Producer, kill what is left after stop_timeout secs."""
+        self.stopping = True
+        self.restart_due = []
+        alive = [child for child in self.children if child.alive()]
+        shutdown_msg = {"message_type": "shutdown"}
+        try:
+            send_msg_tcp(self.producer.port, shutdown_msg)
+        except OSError:
+            # no Producer to pass it on, tell everyone ourselves
+            for child in alive:
+                try:
+                    send_msg_tcp(child.port, shutdown_msg)
+                except OSError:
+                    pass
+        deadline = time.monotonic() + self.stop_timeout
+        for child in alive:
+            try:
+                child.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                LOGGER.warning("%s did not stop in %gs, killing it", child.name,
+                               self.stop_timeout)
+                child.process.kill()
+                child.process.wait()
+        for child in self.children:
+            if child.watcher is not None:
+                child.watcher.join()
+        if self.stats is not None:
+            with self.stats.lock:
+                self.stats.handle_shutdown()
+
+
+@click.group()
+def main():
+    """Run an SMS Alert System fleet under supervision."""
+    setup_logging("Supervisor")
+
+
+def read_config(config_path):
+    try:
+        return load_config(config_path)
+    except (OSError, ValueError) as error:
+        raise click.ClickException(str(error))
+
+
+@main.command()
+@click.option("--config", "config_path", default=None, type=click.Path(dir_okay=False),
+              help="JSON fleet config, the fleet bin/system used to start if not given.")
+@click.option("--ready-timeout", "ready_timeout", default=10.0,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Secs a component may take to become ready.")
+@click.option("--stop-timeout", "stop_timeout", default=5.0, type=click.FloatRange(min=0),
+              help="Secs the fleet may take to shut down before it is killed.")
+def start(config_path, ready_timeout, stop_timeout):
+    """Start the fleet and supervise it until stopped."""
+    try:
+        supervisor = Supervisor(read_config(config_path), ready_timeout, stop_timeout)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    signal.signal(signal.SIGINT, supervisor.request_stop)
+    signal.signal(signal.SIGTERM, supervisor.request_stop)
+    try:
+        supervisor.start()
+    except (RuntimeError, TimeoutError) as error:
+        supervisor.stop()
+        raise click.ClickException(str(error))
+    supervisor.run()
+
+
+@main.command()
+@click.option("--config", "config_path", default=None, type=click.Path(dir_okay=False),
+              help="JSON fleet config the fleet was started with.")
+def stop(config_path):
+    """Ask a running fleet to shut down, its supervisor exits once it did."""
+    # shutting one shard down stops the fleet, the first is the one supervised
+    port = build_children(read_config(config_path))[1][0].port
+    try:
+        send_msg_tcp(port, {"message_type": "shutdown"})
+    except OSError:
+        raise click.ClickException("no Producer listening on port {}".format(port))
+
+
+if __name__ == '__main__':
+    main()
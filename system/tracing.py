@@ -0,0 +1,166 @@
+import collections
+import glob
+import json
+import os
+import random
+import threading
+import time
+
+import click
+
+SAMPLE_RATE = 0.01
+MAX_BYTES = 64 * 1024 * 1024
+BACKUPS = 3
+FLUSH_INTERVAL = 1.0
+
+
+class TraceFile:
+    """Chrome trace (JSON array) file, rotated once it grows past max_bytes.
+
+    The viewers accept an array without its closing bracket, so a file cut short
+    by a crash still opens. Every file repeats the header events, so a rotated
+    file opens on its own too.
+    """
+
+    def __init__(self, path, header, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.path = path
+        self.header = header
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = self.header_size = 0
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, "w", encoding="utf-8")
+        text = "[\n" + ",\n".join(json.dumps(event) for event in self.header)
+        self.file.write(text)
+        self.size = self.header_size = len(text)
+
+    def write(self, events):
+        """Append already built events, rotating first if they would not fit."""
+        text = "".join(",\n" + json.dumps(event) for event in events)
+        if self.size > self.header_size and self.size + len(text) > self.max_bytes:
+            self.rotate()
+        self.file.write(text)
+        self.size += len(text)
+
+    def rotate(self):
+        """Shift path to path.1, path.1 to path.2 and so on, dropping the oldest."""
+        self.close()
+        for number in range(self.backups - 1, 0, -1):
+            older = "{}.{}".format(self.path, number)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.path, number + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        self.open()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.write("\n]\n")
+        self.file.close()
+
+
+class Tracer:
+    """Buffer msg lifecycle spans of one process and write them out in the background.
+
+    Spans are keyed by msg_id, which doubles as the trace's thread id, so every
+    traced msg gets a row of its own under each process it went through. Timestamps
+    are wall clock, so the spans of processes on one host line up when merged.
+    """
+
+    def __init__(self, trace_dir, name, port, sample_rate=SAMPLE_RATE, max_bytes=MAX_BYTES,
+                 backups=BACKUPS, flush_interval=FLUSH_INTERVAL):
+        self.sample_rate = sample_rate
+        self.pid = port
+        # monotonic times recorded before tracing picked the msg, in wall clock
+        self.offset = time.time() - time.monotonic()
+        os.makedirs(trace_dir, exist_ok=True)
+        header = [{"name": "process_name", "ph": "M", "pid": port,
+                   "args": {"name": "{}:{}".format(name, port)}}]
+        self.file = TraceFile(os.path.join(trace_dir, "{}-{}.json".format(name.lower(), port)),
+                              header, max_bytes, backups)
+        self.flush_interval = flush_interval
+        # (name, msg_id, start, end, args) tuples, turned into events by the writer
+        self.buffer = collections.deque()
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self.write_forever)
+        self.writer.start()
+
+    def sample(self):
+        """Return True if the next msg should be traced."""
+        return random.random() < self.sample_rate
+
+    def wall(self, monotonic):
+        """Return monotonic time in wall clock secs."""
+        return monotonic + self.offset
+
+    def span(self, name, msg_id, start, end, args=None):
+        """Record that msg_id spent start to end (wall clock secs) in stage name."""
+        self.buffer.append((name, msg_id, start, end, args))
+
+    def context(self, msg_ids):
+        """Return the trace context propagated in the msg carrying msg_ids."""
+        return {"ids": msg_ids, "sent": time.time()}
+
+    def events(self, spans):
+        pid = self.pid
+        for name, msg_id, start, end, args in spans:
+            event = {"name": name, "cat": "msg", "ph": "X", "pid": pid, "tid": msg_id,
+                     "ts": round(start * 1e6), "dur": max(0, round((end - start) * 1e6))}
+            event["args"] = {"msg_id": msg_id}
+            if args:
+                event["args"].update(args)
+            yield event
+
+    def write(self):
+        """Write out the spans buffered so far."""
+        # popping is thread safe, spans recorded meanwhile wait for the next write
+        buffer = self.buffer
+        spans = [buffer.popleft() for _ in range(len(buffer))]
+        if spans:
+            self.file.write(list(self.events(spans)))
+            self.file.flush()
+
+    def write_forever(self):
+        while not self.closed.wait(self.flush_interval):
+            self.write()
+
+    def close(self):
+        """Write out every buffered span and close the file."""
+        self.closed.set()
+        self.writer.join()
+        self.write()
+        self.file.close()
+
+
+def load_events(path):
+    """Return the events of a trace file, closed or cut short."""
+    with open(path, encoding="utf-8") as trace_file:
+        text = trace_file.read().rstrip()
+    if not text.endswith("]"):
+        text = text.rstrip(",") + "]"
+    return json.loads(text)
+
+
+@click.command()
+@click.argument("trace_dir", type=click.Path(exists=True, file_okay=False))
+@click.option("--output", "output", default="trace.json", type=click.Path(dir_okay=False),
+              help="Merged trace file to open in chrome://tracing or Perfetto.")
+def main(trace_dir, output):
+    """Merge the trace files of every component into one."""
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, "*.json*"))):
+        if os.path.abspath(path) != os.path.abspath(output):
+            events.extend(load_events(path))
+    with open(output, "w", encoding="utf-8") as trace_file:
+        json.dump(events, trace_file)
+    click.echo("Wrote {} events to {}".format(len(events), output))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,418 @@
+import asyncio
+import logging
+import os
 import socket
-import json
+import threading
+
+from system.codec import CODECS, FrameDecoder, encode_msg
+
+LOGGER = logging.getLogger(__name__)
+
+RECV_SIZE = 4096
+SERVER_MODES = ("thread", "asyncio")
+# a supervisor passes the write end of a pipe in this env var to hear when we are ready
+NOTIFY_FD = "SMS_NOTIFY_FD"
+
+
+def socket_path(socket_dir, port):
+    """Return the Unix socket a component listening on port also serves in socket_dir."""
+    return os.path.join(socket_dir, "{}.sock".format(port))
+
+
+def listen_unix(path):
+    """Return a Unix socket listening at path, replacing whatever a dead process left there."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen()
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def remove_socket(path):
+    """Remove the Unix socket at path if it is still there."""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def notify(state):
+    """Tell the supervisor that started us we reached state, if one did."""
+    fd = os.environ.get(NOTIFY_FD)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), (state + "\n").encode())
+    except (OSError, ValueError):
+        pass
+
 
 def send_msg_tcp(port, msg_dict):
-    """Set up TCP Socket Client and send msgs."""
+    """Set up a one-shot TCP Socket Client and send a single msg."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         # connect to the server
         sock.connect(("localhost", port))
         # send a message
-        message = json.dumps(msg_dict)
-        sock.sendall(message.encode('utf-8'))
+        sock.sendall(encode_msg(msg_dict))
+
+
+class ConnectionPool:
+    """Keep one long-lived connection per peer port and reuse it for every msg.
+
+    With socket_dir, peers serving a Unix socket there are reached through it
+    instead of the loopback TCP stack, any other peer over TCP.
+    """
+
+    def __init__(self, host="localhost", codec="json", socket_dir=None):
+        self.host = host
+        self.socket_dir = socket_dir
+        self.codec = CODECS[codec]
+        # codecs negotiated with single peers, overriding self.codec
+        self.codecs = {}
+        self.conns = {}
+        # only counted once instrumented, broken connections are rare
+        self.reconnects = None
+        self.port_locks = {}
+        self.lock = threading.Lock()
+
+    def send(self, port, msg_dict, frames=None):
+        """Send a msg to port, transparently reconnecting if the connection went away.
+
+        frames caches the msg encoded per codec, to share it between several sends.
+        """
+        with self.get_port_lock(port):
+            codec = self.codecs.get(port, self.codec)
+            if frames is None:
+                data = codec.encode(msg_dict)
+            else:
+                data = frames.get(codec.name)
+                if data is None:
+                    data = frames[codec.name] = codec.encode(msg_dict)
+            sock = self.conns.get(port)
+            if sock is not None and not self.is_stale(sock):
+                try:
+                    sock.sendall(data)
+                    return
+                except OSError:
+                    pass
+            if sock is not None and self.reconnects is not None:
+                self.reconnects.inc()
+            self.discard(port)
+            sock = self.connect(port)
+            sock.sendall(codec.preamble + data)
+
+    def broadcast(self, ports, msg_dict):
+        """Send one msg to every port, encoding it once per codec.
+
+        Return the ports that could not be reached.
+        """
+        frames = {}
+        unreachable = []
+        for port in ports:
+            try:
+                self.send(port, msg_dict, frames)
+            except OSError:
+                unreachable.append(port)
+        return unreachable
+
+    def instrument(self, metrics):
+        """Time connects and sampled sends, and count failed connects and reconnects."""
+        self.connect = metrics.timed(
+            "sms_connect_seconds", "Time spent opening connections to peers.", self.connect,
+            errors=metrics.counter("sms_connect_errors_total", "Connects that failed."),
+        )
+        metrics.sampled(self, "send", "sms_send_seconds", "Time spent sending msgs to peers.")
+        self.reconnects = metrics.counter(
+            "sms_reconnects_total", "Pooled connections found broken and reopened."
+        )
+
+    def set_codec(self, port, codec):
+        """Speak codec to port from now on, reconnecting if it changes."""
+        codec = CODECS[codec]
+        with self.get_port_lock(port):
+            if self.codecs.get(port, self.codec) is not codec:
+                self.discard(port)
+            self.codecs[port] = codec
+
+    def get_port_lock(self, port):
+        """Return the lock serializing writes to a single peer."""
+        with self.lock:
+            port_lock = self.port_locks.get(port)
+            if port_lock is None:
+                port_lock = self.port_locks[port] = threading.Lock()
+            return port_lock
+
+    def connect(self, port):
+        """Open a new connection to port and keep it in the pool."""
+        if self.socket_dir is not None:
+            sock = self.connect_unix(port)
+            if sock is not None:
+                self.conns[port] = sock
+                return sock
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((self.host, port))
+        except OSError:
+            sock.close()
+            raise
+        # msgs are tiny, do not let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conns[port] = sock
+        return sock
+
+    def connect_unix(self, port):
+        """Return a connection to the Unix socket of port, None if it does not serve one."""
+        path = socket_path(self.socket_dir, port)
+        if not os.path.exists(path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            # left behind by a dead process, TCP tells whether the peer is really gone
+            sock.close()
+            return None
+        return sock
+
+    def discard(self, port):
+        """Close and forget the connection to port."""
+        sock = self.conns.pop(port, None)
+        if sock is not None:
+            sock.close()
+
+    @staticmethod
+    def is_stale(sock):
+        """Check whether the peer closed an idle pooled connection."""
+        # peers never write back on pooled connections, so readable means EOF
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def close(self):
+        """Close every pooled connection."""
+        with self.lock:
+            ports = list(self.conns)
+        for port in ports:
+            with self.get_port_lock(port):
+                self.discard(port)
+
+
+def recv_chunks(sock, is_shut_down, decoder):
+    """Yield the list of msgs completed by every recv until EOF or shutdown."""
+    while not is_shut_down():
+        try:
+            data = sock.recv(RECV_SIZE)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        msgs = decoder.feed(data)
+        if msgs:
+            yield msgs
+    msgs = decoder.finish()
+    if msgs:
+        yield msgs
+
+
+def recv_msgs(sock, is_shut_down, decoder=None):
+    """Yield every msg received on a framed stream until EOF or shutdown."""
+    for msgs in recv_chunks(sock, is_shut_down, decoder or FrameDecoder()):
+        yield from msgs
+
+
+def new_decoder(metrics=None):
+    """Return a frame decoder for one connection, timed if metrics are on."""
+    if metrics is None:
+        return FrameDecoder()
+    return metrics.timed_decoder(FrameDecoder())
+
+
+def dispatch_msgs(msgs, dispatch, is_shut_down):
+    """Dispatch msgs in order, stopping early once shut down."""
+    for msg_dict in msgs:
+        dispatch(msg_dict)
+        if is_shut_down():
+            return
+
+
+def serve_connection(conn, dispatch, is_shut_down, metrics=None):
+    """Read framed msgs from a single long-lived connection and dispatch them."""
+    dispatch_all = dispatch_msgs if metrics is None else metrics.timed_dispatch
+    with conn:
+        conn.settimeout(1)
+        try:
+            for msgs in recv_chunks(conn, is_shut_down, new_decoder(metrics)):
+                dispatch_all(msgs, dispatch, is_shut_down)
+                if is_shut_down():
+                    break
+        except ValueError as error:
+            LOGGER.warning("Dropped connection: %s", error, extra={"event": "dropped_connection"})
+
+
+def serve_tcp(port, dispatch, is_shut_down, ready=None, metrics=None, socket_dir=None):
+    """Set up TCP Socket Server, plus a Unix one in socket_dir, and serve every connection."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # Bind the socket to the server
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("localhost", port))
+        sock.listen()
+        unix_sock = unix_thread = None
+        if socket_dir is not None:
+            # bound after the TCP port, so a live owner of the same port fails us first
+            unix_sock = listen_unix(socket_path(socket_dir, port))
+            unix_thread = threading.Thread(
+                target=accept_forever, args=(unix_sock, dispatch, is_shut_down, metrics)
+            )
+            unix_thread.start()
+        if ready is not None:
+            ready.set()
+        try:
+            accept_forever(sock, dispatch, is_shut_down, metrics)
+        finally:
+            if unix_sock is not None:
+                unix_thread.join()
+                unix_sock.close()
+                remove_socket(socket_path(socket_dir, port))
+
+
+def accept_forever(sock, dispatch, is_shut_down, metrics=None):
+    """Serve every connection accepted on a listening sock on its own thread until shut down."""
+    workers = []
+    sock.settimeout(1)
+    while not is_shut_down():
+        try:
+            conn, _ = sock.accept()
+        except socket.timeout:
+            continue
+        worker = threading.Thread(
+            target=serve_connection, args=(conn, dispatch, is_shut_down, metrics)
+        )
+        worker.start()
+        workers.append(worker)
+        workers = [w for w in workers if w.is_alive()]
+
+    for worker in workers:
+        worker.join()
+
+
+LISTEN_TIMEOUT = 5
+
+
+class ThreadedServer:
+    """Serve framed msgs with a blocking accept loop and one thread per connection."""
+
+    def __init__(self, port, dispatch, is_shut_down, metrics=None, socket_dir=None):
+        self.port = port
+        self.dispatch = dispatch
+        self.is_shut_down = is_shut_down
+        self.metrics = metrics
+        self.socket_dir = socket_dir
+        self.ready = threading.Event()
+
+    def serve_forever(self):
+        """Serve until is_shut_down() turns True."""
+        serve_tcp(self.port, self.dispatch, self.is_shut_down, self.ready, self.metrics,
+                  self.socket_dir)
+
+    def stop(self):
+        """Nothing to wake up, the accept loop polls is_shut_down."""
+
+
+class AsyncioServer:
+    """Serve framed msgs from every connection concurrently on an asyncio event loop.
+
+    Msgs are dispatched on the loop's executor, a connection's in arrival order.
+    """
+
+    def __init__(self, port, dispatch, is_shut_down=None, metrics=None, socket_dir=None):
+        self.port = port
+        self.dispatch = dispatch
+        self.metrics = metrics
+        self.socket_dir = socket_dir
+        self.loop = None
+        self.stopped = None
+        self.stopping = False
+        self.ready = threading.Event()
+        self.connections = {}
+
+    def serve_forever(self):
+        """Run the event loop until stop() is called."""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Accept connections until stopped, then close them all."""
+        self.stopped = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        if self.stopping:
+            self.stopped.set()
+        servers = [await asyncio.start_server(
+            self.handle_connection, "localhost", self.port,
+            reuse_address=True,
+        )]
+        if self.socket_dir is not None:
+            path = socket_path(self.socket_dir, self.port)
+            servers.append(await asyncio.start_unix_server(
+                self.handle_connection, sock=listen_unix(path)
+            ))
+        self.ready.set()
+        try:
+            await self.stopped.wait()
+        finally:
+            for server in servers:
+                server.close()
+            # closing the transports hands every reader an EOF
+            for writer in list(self.connections.values()):
+                writer.close()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            for server in servers:
+                await server.wait_closed()
+            if self.socket_dir is not None:
+                remove_socket(socket_path(self.socket_dir, self.port))
+
+    async def handle_connection(self, reader, writer):
+        """Dispatch every frame of a single connection in arrival order."""
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        decoder = new_decoder(self.metrics)
+        dispatch_all = dispatch_msgs if self.metrics is None else self.metrics.timed_dispatch
+        try:
+            while not self.stopped.is_set():
+                data = await reader.read(RECV_SIZE)
+                msgs = decoder.feed(data) if data else decoder.finish()
+                if msgs:
+                    # handlers take locks and send, the loop keeps accepting and reading meanwhile
+                    await self.loop.run_in_executor(
+                        None, dispatch_all, msgs, self.dispatch, self.stopped.is_set)
+                if not data:
+                    break
+        except ConnectionError:
+            pass
+        except ValueError as error:
+            LOGGER.warning("Dropped connection: %s", error, extra={"event": "dropped_connection"})
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    def stop(self):
+        """Wake the event loop up and stop serving, callable from any thread."""
+        self.stopping = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+
+def create_server(mode, port, dispatch, is_shut_down, metrics=None, socket_dir=None):
+    """Build the listener for the requested server mode."""
+    if mode == "asyncio":
+        return AsyncioServer(port, dispatch, is_shut_down, metrics, socket_dir)
+    return ThreadedServer(port, dispatch, is_shut_down, metrics, socket_dir)
@@ -0,0 +1,321 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from system.source import DEFAULT_LANE
+
+# record types
+ENQUEUED = 1
+ASSIGNED = 2
+FINISHED = 3
+STATS = 4
+# a failed attempt of a msg still pending, waiting for its retry
+RETRIED = 5
+
+# every record is length and crc32 of its body, then type byte and payload
+HEADER = struct.Struct("<II")
+ENQUEUED_FIELDS = struct.Struct("<B q ? H I")
+# msgs outside the default lane end their enqueued record with their lane
+LANE = struct.Struct("<B")
+ASSIGNED_FIELDS = struct.Struct("<B q i")
+FINISHED_FIELDS = struct.Struct("<B q ? d")
+STATS_FIELDS = struct.Struct("<B q q d q q")
+RETRIED_FIELDS = struct.Struct("<B q d")
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+SYNC_INTERVAL = 0.01
+# closed segments kept around before they are folded into a checkpoint
+COMPACT_AFTER = 4
+
+SEGMENT_NAME = "segment-{:08d}.log"
+CHECKPOINT_NAME = "checkpoint-{:08d}.log"
+FILE_PATTERN = re.compile(r"(segment|checkpoint)-(\d{8})\.log$")
+
+
+class RecoveredState:
+    """Queue and stats rebuilt by replaying the log."""
+
+    def __init__(self):
+        # msg_id -> (msg_id, phone, msg), in enqueue order
+        self.pending = {}
+        # msg_id -> lane of the pending msgs outside the default lane
+        self.lanes = {}
+        self.assigned = set()
+        self.status = {"num_sent": 0, "num_fail": 0, "total_time": 0}
+        self.next_msg_id = 0
+        self.next_generated_id = 0
+
+    def apply(self, body):
+        """Apply a single record body."""
+        record_type = body[0]
+        if record_type == ENQUEUED:
+            _, msg_id, generated, phone_len, msg_len = ENQUEUED_FIELDS.unpack_from(body)
+            offset = ENQUEUED_FIELDS.size
+            phone = body[offset:offset + phone_len].decode("utf-8")
+            offset += phone_len + msg_len
+            msg = body[offset - msg_len:offset].decode("utf-8")
+            self.pending[msg_id] = (msg_id, phone, msg)
+            if len(body) > offset:
+                (self.lanes[msg_id],) = LANE.unpack_from(body, offset)
+            self.next_msg_id = max(self.next_msg_id, msg_id + 1)
+            if generated:
+                self.next_generated_id = max(self.next_generated_id, msg_id + 1)
+        elif record_type == ASSIGNED:
+            _, msg_id, _ = ASSIGNED_FIELDS.unpack_from(body)
+            self.assigned.add(msg_id)
+        elif record_type == FINISHED:
+            _, msg_id, success, send_time = FINISHED_FIELDS.unpack_from(body)
+            self.pending.pop(msg_id, None)
+            self.lanes.pop(msg_id, None)
+            self.assigned.discard(msg_id)
+            if success:
+                self.status["num_sent"] += 1
+                self.status["total_time"] += send_time
+            else:
+                self.status["num_fail"] += 1
+        elif record_type == RETRIED:
+            _, msg_id, _ = RETRIED_FIELDS.unpack_from(body)
+            self.assigned.discard(msg_id)
+            self.status["num_fail"] += 1
+        elif record_type == STATS:
+            (_, num_sent, num_fail, total_time,
+             self.next_msg_id, self.next_generated_id) = STATS_FIELDS.unpack_from(body)
+            self.status = {"num_sent": num_sent, "num_fail": num_fail, "total_time": total_time}
+
+    @property
+    def requeued(self):
+        """Number of msgs that were in flight when the log stopped."""
+        return len(self.assigned)
+
+
+def encode_record(body):
+    """Frame a record body with its length and checksum."""
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def enqueued_record(msg_id, phone, msg, generated=False, lane=DEFAULT_LANE):
+    """Encode an enqueued msg."""
+    phone, msg = phone.encode("utf-8"), msg.encode("utf-8")
+    body = ENQUEUED_FIELDS.pack(ENQUEUED, msg_id, generated, len(phone), len(msg)) + phone + msg
+    if lane != DEFAULT_LANE:
+        body += LANE.pack(lane)
+    return encode_record(body)
+
+
+def iter_records(data):
+    """Yield (body, end offset) of every intact record, stopping at the first torn one."""
+    offset = 0
+    end = len(data)
+    unpack_header = HEADER.unpack_from
+    crc32 = zlib.crc32
+    while offset + HEADER.size <= end:
+        length, crc = unpack_header(data, offset)
+        start = offset + HEADER.size
+        # preallocated, never written space reads as a zero length
+        if length == 0 or start + length > end:
+            return
+        body = data[start:start + length]
+        if crc32(body) != crc:
+            return
+        offset = start + length
+        yield body, offset
+
+
+def replay_file(path, state):
+    """Apply every record in path to state, return the offset after the last one."""
+    position = 0
+    with open(path, "rb") as log_file:
+        if os.fstat(log_file.fileno()).st_size == 0:
+            return position
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for body, position in iter_records(data):
+                state.apply(body)
+    return position
+
+
+class Segment:
+    """A preallocated log file written through a shared memory map."""
+
+    def __init__(self, path, size, position=0):
+        self.path = path
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+        self.position = position
+        self.synced = position
+
+    def write(self, record):
+        """Copy record into the map, return False if it does not fit."""
+        end = self.position + len(record)
+        if end > self.size:
+            return False
+        self.map[self.position:end] = record
+        self.position = end
+        return True
+
+    def sync(self, position=None):
+        """msync everything written up to position since the last sync."""
+        position = self.position if position is None else position
+        if self.synced >= position:
+            return
+        start = self.synced - self.synced % mmap.PAGESIZE
+        self.map.flush(start, position - start)
+        self.synced = position
+
+    def close(self):
+        self.sync()
+        self.map.close()
+        self.file.close()
+
+
+class WriteAheadLog:
+    """Append-only, segment based log of enqueued, assigned, retried and finished msgs.
+
+    Records land in the page cache as soon as they are copied into the mapped
+    segment, so they survive the process being killed. A background thread
+    msyncs new records every sync_interval secs, which commits the whole group
+    with one call instead of one fsync per record.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, sync_interval=SYNC_INTERVAL,
+                 compact_after=COMPACT_AFTER):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.segment = None
+        # full segments waiting for the syncer to sync and close them
+        self.retired = []
+        self.compactor = None
+        self.syncer = None
+
+    def list_files(self, kind):
+        """Return (number, path) of every segment or checkpoint file, oldest first."""
+        files = []
+        for name in os.listdir(self.directory):
+            match = FILE_PATTERN.match(name)
+            if match and match.group(1) == kind:
+                files.append((int(match.group(2)), os.path.join(self.directory, name)))
+        return sorted(files)
+
+    def recover(self):
+        """Replay the newest checkpoint and every later segment, then open the log for writing."""
+        state = RecoveredState()
+        checkpoint = 0
+        checkpoints = self.list_files("checkpoint")
+        if checkpoints:
+            checkpoint, path = checkpoints[-1]
+            replay_file(path, state)
+        segments = [(number, path) for number, path in self.list_files("segment")
+                    if number > checkpoint]
+        position = 0
+        for _, path in segments:
+            position = replay_file(path, state)
+
+        # keep appending to the last segment, right after its last intact record
+        number = segments[-1][0] if segments else checkpoint + 1
+        self.segment = Segment(os.path.join(self.directory, SEGMENT_NAME.format(number)),
+                               self.segment_size, position)
+        self.syncer = threading.Thread(target=self.sync_forever)
+        self.syncer.start()
+        return state
+
+    def append(self, record):
+        """Append an encoded record, rolling over to a new segment when full."""
+        with self.lock:
+            if self.segment.write(record):
+                return
+            self.rotate()
+            if not self.segment.write(record):
+                raise ValueError("record larger than a WAL segment")
+
+    def log_enqueued(self, msg_id, phone, msg, generated=False, lane=DEFAULT_LANE):
+        self.append(enqueued_record(msg_id, phone, msg, generated, lane))
+
+    def log_assigned(self, msg_id, sender_port):
+        self.append(encode_record(ASSIGNED_FIELDS.pack(ASSIGNED, msg_id, sender_port)))
+
+    def log_finished(self, msg_id, success, send_time):
+        self.append(encode_record(FINISHED_FIELDS.pack(FINISHED, msg_id, success, send_time)))
+
+    def log_retried(self, msg_id, send_time):
+        self.append(encode_record(RETRIED_FIELDS.pack(RETRIED, msg_id, send_time)))
+
+    def rotate(self):
+        """Close the full segment and start the next one. Caller holds the lock."""
+        number = int(FILE_PATTERN.search(self.segment.path).group(2)) + 1
+        self.retired.append(self.segment)
+        self.segment = Segment(os.path.join(self.directory, SEGMENT_NAME.format(number)),
+                               self.segment_size)
+        closed = [s for s in self.list_files("segment") if s[0] < number]
+        if len(closed) >= self.compact_after and not self.compacting():
+            self.compactor = threading.Thread(target=self.compact, args=(number - 1,))
+            self.compactor.start()
+
+    def compacting(self):
+        return self.compactor is not None and self.compactor.is_alive()
+
+    def compact(self, last):
+        """Fold the checkpoint and segments up to last into a new checkpoint."""
+        state = RecoveredState()
+        checkpoints = self.list_files("checkpoint")
+        if checkpoints:
+            replay_file(checkpoints[-1][1], state)
+        first = checkpoints[-1][0] if checkpoints else 0
+        segments = [s for s in self.list_files("segment") if first < s[0] <= last]
+        for _, path in segments:
+            replay_file(path, state)
+
+        path = os.path.join(self.directory, CHECKPOINT_NAME.format(last))
+        with open(path + ".tmp", "wb") as checkpoint:
+            status = state.status
+            checkpoint.write(encode_record(STATS_FIELDS.pack(
+                STATS, status["num_sent"], status["num_fail"], status["total_time"],
+                state.next_msg_id, state.next_generated_id,
+            )))
+            for msg_id, phone, msg in state.pending.values():
+                checkpoint.write(enqueued_record(
+                    msg_id, phone, msg, lane=state.lanes.get(msg_id, DEFAULT_LANE)
+                ))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(path + ".tmp", path)
+
+        for _, old_path in checkpoints + segments:
+            os.remove(old_path)
+
+    def sync_forever(self):
+        """Group-commit new records until closed."""
+        while not self.closed.wait(self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """Make every record appended so far durable, without blocking appends meanwhile."""
+        with self.lock:
+            segment, position = self.segment, self.segment.position
+            retired, self.retired = self.retired, []
+        for old in retired:
+            old.close()
+        segment.sync(position)
+
+    def close(self):
+        """Sync and close the log."""
+        self.closed.set()
+        if self.syncer is not None:
+            self.syncer.join()
+        if self.compactor is not None:
+            self.compactor.join()
+        with self.lock:
+            if self.segment is not None:
+                for old in self.retired + [self.segment]:
+                    old.close()
+                self.retired = []
+                self.segment = None
@@ -0,0 +1,76 @@
+import socket
+import threading
+import time
+import system
+import utils
+from system.utils import AsyncioServer, ConnectionPool, send_msg_tcp
+
+
+def test_asyncio_server_serves_connections_concurrently():
+    """Test a stalled connection does not hold back other connections."""
+    port = utils.free_port()
+    received = []
+    server = AsyncioServer(port, received.append)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    server.ready.wait(utils.TIMEOUT)
+
+    with socket.create_connection(("localhost", port)) as stalled:
+        # half a frame that never completes
+        stalled.sendall(b'{"message_type": ')
+        pool = ConnectionPool()
+        pool.send(port, {"message_type": "status", "n": 1})
+        pool.send(port, {"message_type": "status", "n": 2})
+        utils.wait_until(lambda: len(received) == 2)
+        assert [m["n"] for m in received] == [1, 2]
+
+        start = time.time()
+        server.stop()
+        thread.join()
+        assert time.time() - start < 0.5
+        pool.close()
+
+
+def test_asyncio_server_dispatches_off_the_loop():
+    """Test a handler blocking on one connection holds back neither accepts nor other connections."""
+    port = utils.free_port()
+    received = []
+    release = threading.Event()
+
+    def dispatch(msg):
+        if msg["n"] == 0:
+            release.wait(utils.TIMEOUT)
+        received.append(msg["n"])
+
+    server = AsyncioServer(port, dispatch)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    server.ready.wait(utils.TIMEOUT)
+    try:
+        send_msg_tcp(port, {"message_type": "status", "n": 0})
+        send_msg_tcp(port, {"message_type": "status", "n": 1})
+        utils.wait_until(lambda: received == [1])
+    finally:
+        release.set()
+        utils.wait_until(lambda: sorted(received) == [0, 1])
+        server.stop()
+        thread.join()
+
+
+def test_system_asyncio_mode():
+    """Test the whole system delivers every msg with asyncio listeners."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    sender_ports = [utils.free_port(), utils.free_port()]
+    system.Monitor(monitor_port, producer_port, N=1, server_mode="asyncio")
+    producer = system.Producer(
+        producer_port, monitor_port, msg_num=4, server_mode="asyncio"
+    )
+    for sender_port in sender_ports:
+        system.Sender(sender_port, producer_port, mean_time=0,
+                      failure_rate=0.0, server_mode="asyncio")
+
+    try:
+        utils.wait_until(lambda: producer.status["num_sent"] == 4)
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
@@ -0,0 +1,125 @@
+import json
+import threading
+import pytest
+import system
+import utils
+from system.autoscaler import Autoscaler
+from system.simulation import SenderProfile, Simulation
+from system.supervisor import Supervisor, load_config
+from system.utils import send_msg_tcp
+
+
+def test_autoscaler_grows_at_once_and_shrinks_after_delay():
+    """Test the fleet grows as soon as it is short but only shrinks to what it needed a while."""
+    autoscaler = Autoscaler(1, 10, target=10.0, scale_down_delay=5.0)
+    # nothing measured yet, only the bounds count
+    assert autoscaler.decide(0, 1, 0, 0, []) == 1
+    # a Sender manages 20 msgs/sec, as many as arrive
+    assert autoscaler.decide(1, 1, 0, 20, [20.0]) == 1
+    # a burst of 400 on top, to be drained within 10 secs
+    assert autoscaler.decide(2, 1, 400, 40, [20.0]) == 9
+    assert autoscaler.decide(3, 9, 240, 220, [20.0] * 9) == 9
+    assert autoscaler.decide(4, 9, 80, 400, [20.0] * 9) == 9
+    # drained, but 9 Senders were wanted within the last 5 secs
+    assert autoscaler.decide(6, 9, 0, 500, [20.0] * 9) == 9
+    assert autoscaler.decide(8, 9, 0, 540, [20.0] * 9) == 7
+    assert autoscaler.decide(13, 7, 0, 640, [20.0] * 7) == 3
+    # holding steady only remembers the decisions of the last 5 secs
+    for now in range(14, 1000):
+        autoscaler.decide(now, 3, 0, 640 + 20 * (now - 13), [20.0] * 3)
+    assert len(autoscaler.wanted) == 6
+
+    with pytest.raises(ValueError):
+        Autoscaler(3, 2)
+
+
+def test_simulated_autoscaling_clears_backlog_faster():
+    """Test an autoscaled fleet drains a backlog much faster than the fixed fleet it starts as."""
+    profile = SenderProfile(1.0, 0.0, 4, std_time=0.1)
+    fixed = Simulation([profile] * 2, 5000, seed=1)
+    fixed_secs = fixed.run().clock()
+
+    scaled = Simulation([profile] * 2, 5000, seed=1)
+    scaled.autoscale(Autoscaler(2, 20, target=10.0), profile)
+    producer = scaled.run()
+
+    assert producer.status["num_sent"] == 5000
+    assert scaled.most_senders == 20
+    assert producer.clock() < fixed_secs / 5
+    assert not producer.retiring and not producer.in_flight
+
+
+def test_simulated_autoscaling_retires_spare_senders():
+    """Test Senders started to catch up with a stream are retired once it caught up."""
+    profile = SenderProfile(0.5, 0.0, 2, std_time=0.0)
+    simulation = Simulation([profile], 2000, rate=100.0, seed=1)
+    simulation.autoscale(Autoscaler(1, 40, target=5.0, scale_down_delay=5.0), profile)
+    producer = simulation.run()
+
+    assert producer.status["num_sent"] == 2000
+    # 100 msgs/sec take 25 Senders of 4 msgs/sec, more drained the backlog of the ramp up
+    assert simulation.most_senders > 30
+    assert 25 <= len(producer.senders) < simulation.most_senders
+    assert producer.retired and not producer.retiring
+
+
+def test_retired_sender_drains_then_shuts_down():
+    """Test a retired Sender gets no more msgs, finishes those it holds and is shut down."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=1)
+    producer = system.Producer(producer_port, monitor_port, msg_num=20, max_attempts=1)
+    senders = [system.Sender(utils.free_port(), producer_port, mean_time=0.3, failure_rate=0.0,
+                             window=2, std_time=0, heartbeat_interval=0.1) for _ in range(2)]
+    retired, kept = senders
+    try:
+        utils.wait_until(lambda: any(entry[1] == retired.port
+                                     for entry in list(producer.in_flight.values())))
+        send_msg_tcp(producer_port, {"message_type": "retire", "sender_port": retired.port})
+        utils.wait_until(lambda: retired.shut_down)
+        with producer.lock:
+            assert retired.port not in producer.senders
+            assert retired.port in producer.retired
+        utils.wait_until(lambda: producer.status["num_sent"] == 20)
+        sent = {port: histogram.count for port, histogram in producer.sender_histograms.items()}
+        # it finished what it held when retired, the rest went to the other one
+        assert 2 <= sent[retired.port] < sent[kept.port]
+        assert retired.port not in producer.senders
+        assert not kept.shut_down
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+
+def test_supervisor_scales_fleet_with_backlog(tmp_path):
+    """Test the supervisor starts Senders while there is a backlog and retires them once drained."""
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps({
+        "socket_dir": str(tmp_path),
+        "monitor": {"port": utils.free_port(), "N": 5},
+        "producer": {"port": utils.free_port(), "msg_num": 150},
+        "senders": [{"port": utils.free_port(), "mean_time": 0.05, "std_time": 0,
+                     "failure_rate": 0.0}],
+        "autoscale": {"min": 1, "max": 3, "target": 1.0, "interval": 0.2,
+                      "scale_down_delay": 0.5, "first_port": utils.free_port(),
+                      "stats_port": utils.free_port()},
+    }))
+    supervisor = Supervisor(load_config(str(path)))
+    runner = threading.Thread(target=supervisor.run)
+    sizes = []
+
+    def scaled_back():
+        sizes.append(len(supervisor.senders))
+        return supervisor.stats.status["num_sent"] == 150 and sizes[-1] == 1
+
+    try:
+        supervisor.start()
+        runner.start()
+        utils.wait_until(scaled_back, timeout=utils.TIMEOUT_LONG)
+    finally:
+        supervisor.request_stop()
+        if runner.ident is not None:
+            runner.join()
+        else:
+            supervisor.stop()
+    assert max(sizes) == 3
+    assert not any(child.alive() for child in supervisor.children)
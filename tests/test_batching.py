@@ -0,0 +1,113 @@
+import threading
+import system
+import utils
+from system.batching import Batcher
+
+
+def test_batcher_flushes_full_and_released_batches():
+    """Test full batches flush at once and partial ones on release without linger."""
+    flushed = []
+    batcher = Batcher(lambda key, batch: flushed.append((key, batch)), max_items=3)
+    for item in range(4):
+        batcher.add("a", item)
+    batcher.add("b", 9)
+    assert flushed == [("a", [0, 1, 2])]
+
+    batcher.release()
+    assert sorted(flushed) == [("a", [0, 1, 2]), ("a", [3]), ("b", [9])]
+    batcher.close()
+
+
+def test_batcher_lingers_and_limits_bytes():
+    """Test partial batches wait for linger secs and byte limits cut batches short."""
+    flushed = []
+    batcher = Batcher(lambda key, batch: flushed.append(batch), max_items=100,
+                      max_bytes=5, linger=0.2)
+    try:
+        batcher.add("a", "abc")
+        batcher.release()
+        assert flushed == []
+        batcher.add("a", "de")
+        assert flushed == [["abc", "de"]]
+
+        batcher.add("a", "f")
+        utils.wait_until(lambda: len(flushed) == 2, timeout=2)
+        assert flushed[1] == ["f"]
+    finally:
+        batcher.close()
+        batcher.flusher.join()
+
+
+def test_batcher_survives_failed_flush():
+    """Test a flush raising loses its batch but the flusher keeps flushing later ones."""
+    flushed = []
+
+    def flush(key, batch):
+        if batch == ["a"]:
+            raise ConnectionRefusedError("Producer down")
+        flushed.append(batch)
+
+    batcher = Batcher(flush, max_items=100, linger=0.05)
+    try:
+        batcher.add("p", "a")
+        utils.wait_until(lambda: "p" not in batcher.batches, timeout=2)
+        batcher.add("p", "b")
+        utils.wait_until(lambda: flushed == [["b"]], timeout=2)
+        assert batcher.flusher.is_alive()
+    finally:
+        batcher.close()
+        batcher.flusher.join()
+
+
+def test_batcher_flushes_lingering_batches_under_lock():
+    """Test the flusher thread holds the lock it was given around its flushes."""
+    lock = threading.Lock()
+    held = []
+    batcher = Batcher(lambda key, batch: held.append(lock.locked()), max_items=100,
+                      linger=0.05, lock=lock)
+    try:
+        batcher.add("p", "a")
+        utils.wait_until(lambda: held == [True], timeout=2)
+    finally:
+        batcher.close()
+        batcher.flusher.join()
+
+
+def test_producer_sends_batches(mocker):
+    """Test the producer packs every task for one sender into one sendmsg_batch."""
+    mock_socket = mocker.patch('socket.socket')
+    mockproducersocket = mocker.MagicMock()
+
+    def generate_producer_message():
+        yield utils.frame({
+            "message_type": "register",
+            "sender_port": 3001,
+            "credits": 4,
+        })
+        utils.wait_for_right_messages(is_batch, mock_socket)
+        yield utils.frame({
+            "message_type": "finished_batch",
+            "sender_port": 3001,
+            "results": [[0, True, 1.5], [1, False, 2.0], [2, True, 0.5]],
+            "credits": 3,
+        })
+        utils.wait_for_right_messages(is_batch, mock_socket, num=2)
+        yield utils.frame({"message_type": "shutdown"})
+        yield None
+
+    mockproducersocket.recv.side_effect = generate_producer_message()
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mockproducersocket)
+
+    producer = system.Producer(port=6000, monitor_port=5999, msg_num=10,
+                               batch_size=4)
+    utils.wait_for_threads()
+
+    batches = [m for m in utils.get_messages(mock_socket) if is_batch(m)]
+    assert [len(batch["tasks"]) for batch in batches] == [4, 3]
+    assert producer.status == {"num_sent": 2, "num_fail": 1, "total_time": 2.0}
+
+
+def is_batch(message):
+    """Test message type is sendmsg_batch."""
+    return message.get("message_type") == "sendmsg_batch"
@@ -0,0 +1,111 @@
+import json
+import pytest
+import system
+import utils
+from system.codec import CODECS, MAGIC, FrameDecoder, negotiate
+from system.utils import ConnectionPool, send_msg_tcp
+
+MESSAGES = [
+    {"message_type": "sendmsg", "msg_id": 7, "phone": "123456789", "msg": "héllo"},
+    {"message_type": "sendmsg_batch", "tasks": [[1, "123", "a"], [2, "456", "bc"]]},
+    {"message_type": "finished", "sender_port": 6001, "msg_id": 7, "success": True,
+     "send_time": 1.5, "credits": 1},
+    {"message_type": "finished_batch", "sender_port": 6001,
+     "results": [[1, True, 0.5], [2, False, 2.0]], "credits": 2},
+    {"message_type": "status"},
+    {"message_type": "stats", "seq": 3, "num_sent": 3, "num_fail": 1, "total_time": 4.5,
+     "histograms": {"send": [[1, 2], [70, 1]], "queue": [], "e2e": [[9, 3]],
+                    "queue_critical": [], "queue_normal": [[4, 1]], "queue_bulk": []},
+     "senders": {"6001": [[1, 2]], "6002": [[70, 1]]},
+     "retries": {"first_try": 2, "retried": 1, "exhausted": 1},
+     "dedup": {"suppressed": 5, "coalesced": 0}, "backlog": 120,
+     "producer_port": 6000},
+    {"message_type": "shutdown"},
+    # no fixed layout, travels as JSON inside a binary frame
+    {"message_type": "start", "producer_port": 6000},
+    {"message_type": "status", "producer_port": 6000, "num_sent": 3, "num_fail": 1,
+     "total_time": 4.5, "histograms": {"send": [[1, 2]]}, "senders": {"6001": [[1, 2]]},
+     "retries": {"first_try": 2, "retried": 1, "exhausted": 1},
+     "dedup": {"suppressed": 5, "coalesced": 0}},
+    {"message_type": "register", "sender_port": 6001, "credits": 4, "codecs": ["json"]},
+    {"message_type": "sendmsg", "msg_id": None, "phone": "123", "msg": "x"},
+    {"message_type": "sendmsg_batch", "tasks": [[3, "123", "a\0b"], [4, "456", "c"]]},
+]
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_codec_round_trip(codec):
+    """Test every msg type survives encoding and a byte-at-a-time decode."""
+    codec = CODECS[codec]
+    data = codec.preamble + b''.join(codec.encode(m) for m in MESSAGES)
+    decoder = FrameDecoder()
+    decoded = []
+    for i in range(len(data)):
+        decoded.extend(decoder.feed(data[i:i + 1]))
+    decoded.extend(decoder.finish())
+    # batches decode into tuples, compare them the way JSON sees them
+    assert json.loads(json.dumps(decoded)) == MESSAGES
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_large_frame_in_small_chunks(codec):
+    """Test a frame of megabytes arriving a few KB at a time decodes once complete."""
+    codec = CODECS[codec]
+    msg = {"message_type": "sendmsg_batch",
+           "tasks": [[n, "123456789", "x" * 100] for n in range(40000)]}
+    data = codec.preamble + codec.encode(msg) + codec.encode(MESSAGES[0])
+    decoder = FrameDecoder()
+    decoded = []
+    for i in range(0, len(data), 4096):
+        decoded.extend(decoder.feed(data[i:i + 4096]))
+    assert len(decoded) == 2
+    assert len(decoded[0]["tasks"]) == 40000 and decoded[1] == MESSAGES[0]
+
+
+def test_binary_frames_are_smaller():
+    """Test the fixed layouts beat JSON on the wire."""
+    msg = MESSAGES[2]
+    assert len(CODECS["binary"].encode(msg)) < len(CODECS["json"].encode(msg)) // 2
+
+
+def test_unsupported_version_is_rejected():
+    """Test a connection announcing an unknown binary version is refused."""
+    decoder = FrameDecoder()
+    with pytest.raises(ValueError):
+        decoder.feed(MAGIC + bytes([99]))
+
+
+def test_negotiate():
+    """Test peers fall back to JSON unless they offered the preferred codec."""
+    assert negotiate(["binary/1", "json"], "binary") == "binary"
+    assert negotiate([], "binary") == "json"
+    assert negotiate(["binary/2", "json"], "binary") == "json"
+
+
+def test_pool_switches_codec(mocker):
+    """Test a negotiated codec reconnects and opens with the binary preamble."""
+    mock_socket = mocker.patch('socket.socket')
+    pool = ConnectionPool()
+    pool.send(6001, {"message_type": "status"})
+    pool.set_codec(6001, "binary")
+    pool.send(6001, {"message_type": "status"})
+
+    assert mock_socket.call_count == 2
+    data = mock_socket.return_value.sendall.call_args_list[-1][0][0]
+    assert data.startswith(CODECS["binary"].preamble)
+
+
+def test_system_binary_codec_with_json_sender():
+    """Test binary and JSON peers deliver every msg side by side."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=1, codec="binary")
+    producer = system.Producer(producer_port, monitor_port, msg_num=6, codec="binary")
+    system.Sender(utils.free_port(), producer_port, mean_time=0, failure_rate=0.0,
+                  codec="binary")
+    system.Sender(utils.free_port(), producer_port, mean_time=0, failure_rate=0.0)
+
+    try:
+        utils.wait_until(lambda: producer.status["num_sent"] == 6)
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
@@ -0,0 +1,36 @@
+from system.utils import ConnectionPool, recv_msgs
+import utils
+
+
+def test_pool_reuses_connection(mocker):
+    """Test pooled msgs to the same port share a single connection."""
+    mock_socket = mocker.patch('socket.socket')
+    pool = ConnectionPool()
+    for msg_id in range(3):
+        pool.send(6001, {"message_type": "sendmsg", "msg_id": msg_id})
+
+    assert mock_socket.call_count == 1
+    messages = utils.get_messages(mock_socket)
+    assert [m["msg_id"] for m in messages] == [0, 1, 2]
+
+
+def test_pool_reconnects_broken_connection(mocker):
+    """Test the pool transparently reconnects when a send fails."""
+    mock_socket = mocker.patch('socket.socket')
+    pool = ConnectionPool()
+    pool.send(6001, {"message_type": "status"})
+    mock_socket.return_value.sendall.side_effect = [BrokenPipeError, None]
+    pool.send(6001, {"message_type": "status"})
+
+    assert mock_socket.call_count == 2
+    mock_socket.return_value.close.assert_called_once()
+
+
+def test_recv_msgs_reassembles_frames(mocker):
+    """Test frames split across and packed into recv chunks are all decoded."""
+    data = utils.frame({"n": 1}) + utils.frame({"n": 2}) + b'{"n": 3}'
+    conn = mocker.MagicMock()
+    conn.recv.side_effect = [data[:5], data[5:20], data[20:], b'']
+
+    messages = list(recv_msgs(conn, lambda: False))
+    assert messages == [{"n": 1}, {"n": 2}, {"n": 3}]
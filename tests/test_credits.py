@@ -0,0 +1,67 @@
+import system
+import utils
+
+
+def test_producer_fills_sender_windows(mocker):
+    """Test the producer keeps as many msgs in flight as each sender has credits."""
+    mock_socket = mocker.patch('socket.socket')
+    mockproducersocket = mocker.MagicMock()
+
+    def generate_producer_message():
+        yield utils.frame({
+            "message_type": "register",
+            "sender_port": 3001,
+            "credits": 3,
+        })
+        yield utils.frame({
+            "message_type": "register",
+            "sender_port": 3002,
+            "credits": 2,
+        })
+        utils.wait_for_right_messages(is_sendmsg, mock_socket, num=5)
+        # returning one credit frees room for exactly one more msg
+        yield utils.frame({
+            "message_type": "finished",
+            "sender_port": 3001,
+            "success": True,
+            "send_time": 1.0,
+            "credits": 1,
+        })
+        utils.wait_for_right_messages(is_sendmsg, mock_socket, num=6)
+        yield utils.frame({"message_type": "shutdown"})
+        yield None
+
+    mockproducersocket.recv.side_effect = generate_producer_message()
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mockproducersocket)
+
+    system.Producer(port=6000, monitor_port=5999, msg_num=10)
+    utils.wait_for_threads()
+
+
+def test_sender_advertises_window(mocker):
+    """Test the sender registers with its concurrency window as credits."""
+    mock_socket = mocker.patch('socket.socket')
+    mocksendersocket = mocker.MagicMock()
+    mocksendersocket.recv.side_effect = [
+        utils.frame({"message_type": "shutdown"}),
+        None,
+    ]
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mocksendersocket)
+
+    system.Sender(port=3001, producer_port=6000, mean_time=1,
+                  failure_rate=0.0, window=4)
+    utils.wait_for_threads()
+
+    registrations = [m for m in utils.get_messages(mock_socket)
+                     if m["message_type"] == "register"]
+    assert registrations == [
+        {"message_type": "register", "sender_port": 3001, "credits": 4,
+         "codecs": ["binary/1", "json"], "heartbeat": 1.0}
+    ]
+
+
+def is_sendmsg(message):
+    """Test message type is sendmsg."""
+    return message.get("message_type") == "sendmsg"
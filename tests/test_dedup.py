@@ -0,0 +1,65 @@
+from system.dedup import COALESCE_SEPARATOR, Coalescer, DedupIndex
+from system.simulation import SenderProfile, Simulation
+
+
+def test_dedup_index_forgets_after_window():
+    """Test a (phone, msg) repeat is a duplicate within the window only."""
+    dedup = DedupIndex(window=10.0)
+    assert not dedup.is_duplicate("123", "fire", 0.0)
+    assert dedup.is_duplicate("123", "fire", 5.0)
+    assert not dedup.is_duplicate("456", "fire", 5.0)
+    assert not dedup.is_duplicate("123", "flood", 5.0)
+    # the window counts from the first one, not the latest repeat
+    assert not dedup.is_duplicate("123", "fire", 10.0)
+    assert len(dedup) == 3
+
+
+def test_dedup_index_is_bounded():
+    """Test the oldest pairs are forgotten once max_entries are remembered."""
+    dedup = DedupIndex(window=60.0, max_entries=2)
+    for phone in ("1", "2", "3"):
+        assert not dedup.is_duplicate(phone, "fire", 0.0)
+    assert len(dedup) == 2
+    assert not dedup.is_duplicate("1", "fire", 1.0)
+    assert dedup.is_duplicate("3", "fire", 1.0)
+
+
+def test_coalescer_merges_into_queued_alert():
+    """Test alerts to a phone merge into its queued one within the window and lane only."""
+    coalescer = Coalescer(window=5.0, max_msgs=3)
+    coalescer.track(1, "123", 1, "a", 0.0)
+    assert coalescer.merge("123", 1, "b", 1.0) == (1, "a" + COALESCE_SEPARATOR + "b")
+    assert coalescer.merge("123", 0, "critical", 1.0) is None
+    assert coalescer.merge("456", 1, "other", 1.0) is None
+    assert coalescer.merge("123", 1, "c", 2.0)[0] == 1
+    assert coalescer.merge("123", 1, "full", 2.0) is None
+    assert coalescer.merge("123", 1, "late", 6.0) is None
+
+    assert coalescer.take((1, "123", "a"), 1) == (1, "123", COALESCE_SEPARATOR.join("abc"))
+    # once it left the queue nothing merges into it any more
+    assert coalescer.merge("123", 1, "d", 2.0) is None
+    assert coalescer.take((1, "123", "a, b, c"), 1) == (1, "123", "a, b, c")
+
+
+def test_alert_storm_is_cut_down():
+    """Test repeated and same-phone alerts reach the Senders as far fewer sends."""
+    profiles = [SenderProfile(1.0, 0.0, 1, std_time=0.0)]
+    simulation = Simulation(profiles, msg_num=0, seed=6)
+    producer = simulation.producer
+    producer.dedup = DedupIndex(window=60.0)
+    producer.coalescer = Coalescer(window=60.0)
+    sent = []
+    deliver = simulation.deliver
+    simulation.deliver = lambda port, tasks: sent.extend(tasks) or deliver(port, tasks)
+    storm = [("123456789", "site down")] * 50
+    storm += [("123456789", "db down"), ("123456789", "site down"), ("123456789", "disk full")]
+    storm += [("987654321", "site down", "critical")]
+    producer.enqueue(storm)
+    simulation.run()
+
+    assert producer.dedup_counts == {"suppressed": 50, "coalesced": 2}
+    assert producer.status["num_sent"] == 2
+    assert [task[1:] for task in sent] == [
+        ("987654321", "site down"),
+        ("123456789", COALESCE_SEPARATOR.join(["site down", "db down", "disk full"])),
+    ]
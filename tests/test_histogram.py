@@ -0,0 +1,47 @@
+import random
+from system.histogram import NUM_BUCKETS, UNIT, Histogram, bucket_index, bucket_upper
+
+
+def test_buckets_bound_relative_error():
+    """Test every value lands in a bucket at most ~3% wider than itself."""
+    rng = random.Random(1)
+    for _ in range(10000):
+        units = int(10 ** rng.uniform(0, 12))
+        index = bucket_index(units)
+        upper = bucket_upper(index) / UNIT
+        assert units <= round(upper)
+        assert upper - units <= max(1, units / 32)
+    assert bucket_index(1 << 60) == NUM_BUCKETS - 1
+
+
+def test_percentiles():
+    """Test percentiles of 1..10000 ms come out within the bucket error."""
+    histogram = Histogram()
+    for ms in range(1, 10001):
+        histogram.record(ms / 1000)
+
+    percentiles = histogram.percentiles()
+    for percent, expected in ((50, 5.0), (90, 9.0), (99, 9.9), (99.9, 9.99)):
+        assert abs(percentiles[percent] - expected) <= expected / 32
+    assert Histogram().percentile(99) is None
+
+
+def test_merge_and_delta():
+    """Test merged and shipped histograms count the same as recording everything."""
+    first, second, everything = Histogram(), Histogram(), Histogram()
+    for value in (0.001, 0.5, 3.0, 3.0):
+        first.record(value)
+        everything.record(value)
+    published = first.copy()
+    for value in (0.002, 7.5):
+        first.record(value)
+        everything.record(value)
+        second.record(value)
+
+    merged = Histogram.from_list(published.to_list())
+    merged.merge_list(first.delta(published))
+    assert merged.counts == everything.counts
+
+    published.merge(second)
+    assert published.counts == everything.counts
+    assert published.count == 6
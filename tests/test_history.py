@@ -0,0 +1,78 @@
+import json
+import urllib.request
+import pytest
+import system
+import utils
+from system.history import History, Series
+from system.utils import send_msg_tcp
+
+
+def fill(history, secs, start=1000.0):
+    """Record secs of 10 sends and 1 failure a sec, the backlog growing by 2 a sec after 60."""
+    for n in range(secs + 1):
+        history.record(start + n, {"num_sent": 10 * n, "num_fail": n, "total_time": 0.5 * n},
+                       max(0, 2 * (n - 60)))
+
+
+def test_series_keeps_fixed_samples_one_per_slot():
+    """Test records within a slot replace its sample and the oldest make room past capacity."""
+    series = Series(10.0, 5)
+    for n in range(1000):
+        series.record(float(n), [n, 0, 0, 0])
+    assert series.count == 5 and len(series.times) == 5
+    # the last record of each of the latest 5 slots of 10 secs
+    assert [series.sample(i, "num_sent") for i in range(5)] == [
+        (959.0, 959), (969.0, 969), (979.0, 979), (989.0, 989), (999.0, 999)]
+    assert series.find(975.0) == 1
+    assert series.find(900.0) == -1
+
+
+def test_history_answers_windowed_queries():
+    """Test rates, deltas, failure rates and averages over windows of every tier."""
+    history = History(tiers=((1.0, 100), (10.0, 100)))
+    fill(history, 600)
+    now = 1600.0
+
+    assert history.rate("num_sent", 60, now) == pytest.approx(10)
+    assert history.delta("num_fail", 30, now) == 30
+    assert history.failure_rate(60, now) == pytest.approx(1 / 11)
+    # past what the fine tier holds the coarse one answers, to within a slot
+    assert history.rate("num_sent", 500, now) == pytest.approx(10, rel=0.01)
+    # the backlog grew from 2 * 480 to 2 * 540 over the last minute
+    assert history.average("backlog", 60, now) == pytest.approx(2 * 510, rel=0.01)
+    assert [value for _, value in history.series("backlog", 5, now)] == [
+        1070, 1072, 1074, 1076, 1078, 1080]
+    # a window reaching back past every sample covers what is kept, from the
+    # last record of the first coarse slot on
+    assert history.delta("num_sent", 1e9, now) == 6000 - 10 * 9
+    assert History().rate("num_sent", 60, now) is None
+
+    with pytest.raises(ValueError):
+        history.query("median", "num_sent", 60)
+    with pytest.raises(ValueError):
+        history.query("rate", "phone", 60)
+
+
+def test_monitor_serves_history():
+    """Test the Monitor records the stats pushed to it and answers queries on its metrics port."""
+    monitor_port, producer_port, metrics_port = (utils.free_port(), utils.free_port(),
+                                                 utils.free_port())
+    monitor = system.Monitor(monitor_port, producer_port, N=1, metrics_port=metrics_port)
+    producer = system.Producer(producer_port, monitor_port, msg_num=6)
+    system.Sender(utils.free_port(), producer_port, mean_time=0, std_time=0, failure_rate=0.0,
+                  window=2)
+    try:
+        utils.wait_until(lambda: monitor.status["num_sent"] == 6)
+        url = "http://localhost:{}/history?query=series&field=num_sent&window=60".format(
+            metrics_port)
+        with urllib.request.urlopen(url, timeout=5) as response:
+            answer = json.loads(response.read().decode("utf-8"))
+        assert (answer["query"], answer["field"], answer["window"]) == ("series", "num_sent", 60)
+        assert answer["value"][-1][1] == 6
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url.replace("series", "median"), timeout=5)
+        assert error.value.code == 400
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+    assert producer.shut_down
@@ -0,0 +1,121 @@
+import io
+import socket
+import threading
+import time
+import system
+import utils
+from system.ingest import parse_rows
+from system.utils import send_msg_tcp
+
+
+def test_parse_rows_sniffs_format():
+    """Test NDJSON and CSV streams are both parsed, flagging bad rows."""
+    ndjson = io.StringIO(
+        '\n{"phone": "123456789", "msg": "a"}\n'
+        'not json\n'
+        '{"phone": "987654321", "msg": "b"}\n'
+    )
+    assert list(parse_rows(ndjson)) == [("123456789", "a"), None, ("987654321", "b")]
+
+    csv_stream = io.StringIO(
+        'phone,msg\n'
+        '123456789,"a, with comma"\n'
+        'only-one-column\n'
+        '987654321,"two\nlines"\n'
+    )
+    assert list(parse_rows(csv_stream)) == [
+        ("123456789", "a, with comma"), None, ("987654321", "two\nlines"),
+    ]
+
+
+def test_parse_rows_takes_priorities():
+    """Test an optional priority column or field is kept, unknown ones flag the row."""
+    csv_stream = io.StringIO('phone,msg,priority\n1,a,critical\n2,b,\n3,c,urgent\n')
+    assert list(parse_rows(csv_stream)) == [("1", "a", "critical"), ("2", "b"), None]
+
+    ndjson = io.StringIO('{"phone": "1", "msg": "a", "priority": "bulk"}\n'
+                         '{"phone": "2", "msg": "b", "priority": "urgent"}\n')
+    assert list(parse_rows(ndjson)) == [("1", "a", "bulk"), None]
+
+
+def test_enqueue_msg_is_assigned(mocker):
+    """Test alerts pushed with an enqueue msg go out to senders."""
+    mock_socket = mocker.patch('socket.socket')
+    mockproducersocket = mocker.MagicMock()
+    mockproducersocket.recv.side_effect = [
+        utils.frame({"message_type": "register", "sender_port": 3001}),
+        utils.frame({"message_type": "enqueue", "phone": "123456789", "msg": "fire"}),
+        utils.frame({"message_type": "shutdown"}),
+        None,
+    ]
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mockproducersocket)
+
+    system.Producer(port=6000, monitor_port=5999, msg_num=0)
+    utils.wait_for_threads()
+
+    tasks = [m for m in utils.get_messages(mock_socket) if m["message_type"] == "sendmsg"]
+    assert tasks == [{
+        "message_type": "sendmsg", "msg_id": 0, "phone": "123456789", "msg": "fire"
+    }]
+
+
+def test_bulk_ingest_applies_backpressure():
+    """Test bulk ingestion stops reading the client once the queue hits high water."""
+    monitor_port, producer_port, ingest_port = \
+        utils.free_port(), utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=60)
+    producer = system.Producer(producer_port, monitor_port, msg_num=0,
+                               ingest_port=ingest_port, high_water=1500)
+
+    rows = "".join("{:09d},{}\n".format(n, "x" * 100) for n in range(200000))
+    client_done = threading.Event()
+
+    def stream_rows():
+        try:
+            with socket.create_connection(("localhost", ingest_port)) as sock:
+                sock.sendall(rows.encode("utf-8"))
+        except OSError:
+            pass
+        client_done.set()
+
+    threading.Thread(target=stream_rows).start()
+    try:
+        utils.wait_until(lambda: len(producer.queue) >= 1500)
+        time.sleep(0.5)
+        # one ingest batch may overshoot, the rest of the stream waits in TCP buffers
+        assert len(producer.queue) < 3000
+        assert not client_done.is_set()
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+
+def test_bulk_ingest_resumes_at_half_high_water():
+    """Test paused ingestion waits for the queue to drain to half of high water, not just under it."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=60)
+    producer = system.Producer(producer_port, monitor_port, msg_num=0, high_water=10)
+    rows = [("{:09d}".format(n), "x") for n in range(10)]
+    try:
+        assert producer.ingest(rows)
+        paused = threading.Thread(target=producer.ingest, args=(rows,))
+        paused.start()
+
+        with producer.lock:
+            for _ in range(4):
+                producer.queue.pop(producer.clock())
+            producer.assign_messages()
+        # under high water, but not drained enough yet
+        paused.join(1.5)
+        assert paused.is_alive()
+
+        with producer.lock:
+            producer.queue.pop(producer.clock())
+            producer.assign_messages()
+        paused.join(utils.TIMEOUT)
+        assert not paused.is_alive()
+        assert len(producer.queue) == 15
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
@@ -0,0 +1,74 @@
+import collections
+from system.simulation import SenderProfile, Simulation
+from system.source import LANE_INDEX, LaneQueue
+
+CRITICAL, NORMAL, BULK = LANE_INDEX["critical"], LANE_INDEX["normal"], LANE_INDEX["bulk"]
+
+
+def drain(lanes, now=None):
+    """Pop every msg and return them in serving order."""
+    msgs = []
+    queued = lanes.pop(now)
+    while queued is not None:
+        msgs.append(queued[2])
+        queued = lanes.pop(now)
+    return msgs
+
+
+def test_strict_serves_most_urgent_lane_first():
+    """Test critical msgs go first, every lane stays FIFO and requeued msgs go to its head."""
+    lanes = LaneQueue("strict")
+    lanes.put("bulk-1", BULK)
+    lanes.put("normal-1")
+    lanes.put("critical-1", CRITICAL)
+    lanes.put("bulk-2", BULK)
+    lanes.requeue([(BULK, 0.0, "bulk-0"), (CRITICAL, 0.0, "critical-0")])
+
+    assert len(lanes) == 6
+    assert drain(lanes) == ["critical-0", "critical-1", "normal-1", "bulk-0", "bulk-1", "bulk-2"]
+    assert len(lanes) == 0
+
+
+def test_weighted_serves_lanes_by_weight():
+    """Test busy lanes share the picks by weight and bulk is never starved."""
+    lanes = LaneQueue("weighted", weights={"critical": 3, "normal": 2, "bulk": 1})
+    for lane in (CRITICAL, NORMAL, BULK):
+        for n in range(60):
+            lanes.put(lane, lane)
+
+    first = [lanes.pop()[0] for _ in range(60)]
+    assert collections.Counter(first) == {CRITICAL: 30, NORMAL: 20, BULK: 10}
+    # picks interleave rather than come in runs
+    assert BULK in first[:6]
+
+
+def test_overdue_msgs_jump_ahead():
+    """Test a msg queued past its lane's deadline is served before more urgent lanes."""
+    lanes = LaneQueue("strict", deadlines={"bulk": 5.0})
+    lanes.put("bulk-old", BULK, enqueued=0.0)
+    lanes.put("bulk-new", BULK, enqueued=4.0)
+    lanes.put("critical", CRITICAL, enqueued=4.0)
+
+    assert drain(lanes, now=4.0) == ["critical", "bulk-old", "bulk-new"]
+
+    lanes.put("bulk-old", BULK, enqueued=0.0)
+    lanes.put("bulk-new", BULK, enqueued=4.0)
+    lanes.put("critical", CRITICAL, enqueued=4.0)
+    assert drain(lanes, now=6.0) == ["bulk-old", "critical", "bulk-new"]
+
+
+def test_critical_alerts_bypass_bulk_backlog():
+    """Test critical alerts queued behind a bulk backlog wait for one free credit only."""
+    profiles = [SenderProfile(1.0, 0.0, 4, std_time=0.0)]
+    simulation = Simulation(profiles, msg_num=0, seed=5)
+    producer = simulation.producer
+    producer.enqueue([("123456789", "bulk", "bulk")] * 1000)
+    producer.enqueue([("987654321", "critical", "critical")] * 4)
+    simulation.run()
+
+    histograms = producer.histograms
+    assert histograms["queue_critical"].count == 4
+    assert histograms["queue_bulk"].count == 1000
+    assert histograms["queue"].count == 1004
+    assert histograms["queue_critical"].percentiles()[99] < 0.01
+    assert histograms["queue_bulk"].percentiles()[99] > 200
@@ -0,0 +1,153 @@
+import threading
+import time
+import system
+import utils
+from system.utils import ConnectionPool, send_msg_tcp, serve_tcp
+
+
+class FakeSender:
+    """Register with the Producer, collect the msgs it assigns and never finish them."""
+
+    def __init__(self, producer_port, heartbeat=True, listen=True):
+        self.port = utils.free_port()
+        self.msgs = []
+        self.shut_down = False
+        self.thread = None
+        if listen:
+            ready = threading.Event()
+            self.thread = threading.Thread(target=serve_tcp, args=(
+                self.port, self.msgs.append, lambda: self.shut_down, ready))
+            self.thread.start()
+            ready.wait(utils.TIMEOUT)
+        register_msg = {"message_type": "register", "sender_port": self.port, "credits": 2}
+        if heartbeat:
+            register_msg["heartbeat"] = 0.1
+        send_msg_tcp(producer_port, register_msg)
+
+    def assigned(self):
+        return [msg["msg_id"] for msg in self.msgs if msg["message_type"] == "sendmsg"]
+
+    def stop(self):
+        self.shut_down = True
+        if self.thread is not None:
+            self.thread.join()
+
+
+def start_producer(msg_num, **kwargs):
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=1)
+    producer = system.Producer(producer_port, monitor_port, msg_num=msg_num, **kwargs)
+    return producer, producer_port
+
+
+def test_silent_sender_is_evicted_and_msgs_requeued():
+    """Test msgs held by a Sender that stops heartbeating go to a live Sender."""
+    producer, producer_port = start_producer(4, lease_timeout=0.5)
+    dead = FakeSender(producer_port)
+    try:
+        utils.wait_until(lambda: len(dead.assigned()) == 2)
+        system.Sender(utils.free_port(), producer_port, mean_time=0, std_time=0,
+                      failure_rate=0.0, heartbeat_interval=0.1)
+        utils.wait_until(lambda: producer.status["num_sent"] == 4)
+        assert dead.port not in producer.senders
+        assert not producer.in_flight
+        assert dead.port not in producer.sender_msgs
+    finally:
+        dead.stop()
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+
+def test_stuck_msgs_are_requeued_and_late_results_ignored():
+    """Test msgs a live Sender holds past msg_timeout are requeued and counted once."""
+    producer, producer_port = start_producer(2, msg_timeout=0.5)
+    stuck = FakeSender(producer_port, heartbeat=False)
+    try:
+        utils.wait_until(lambda: len(stuck.assigned()) == 2)
+        # the stuck Sender keeps its credits, so the requeued msgs wait for another one
+        system.Sender(utils.free_port(), producer_port, mean_time=0, std_time=0,
+                      failure_rate=0.0, heartbeat_interval=0)
+        utils.wait_until(lambda: producer.status["num_sent"] == 2)
+        for msg_id in stuck.assigned():
+            send_msg_tcp(producer_port, {
+                "message_type": "finished", "sender_port": stuck.port, "msg_id": msg_id,
+                "success": True, "send_time": 0.1, "credits": 1,
+            })
+        utils.wait_until(lambda: producer.scheduler.stats[stuck.port].free == 2)
+        assert producer.status["num_sent"] == 2
+        assert stuck.port in producer.senders
+    finally:
+        stuck.stop()
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+
+def test_results_long_after_requeue_are_ignored():
+    """Test results of msgs whose requeued copies finished long ago are not counted again."""
+    producer, producer_port = start_producer(2, msg_timeout=0.2)
+    stuck = FakeSender(producer_port, heartbeat=False)
+    try:
+        utils.wait_until(lambda: len(stuck.assigned()) == 2)
+        system.Sender(utils.free_port(), producer_port, mean_time=0, std_time=0,
+                      failure_rate=0.0, heartbeat_interval=0)
+        utils.wait_until(lambda: producer.status["num_sent"] == 2)
+        with producer.lock:
+            assert not producer.sender_msgs[stuck.port]
+        # well past the msg_timeout the requeue happened within
+        time.sleep(1)
+        for msg_id in stuck.assigned():
+            send_msg_tcp(producer_port, {
+                "message_type": "finished", "sender_port": stuck.port, "msg_id": msg_id,
+                "success": False, "send_time": 0.1, "credits": 1,
+            })
+        utils.wait_until(lambda: producer.scheduler.stats[stuck.port].free == 2)
+        with producer.lock:
+            assert producer.status["num_sent"] == 2 and producer.status["num_fail"] == 0
+            assert not producer.retry_queue
+    finally:
+        stuck.stop()
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+
+def test_unreachable_sender_is_evicted():
+    """Test a Sender nobody listens for is evicted as soon as a send to it fails."""
+    producer, producer_port = start_producer(3)
+    gone = FakeSender(producer_port, heartbeat=False, listen=False)
+    try:
+        utils.wait_until(lambda: gone.port not in producer.senders)
+        system.Sender(utils.free_port(), producer_port, mean_time=0, std_time=0,
+                      failure_rate=0.0, heartbeat_interval=0)
+        utils.wait_until(lambda: producer.status["num_sent"] == 3)
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+
+def test_late_failure_of_evicted_sender_leaves_requeued_copy_alone():
+    """Test a late failure from an evicted Sender neither retries nor finishes the copy in flight."""
+    producer, producer_port = start_producer(2, lease_timeout=0.5)
+    dead = FakeSender(producer_port)
+    pool = ConnectionPool()
+    try:
+        utils.wait_until(lambda: len(dead.assigned()) == 2)
+        dead.stop()
+        alive = FakeSender(producer_port)
+        utils.wait_until(lambda: len(alive.assigned()) == 2)
+        msg_id = alive.assigned()[0]
+        # one connection, so the late failure is handled first
+        for sender_port, success in ((dead.port, False), (alive.port, True)):
+            pool.send(producer_port, {
+                "message_type": "finished", "sender_port": sender_port, "msg_id": msg_id,
+                "success": success, "send_time": 0.1, "credits": 1,
+            })
+        utils.wait_until(lambda: producer.status["num_sent"] == 1)
+        with producer.lock:
+            assert producer.status["num_fail"] == 0
+            assert not producer.retry_queue
+            assert msg_id not in producer.in_flight
+    finally:
+        pool.close()
+        alive.stop()
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
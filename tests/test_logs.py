@@ -0,0 +1,87 @@
+import json
+import logging
+import random
+import threading
+from system.logs import AsyncHandler, EventFilter, JsonFormatter
+
+
+class GatedStream:
+    """Stand in for stdout, holding up the first write until opened."""
+
+    def __init__(self):
+        self.writes = []
+        self.writing = threading.Event()
+        self.gate = threading.Event()
+
+    def write(self, text):
+        self.writing.set()
+        self.gate.wait()
+        self.writes.append(text)
+
+    def flush(self):
+        pass
+
+
+def record(msg, event=None, created=None):
+    fields = {"msg": msg, "levelno": logging.INFO, "levelname": "INFO"}
+    if event is not None:
+        fields["event"] = event
+    if created is not None:
+        fields["created"] = created
+    return logging.makeLogRecord(fields)
+
+
+def test_full_queue_drops_and_counts_instead_of_blocking():
+    """Test records logged while the writer is stuck are dropped once the queue is full."""
+    stream = GatedStream()
+    handler = AsyncHandler(stream, queue_size=2)
+    handler.handle(record("first"))
+    assert stream.writing.wait(5)
+    for n in range(10):
+        handler.handle(record("msg {}".format(n)))
+    assert handler.dropped == 8
+    stream.gate.set()
+    handler.close()
+
+    lines = "".join(stream.writes).splitlines()
+    assert lines[:3] == ["first", "msg 0", "msg 1"]
+    assert lines[3] == "Dropped 8 log records, the log writer fell behind"
+
+
+def test_writer_batches_json_lines():
+    """Test records queued meanwhile go out in one write, as JSON lines."""
+    stream = GatedStream()
+    handler = AsyncHandler(stream)
+    handler.setFormatter(JsonFormatter("Sender:6001"))
+    handler.handle(record("first"))
+    assert stream.writing.wait(5)
+    for n in range(100):
+        handler.handle(record("Send {%s}", event="sent"))
+    stream.gate.set()
+    handler.close()
+
+    assert len(stream.writes) == 2
+    entries = [json.loads(line) for line in stream.writes[1].splitlines()]
+    assert len(entries) == 100
+    assert entries[0]["component"] == "Sender:6001"
+    assert entries[0]["event"] == "sent" and entries[0]["level"] == "INFO"
+    assert "event" not in json.loads(stream.writes[0])
+
+
+def test_event_filter_samples_and_limits_events():
+    """Test sampled events keep their fraction, limited ones their rate, others all pass."""
+    random.seed(1)
+    event_filter = EventFilter(samples={"sent": 0.1}, limits={"unreachable": 5})
+    kept = sum(event_filter.filter(record("sent", "sent")) for _ in range(10000))
+    assert 800 < kept < 1200
+    assert event_filter.dropped["sent"] == 10000 - kept
+
+    # a burst of 5 at once, then 5 per sec
+    assert sum(event_filter.filter(record("down", "unreachable", 100.0))
+               for _ in range(20)) == 5
+    assert sum(event_filter.filter(record("down", "unreachable", 100.5))
+               for _ in range(20)) == 2
+    assert sum(event_filter.filter(record("down", "unreachable", 102.0))
+               for _ in range(20)) == 5
+    assert event_filter.dropped["unreachable"] == 48
+    assert all(event_filter.filter(record("other", event)) for event in (None, "registered"))
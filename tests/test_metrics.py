@@ -0,0 +1,75 @@
+import urllib.request
+import system
+import utils
+from system.metrics import Metrics
+from system.utils import send_msg_tcp
+
+
+def test_render_prometheus_text():
+    """Test counters, gauges and timers render in the exposition format."""
+    metrics = Metrics()
+    metrics.counter("sms_things_total", "Things.", kind="a").inc(3)
+    metrics.gauge("sms_depth", "Depth.", lambda: 7)
+    timed = metrics.timed("sms_work_seconds", "Work.", lambda x: x * 2)
+    assert timed(21) == 42
+    assert timed(1) == 2
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE sms_things_total counter" in lines
+    assert 'sms_things_total{kind="a"} 3' in lines
+    assert "sms_depth 7" in lines
+    assert "# TYPE sms_work_seconds summary" in lines
+    assert "sms_work_seconds_count 2" in lines
+
+
+def test_sampled_method_times_one_call_per_recv():
+    """Test a sampled method is timed once, then runs unwrapped until re-armed."""
+    class Worker:
+        def work(self, x):
+            return x + 1
+
+    metrics = Metrics()
+    worker = Worker()
+    metrics.sampled(worker, "work", "sms_work_seconds", "Work.")
+    timer = metrics.timer("sms_work_seconds", "Work.")
+    assert [worker.work(1), worker.work(2)] == [2, 3]
+    assert "work" not in vars(worker)
+    metrics.timed_dispatch([{"message_type": "status"}], lambda msg: worker.work(0),
+                           lambda: False)
+    assert timer.totals()[0] == 2
+
+
+def test_producer_metrics_endpoint():
+    """Test a Producer with a metrics port serves its hot path metrics."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    metrics_port = utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=60)
+    producer = system.Producer(producer_port, monitor_port, msg_num=4,
+                               metrics_port=metrics_port)
+    system.Sender(utils.free_port(), producer_port, mean_time=0, failure_rate=0.0)
+
+    try:
+        utils.wait_until(lambda: producer.status["num_sent"] == 4)
+        url = "http://localhost:{}/metrics".format(metrics_port)
+        with urllib.request.urlopen(url, timeout=utils.TIMEOUT) as response:
+            text = response.read().decode("utf-8")
+        assert "sms_queue_depth 0" in text
+        assert "sms_senders 1" in text
+        assert 'sms_dispatch_seconds_count{type="finished"}' in text
+        assert "sms_msgs_received_total" in text
+        assert "sms_assign_seconds_count" in text
+        assert "sms_send_seconds_count" in text
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+
+def test_metrics_off_leaves_hot_paths_alone(mocker):
+    """Test nothing is wrapped when metrics are switched off."""
+    mocker.patch('socket.socket')
+    mocker.patch.object(system.Producer, "create_listen_thread")
+    producer = system.Producer(6000, 5999, msg_num=0)
+    assert producer.metrics is None
+    assert "dispatch" not in vars(producer)
+    assert "assign_messages" not in vars(producer)
+    assert "send" not in vars(producer.pool)
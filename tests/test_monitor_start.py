@@ -1,36 +1,60 @@
 import system
 import utils
-import json
+from system.monitor.__main__ import Totals
 
 def generate_monitor_message(mock_socket):
     """Generate msgs for monitor and wait for response."""
     # ask the monitor to start
-    yield json.dumps({
+    yield utils.frame({
         "message_type": "start",
-    }).encode('utf-8')
-    yield None
+    })
+
+    # wait for the subscription made on start
+    utils.wait_for_right_messages(is_subscribe, mock_socket, num=2)
 
-    # wait for update request 
-    utils.wait_for_right_messages(is_status_update, mock_socket)
+    # the producer answers with a snapshot, then pushes deltas
+    yield utils.frame({
+        "message_type": "stats_snapshot", "seq": 4,
+        "num_sent": 10, "num_fail": 2, "total_time": 30.0,
+        "histograms": {"send": [[3, 12]], "queue": [], "e2e": []},
+        "senders": {"6001": [[3, 12]]},
+    })
+    yield utils.frame({
+        "message_type": "stats", "seq": 5,
+        "num_sent": 1, "num_fail": 0, "total_time": 2.0,
+        "histograms": {"send": [[5, 1]], "queue": [], "e2e": []},
+        "senders": {"6002": [[5, 1]]},
+    })
+    # already part of the snapshot
+    yield utils.frame({
+        "message_type": "stats", "seq": 4,
+        "num_sent": 1, "num_fail": 0, "total_time": 2.0,
+        "histograms": {"send": [[5, 1]], "queue": [], "e2e": []},
+        "senders": {"6002": [[5, 1]]},
+    })
+    yield utils.frame({
+        "message_type": "stats", "seq": 6,
+        "num_sent": 0, "num_fail": 1, "total_time": 0.0,
+        "histograms": {"send": [[5, 1]], "queue": [], "e2e": []},
+        "senders": {"6001": [[5, 1]]},
+    })
 
     # shutdown
-    yield json.dumps({
+    yield utils.frame({
         "message_type": "shutdown",
-    }).encode('utf-8')
+    })
     yield None
 
 def test_monitor_start(mocker):
-    """Test monitor start monitoring after getting start msg from producer."""
+    """Test monitor subscribes after getting start msg and adds up pushed deltas."""
     mockmonitorsocket = mocker.MagicMock()
     mock_socket = mocker.patch('socket.socket')
-    mock_socket.return_value.__enter__.return_value.accept.return_value = (
-        mockmonitorsocket,
-        ("localhost", 10000),
-    )
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mockmonitorsocket)
     
     mockmonitorsocket.recv.side_effect = generate_monitor_message(mock_socket)
     try:
-        system.Monitor(
+        monitor = system.Monitor(
             port=5999,
             producer_port=6000,
             N = 1,
@@ -38,8 +62,30 @@ def test_monitor_start(mocker):
         utils.wait_for_threads()
     except SystemExit as error:
         assert error.code == 0
+    assert monitor.status == {"num_sent": 11, "num_fail": 3, "total_time": 32.0}
+    assert monitor.histograms["send"].count == 14
+    assert {port: h.count for port, h in monitor.sender_histograms.items()} == \
+        {6001: 13, 6002: 1}
+
+
+def test_monitor_resubscribes_on_gap(mocker):
+    """Test a lost delta makes the monitor ask for a fresh snapshot."""
+    mocker.patch('socket.socket')
+    monitor = system.Monitor.__new__(system.Monitor)
+    monitor.producer_port = 6000
+    monitor.shards = {6000: Totals()}
+    monitor.totals = monitor.shards[6000]
+    monitor.totals.seq = 1
+    monitor.subscribe = mocker.MagicMock()
+
+    monitor.handle_stats({"message_type": "stats", "seq": 3,
+                          "num_sent": 1, "num_fail": 0, "total_time": 1.0})
+    monitor.subscribe.assert_called_once()
+    assert monitor.seq is None
+    assert monitor.status["num_sent"] == 0
+
 
-def is_status_update(message):
-    """Test message type is status update request."""
+def is_subscribe(message):
+    """Test message type is a stats subscription."""
     return ("message_type" in message and
-        message["message_type"] == "status")
\ No newline at end of file
+        message["message_type"] == "subscribe")
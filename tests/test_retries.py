@@ -0,0 +1,64 @@
+import pytest
+from system.scheduler import create_scheduler
+from system.simulation import SenderProfile, Simulation
+from system.source import RetryQueue
+
+
+def test_retry_queue_hands_out_due_msgs_earliest_first():
+    """Test msgs are held until due and come out in due order."""
+    now = [0.0]
+    retry_queue = RetryQueue(lambda: now[0])
+    retry_queue.put((2, "456", "b"), 2.0)
+    retry_queue.put((1, "123", "a"), 1.0)
+    retry_queue.put((3, "789", "c"), 1.0)
+
+    assert retry_queue.pop_due() is None
+    assert retry_queue.next_due() == 1.0
+    now[0] = 1.5
+    assert [retry_queue.pop_due(), retry_queue.pop_due()] == [(1, "123", "a"), (3, "789", "c")]
+    assert retry_queue.pop_due() is None
+    assert len(retry_queue) == 1
+
+
+@pytest.mark.parametrize("name", ["fifo", "least-loaded", "fastest", "p2c"])
+def test_acquire_avoids_failed_sender(name):
+    """Test a retry goes to another Sender if any has a free credit, else to the same one."""
+    scheduler = create_scheduler(name)
+    scheduler.add_sender(3001, 2)
+    scheduler.add_sender(3002, 1)
+    for _ in range(10):
+        assert scheduler.acquire(avoid=3001) == 3002
+        scheduler.release(3002)
+
+    assert scheduler.acquire(avoid=3001) == 3002
+    assert scheduler.acquire(avoid=3001) == 3001
+    assert scheduler.acquire(avoid=3001) == 3001
+    assert scheduler.acquire(avoid=3001) is None
+
+
+def test_failed_msgs_are_retried_on_another_sender():
+    """Test msgs a flaky Sender fails are delivered by a reliable one after backoff."""
+    # the reliable Sender always has a free credit for a retry
+    profiles = [SenderProfile(1.0, 1.0, 4, std_time=0.0), SenderProfile(1.0, 0.0, 100, std_time=0.0)]
+    producer = Simulation(profiles, msg_num=100, retry_backoff=5.0, seed=2).run()
+
+    retries = producer.retries
+    assert retries["exhausted"] == 0
+    assert retries["retried"] > 0
+    assert retries["first_try"] + retries["retried"] == 100
+    # every attempt counts, the failed ones included
+    assert producer.status["num_sent"] == 100
+    assert producer.status["num_fail"] == retries["retried"]
+    assert not producer.attempts and not producer.retry_queue
+
+
+def test_msgs_are_given_up_after_max_attempts():
+    """Test a msg failing every attempt is counted once as exhausted."""
+    profiles = [SenderProfile(1.0, 1.0, 2, std_time=0.0)]
+    producer = Simulation(profiles, msg_num=10, max_attempts=3, retry_backoff=1.0,
+                          seed=4).run()
+
+    assert producer.retries == {"first_try": 0, "retried": 0, "exhausted": 10}
+    assert producer.status["num_fail"] == 30
+    # two backoffs of at least 0.5 and 1 secs between the three attempts
+    assert producer.clock() >= 3 * 1.0 + 1.5
@@ -0,0 +1,65 @@
+import random
+from system.scheduler import create_scheduler, PowerOfTwoScheduler
+
+
+def acquire_all(scheduler):
+    """Take every free credit and return the ports in pick order."""
+    ports = []
+    port = scheduler.acquire()
+    while port is not None:
+        ports.append(port)
+        port = scheduler.acquire()
+    return ports
+
+
+def test_fifo_hands_out_credits_in_order():
+    """Test fifo keeps the order senders registered and gave credits back in."""
+    scheduler = create_scheduler("fifo")
+    scheduler.add_sender(3001, 2)
+    scheduler.add_sender(3002, 1)
+    assert acquire_all(scheduler) == [3001, 3001, 3002]
+
+    scheduler.release(3002)
+    scheduler.release(3001)
+    assert acquire_all(scheduler) == [3002, 3001]
+
+
+def test_least_loaded_spreads_msgs():
+    """Test least-loaded balances msgs by the share of each window in use."""
+    scheduler = create_scheduler("least-loaded")
+    scheduler.add_sender(3001, 4)
+    scheduler.add_sender(3002, 2)
+    picks = [scheduler.acquire() for _ in range(3)]
+    assert sorted(picks) == [3001, 3001, 3002]
+
+
+def test_fastest_prefers_fast_reliable_sender():
+    """Test fastest routes msgs to the sender with the best expected time."""
+    scheduler = create_scheduler("fastest")
+    scheduler.add_sender(3001, 4)
+    scheduler.add_sender(3002, 4)
+    for _ in range(20):
+        scheduler.record(3001, True, 3.0)
+        scheduler.record(3002, random.random() > 0.3, 15.0)
+
+    picks = [scheduler.acquire() for _ in range(4)]
+    assert picks.count(3001) >= 3
+    assert len(acquire_all(scheduler)) == 4
+    assert scheduler.acquire() is None
+
+
+def test_p2c_only_picks_senders_with_credits():
+    """Test power-of-two-choices never overdraws a sender's window."""
+    scheduler = PowerOfTwoScheduler(rng=random.Random(0))
+    for port in range(3000, 3100):
+        scheduler.add_sender(port, 2)
+        scheduler.record(port, True, port - 2999)
+
+    picks = acquire_all(scheduler)
+    assert len(picks) == 200
+    assert all(picks.count(port) == 2 for port in range(3000, 3100))
+
+    scheduler.remove_sender(3000)
+    scheduler.release(3000)
+    scheduler.release(3001)
+    assert acquire_all(scheduler) == [3001]
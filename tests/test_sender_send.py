@@ -1,35 +1,31 @@
-import json
 import system
 import utils
 
 def generate_sender_message(mock_socket):
     """Generate msgs for sender and wait for response."""
     # send sender msg request
-    yield json.dumps({
+    yield utils.frame({
         "message_type": "sendmsg",
         "msg_id": 0,
         "phone": "123456789",
         "msg": "abc"
-    }).encode('utf-8')
-    yield None
+    })
 
     # wait for finished msgs 
     utils.wait_for_right_messages(is_finished, mock_socket)
 
     # shutdown
-    yield json.dumps({
+    yield utils.frame({
         "message_type": "shutdown",
-    }).encode('utf-8')
+    })
     yield None
 
 def test_sender_send(mocker):
     """Test sender successfully send msgs given msg sending requests."""
     mocksendersocket = mocker.MagicMock()
     mock_socket = mocker.patch('socket.socket')
-    mock_socket.return_value.__enter__.return_value.accept.return_value = (
-        mocksendersocket,
-        ("localhost", 10000),
-    )
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mocksendersocket)
     
     mocksendersocket.recv.side_effect = generate_sender_message(mock_socket)
     try:
@@ -0,0 +1,109 @@
+import json
+import pytest
+import system
+import utils
+from system.sharding import first_id, owner_of, shard_msgs, shard_of, split_rows
+from system.supervisor import build_children, load_config
+from system.utils import send_msg_tcp
+
+
+def test_shards_partition_msg_ids_and_phones():
+    """Test every generated msg id and every phone belongs to exactly one shard."""
+    ids = [[msg_id for msg_id, _, _ in shard_msgs(10, shard, 3)] for shard in range(3)]
+    assert ids == [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]]
+    # msgs already generated before a restart are skipped
+    assert [msg_id for msg_id, _, _ in shard_msgs(10, 1, 3, first=5)] == [7]
+    assert [first_id(10, shard, 3) for shard in range(3)] == [12, 10, 11]
+    assert [owner_of(msg_id, [6000, 6100, 6200]) for msg_id in (12, 10, 11)] == [6000, 6100, 6200]
+
+    rows = [("{:09d}".format(n), "msg") for n in range(3000)]
+    split = split_rows(rows, 3)
+    assert sorted(row for shard_rows in split for row in shard_rows) == rows
+    assert all(900 < len(shard_rows) < 1100 for shard_rows in split)
+    assert all(shard_of(row[0], 3) == shard for shard, shard_rows in enumerate(split)
+               for row in shard_rows)
+
+
+def test_shards_share_senders_and_monitor():
+    """Test two shards split generated and pushed msgs, share Senders and add up in the Monitor."""
+    monitor_port, sender_ports = utils.free_port(), [utils.free_port(), utils.free_port()]
+    shard_ports = [utils.free_port(), utils.free_port()]
+    monitor = system.Monitor(monitor_port, shard_ports, N=1)
+    shards = [system.Producer(port, monitor_port, msg_num=20, shard_ports=shard_ports)
+              for port in shard_ports]
+    senders = [system.Sender(port, shard_ports, mean_time=0, std_time=0, failure_rate=0.0,
+                             window=3) for port in sender_ports]
+    try:
+        # all pushed to the first shard, which passes on those of the other
+        alerts = [["{:09d}".format(n), "alert"] for n in range(10)]
+        send_msg_tcp(shard_ports[0], {"message_type": "enqueue", "msgs": alerts})
+        utils.wait_until(lambda: monitor.status["num_sent"] == 30)
+        with monitor.lock:
+            per_shard = {port: totals.status["num_sent"]
+                         for port, totals in monitor.shards.items()}
+            assert monitor.backlog == 0
+            assert monitor.histograms["e2e"].count == 30
+        owned = [len(rows) for rows in split_rows(alerts, 2)]
+        assert per_shard == {port: 10 + count for port, count in zip(shard_ports, owned)}
+        for shard, producer in enumerate(shards):
+            with producer.lock:
+                assert producer.senders == set(sender_ports)
+                assert not producer.in_flight
+                # every result made it back to the shard that handed the msg out
+                assert producer.status["num_sent"] == per_shard[producer.port]
+    finally:
+        # one shard going down takes the others with it
+        send_msg_tcp(shard_ports[0], {"message_type": "shutdown"})
+        utils.wait_for_threads()
+    assert all(producer.shut_down for producer in shards)
+    assert all(sender.shut_down for sender in senders)
+
+
+def test_forwarded_alerts_wait_for_high_water():
+    """Test alerts pushed to the wrong shard wait out the owner's high water off the sender's lock."""
+    monitor_port, shard_ports = utils.free_port(), [utils.free_port(), utils.free_port()]
+    system.Monitor(monitor_port, shard_ports, N=1)
+    shards = [system.Producer(port, monitor_port, msg_num=0, shard_ports=shard_ports,
+                              high_water=2)
+              for port in shard_ports]
+    alerts = [["{:09d}".format(n), "alert"] for n in range(40)]
+    own, foreign = split_rows(alerts, 2)
+    try:
+        send_msg_tcp(shard_ports[0], {"message_type": "enqueue", "msgs": foreign[:3]})
+        utils.wait_until(lambda: len(shards[1].queue) == 3)
+        # the next batch waits on the other shard until its queue drains
+        send_msg_tcp(shard_ports[0], {"message_type": "enqueue", "msgs": foreign[3:]})
+        # meanwhile the first shard keeps queueing what it owns
+        send_msg_tcp(shard_ports[0], {"message_type": "enqueue", "msgs": own})
+        utils.wait_until(lambda: len(shards[0].queue) == len(own))
+        assert len(shards[1].queue) == 3
+
+        sender = system.Sender(utils.free_port(), shard_ports, mean_time=0, std_time=0,
+                               failure_rate=0.0, window=2)
+        utils.wait_until(lambda: sum(shard.status["num_sent"] for shard in shards) == 40)
+        assert shards[1].status["num_sent"] == len(foreign)
+    finally:
+        send_msg_tcp(shard_ports[0], {"message_type": "shutdown"})
+        utils.wait_for_threads()
+    assert sender.shut_down
+
+
+def test_config_shards_producers(tmp_path):
+    """Test a producer section with shards turns into Producers every other component knows."""
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps({
+        "monitor": {"port": 7000},
+        "producer": {"port": 7001, "shards": 2},
+        "senders": [{"port": 7010}],
+    }))
+    monitor, producers, senders = build_children(load_config(str(path)))
+
+    assert [producer.port for producer in producers] == [7001, 7002]
+    assert producers[1].args[:2] == ["--port", "7002"]
+    assert producers[1].args.count("--shard-port") == 2
+    assert monitor.args.count("--producer-port") == 2
+    assert senders[0].args.count("--producer-port") == 2
+
+    path.write_text(json.dumps({"producer": {"shards": 2}, "autoscale": {"max": 4}}))
+    with pytest.raises(ValueError):
+        load_config(str(path))
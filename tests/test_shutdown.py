@@ -1,6 +1,6 @@
-import json
 import system
 import utils
+from system.utils import send_msg_tcp
 
 
 TIMEOUT = 10
@@ -10,14 +10,12 @@ def test_sender_shutdown(mocker):
     mock_socket = mocker.patch('socket.socket')
     mocksendersocket = mocker.MagicMock()
     mocksendersocket.recv.side_effect = [
-        json.dumps({"message_type": "shutdown"}).encode('utf-8'),
+        utils.frame({"message_type": "shutdown"}),
         None,
     ]
 
-    mock_socket.return_value.__enter__.return_value.accept.return_value = (
-        mocksendersocket,
-        ("localhost", 10000),
-    )
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mocksendersocket)
 
     try:
         system.Sender(
@@ -37,28 +35,24 @@ def test_producer_shutdown(mocker):
     mockproducersocket = mocker.MagicMock()
     mockproducersocket.recv.side_effect = [
         # First fake sender registers with producer
-        json.dumps({
+        utils.frame({
             "message_type": "register",
             "sender_port": 3001,
-        }).encode('utf-8'),
-        None,
+        }),
         # Second fake sender registers with producer
-        json.dumps({
+        utils.frame({
             "message_type": "register",
             "sender_port": 3002,
-        }).encode('utf-8'),
-        None,
+        }),
         # Fake shutdown message sent to producer
-        json.dumps({
+        utils.frame({
             "message_type": "shutdown",
-        }).encode('utf-8'),
+        }),
         None,
     ]
 
-    mock_socket.return_value.__enter__.return_value.accept.return_value = (
-        mockproducersocket,
-        ("localhost", 10000),
-    )
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mockproducersocket)
 
     try:
         system.Producer(port=6000, monitor_port=5999)
@@ -66,3 +60,19 @@ def test_producer_shutdown(mocker):
     except SystemExit as error:
         assert error.code == 0
 
+
+
+def test_producer_handles_msgs_while_shutting_down():
+    """Test the Producer waiting for the others to shut down does not hold its lock."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=1)
+    producer = system.Producer(producer_port, monitor_port, msg_num=0)
+    send_msg_tcp(producer_port, {"message_type": "shutdown"})
+    utils.wait_until(lambda: producer.shutting_down)
+    try:
+        assert producer.lock.acquire(timeout=0.5)
+        producer.lock.release()
+        assert not producer.shut_down
+    finally:
+        utils.wait_for_threads()
+    assert producer.shut_down
@@ -0,0 +1,42 @@
+import pytest
+from click.testing import CliRunner
+from system.simulation import SenderProfile, Simulation, main
+
+
+def test_simulation_runs_on_virtual_clock():
+    """Test every msg is sent in virtual time without sleeping."""
+    profile = SenderProfile(mean_time=1.0, failure_rate=0.0, window=2, std_time=0.0)
+    producer = Simulation([profile], msg_num=10, latency=0.1, seed=1).run()
+
+    assert producer.status["num_sent"] == 10
+    assert producer.status["total_time"] == pytest.approx(10.0)
+    # 5 rounds of 2 msgs in flight at once, each 1.2 secs with the round trip
+    assert producer.clock() == pytest.approx(6.0)
+    assert producer.histograms["e2e"].count == 10
+    assert not producer.in_flight
+
+
+def test_fastest_scheduler_favors_fast_sender():
+    """Test the simulation compares dispatch policies on the same fleet."""
+    profiles = [SenderProfile(1.0, 0.0, 4), SenderProfile(10.0, 0.0, 4)]
+    fifo = Simulation(profiles, msg_num=2000, scheduler="fifo", seed=3).run()
+    fastest = Simulation(profiles, msg_num=2000, scheduler="fastest", seed=3).run()
+
+    assert fastest.sender_histograms[6001].count > fifo.sender_histograms[6001].count
+    assert fastest.clock() < fifo.clock()
+
+
+def test_simulate_cli_reports_like_monitor():
+    """Test the CLI parses fleets, takes arrival rates and prints the Monitor report."""
+    result = CliRunner().invoke(main, [
+        "--sender", "2,0.5,4x3", "--msg-num", "500", "--rate", "10", "--seed", "7",
+    ])
+
+    assert result.exit_code == 0, result.output
+    assert "over 3 Senders" in result.output
+    assert "Number of messages sent" in result.output
+    assert "Number of messages failed" in result.output
+    assert "Sender 6003 send time" in result.output
+
+    result = CliRunner().invoke(main, ["--sender", "2,0.5"])
+    assert result.exit_code != 0
@@ -0,0 +1,51 @@
+import itertools
+import random
+import system
+import utils
+from system.source import IterSource, synthetic_msgs
+
+
+def test_synthetic_msgs_are_valid():
+    """Test generated msgs have sequential ids, 9-digit phones and 1-100 letters."""
+    msgs = list(synthetic_msgs(3000, rng=random.Random(1), chunk_size=512))
+    assert [msg_id for msg_id, _, _ in msgs] == list(range(3000))
+    for _, phone, msg in msgs:
+        assert len(phone) == 9 and phone.isdigit()
+        assert 1 <= len(msg) <= 100
+        assert msg.isalpha() and msg.islower()
+    assert len({msg for _, _, msg in msgs}) > 2900
+
+
+def test_synthetic_msgs_are_lazy():
+    """Test a huge workload costs nothing until msgs are pulled."""
+    msgs = synthetic_msgs(10 ** 12)
+    assert len(list(itertools.islice(msgs, 5))) == 5
+
+
+def test_producer_pulls_msgs_on_demand(mocker):
+    """Test the producer only takes as many msgs as senders have credits for."""
+    mock_socket = mocker.patch('socket.socket')
+    mockproducersocket = mocker.MagicMock()
+    mockproducersocket.recv.side_effect = [
+        utils.frame({
+            "message_type": "register",
+            "sender_port": 3001,
+            "credits": 3,
+        }),
+        utils.frame({"message_type": "shutdown"}),
+        None,
+    ]
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mockproducersocket)
+
+    pulled = []
+
+    def generate_msgs():
+        for msg_id in itertools.count():
+            pulled.append(msg_id)
+            yield msg_id, "123456789", "abc"
+
+    system.Producer(port=6000, monitor_port=5999, source=IterSource(generate_msgs()))
+    utils.wait_for_threads()
+
+    assert pulled == [0, 1, 2]
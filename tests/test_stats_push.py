@@ -0,0 +1,42 @@
+import pytest
+import system
+import utils
+from system.codec import CODECS
+from system.utils import ConnectionPool, send_msg_tcp
+
+
+def test_broadcast_encodes_once(mocker):
+    """Test a msg broadcast to many ports is encoded once per codec."""
+    mock_socket = mocker.patch('socket.socket')
+    encode = mocker.spy(CODECS["json"], "encode")
+    pool = ConnectionPool()
+    pool.broadcast([6001, 6002, 6003], {"message_type": "stats", "seq": 1})
+
+    assert encode.call_count == 1
+    assert mock_socket.return_value.sendall.call_count == 3
+
+
+def test_monitors_follow_pushed_stats():
+    """Test every subscribed Monitor, late ones included, ends up with the Producer totals."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    monitor = system.Monitor(monitor_port, producer_port, N=60)
+    # every msg is tried once, so each counts exactly once below
+    producer = system.Producer(producer_port, monitor_port, msg_num=8, stats_interval=0.05,
+                               max_attempts=1)
+    late_monitor = system.Monitor(utils.free_port(), producer_port, N=60, codec="binary")
+    for _ in range(2):
+        system.Sender(utils.free_port(), producer_port, mean_time=0, failure_rate=0.5)
+
+    try:
+        utils.wait_until(lambda: producer.status["num_sent"] + producer.status["num_fail"] == 8)
+        for each in (monitor, late_monitor):
+            utils.wait_until(lambda: each.status["num_fail"] == producer.status["num_fail"]
+                             and each.status["num_sent"] == producer.status["num_sent"])
+            assert each.status["total_time"] == pytest.approx(producer.status["total_time"])
+            utils.wait_until(lambda: each.histograms["e2e"].count == producer.status["num_sent"])
+            assert each.histograms["send"].counts == producer.histograms["send"].counts
+            assert each.histograms["queue"].count == 8
+            assert sum(h.count for h in each.sender_histograms.values()) == 8
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
@@ -0,0 +1,118 @@
+import json
+import logging
+import signal
+import threading
+import time
+import pytest
+import utils
+from click.testing import CliRunner
+from system.supervisor import Supervisor, build_children, load_config, main
+
+
+def fleet_config(tmp_path, senders=2, **sender_options):
+    """Return a config of a Monitor, a Producer and senders fast Senders on free ports."""
+    sender = {"mean_time": 0, "std_time": 0, "failure_rate": 0.0, "window": 2}
+    sender.update(sender_options)
+    return {
+        "socket_dir": str(tmp_path),
+        "monitor": {"port": utils.free_port(), "N": 1},
+        "producer": {"port": utils.free_port(), "msg_num": 20},
+        "senders": [dict(sender, port=utils.free_port()) for _ in range(senders)],
+    }
+
+
+def test_config_becomes_command_lines(tmp_path):
+    """Test config sections turn into flags, with the ports components need filled in."""
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps({
+        "monitor": {"port": 7000, "N": 5},
+        "producer": {"port": 7001, "msg_num": 10, "lane_weight": ["critical=4", "bulk=1"]},
+        "senders": [{"port": 7010, "mean_time": 1, "count": 3}],
+    }))
+    monitor, (producer,), senders = build_children(load_config(str(path)))
+
+    assert monitor.args == ["--port", "7000", "--N", "5", "--producer-port", "7001",
+                            "--socket-dir", "/tmp/sms-alert-system"]
+    assert producer.args[:8] == ["--port", "7001", "--msg-num", "10",
+                                 "--lane-weight", "critical=4", "--lane-weight", "bulk=1"]
+    assert "--monitor-port" in producer.args
+    assert [sender.port for sender in senders] == [7010, 7011, 7012]
+    assert senders[2].args[-2:] == ["--port", "7012"]
+
+    path.write_text(json.dumps({"sender": []}))
+    with pytest.raises(ValueError):
+        load_config(str(path))
+
+
+def test_supervisor_starts_restarts_and_stops(tmp_path):
+    """Test the fleet starts on readiness, a killed Sender comes back and stop is bounded."""
+    supervisor = Supervisor(fleet_config(tmp_path), stop_timeout=5.0, restart_backoff=0.1)
+    runner = threading.Thread(target=supervisor.run)
+    try:
+        elapsed = supervisor.start()
+        assert all(child.ready is not None for child in supervisor.children)
+        assert elapsed < utils.TIMEOUT
+        dispatched = supervisor.wait_dispatched(utils.TIMEOUT)
+        assert dispatched is not None and dispatched >= supervisor.producer.ready
+
+        runner.start()
+        sender = supervisor.senders[0]
+        crashed = sender.process
+        crashed.send_signal(signal.SIGKILL)
+        utils.wait_until(lambda: sender.process is not crashed and sender.ready is not None)
+        assert len(sender.restarts) == 1
+    finally:
+        start = time.monotonic()
+        supervisor.request_stop()
+        if runner.ident is not None:
+            runner.join()
+        else:
+            supervisor.stop()
+    assert time.monotonic() - start < supervisor.stop_timeout + 1
+    assert not any(child.alive() for child in supervisor.children)
+    # the fleet went down through its shutdown msg, nothing had to be killed
+    assert all(child.process.returncode == 0 for child in supervisor.children)
+
+
+def test_stop_command_shuts_the_fleet_down(tmp_path):
+    """Test the stop command reaches the fleet of the config and its supervisor exits."""
+    config = fleet_config(tmp_path, senders=1)
+    config["producer"]["shards"] = 2
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps(config))
+    supervisor = Supervisor(load_config(str(path)), stop_timeout=5.0)
+    runner = threading.Thread(target=supervisor.run)
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    try:
+        supervisor.start()
+        runner.start()
+        result = CliRunner().invoke(main, ["stop", "--config", str(path)])
+        assert result.exit_code == 0, result.output
+        runner.join(utils.TIMEOUT)
+        assert not runner.is_alive()
+        assert all(child.process.returncode == 0 for child in supervisor.children)
+
+        result = CliRunner().invoke(main, ["stop", "--config", str(path)])
+        assert result.exit_code != 0 and "no Producer listening" in result.output
+    finally:
+        if runner.is_alive():
+            supervisor.request_stop()
+            runner.join()
+        else:
+            supervisor.stop()
+        # every command sets up the logging of a supervisor process of its own
+        for handler in root_logger.handlers[len(handlers):]:
+            root_logger.removeHandler(handler)
+            handler.close()
+
+
+def test_supervisor_fails_start_of_broken_component(tmp_path):
+    """Test a component exiting before it is ready fails the start instead of hanging it."""
+    supervisor = Supervisor(fleet_config(tmp_path, senders=1, window=0))
+    try:
+        with pytest.raises(RuntimeError):
+            supervisor.start()
+    finally:
+        supervisor.stop()
+    assert not any(child.alive() for child in supervisor.children)
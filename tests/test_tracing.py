@@ -0,0 +1,67 @@
+import os
+import system
+import utils
+from system.tracing import TraceFile, Tracer, load_events
+from system.utils import send_msg_tcp
+
+
+def test_trace_file_rotates(tmp_path):
+    """Test full trace files are rotated and every file opens on its own."""
+    path = str(tmp_path / "producer-6000.json")
+    header = [{"name": "process_name", "ph": "M", "pid": 6000, "args": {"name": "Producer"}}]
+    trace_file = TraceFile(path, header, max_bytes=400, backups=2)
+    for tid in range(20):
+        trace_file.write([{"name": "send", "ph": "X", "pid": 6000, "tid": tid, "ts": 0, "dur": 1}])
+    trace_file.flush()
+
+    # the current file is still open and has no closing bracket yet
+    files = [path, path + ".1", path + ".2"]
+    assert not os.path.exists(path + ".3")
+    for name in files:
+        events = load_events(name)
+        assert events[0] == header[0]
+        assert len(events) > 1
+    trace_file.close()
+    assert load_events(path)[-1]["tid"] == 19
+
+
+def test_tracer_buffers_spans(tmp_path):
+    """Test spans are written as complete events keyed by msg_id."""
+    tracer = Tracer(str(tmp_path), "Sender", 6001, flush_interval=60)
+    tracer.span("send", 7, 1.0, 1.5, {"success": True})
+    tracer.close()
+
+    _, event = load_events(str(tmp_path / "sender-6001.json"))
+    assert event == {"name": "send", "cat": "msg", "ph": "X", "pid": 6001, "tid": 7,
+                     "ts": 1000000, "dur": 500000, "args": {"msg_id": 7, "success": True}}
+
+
+def test_system_traces_msg_lifecycle(tmp_path):
+    """Test a traced msg gets spans from the Producer and the Sender that line up."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    sender_port = utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=1)
+    producer = system.Producer(producer_port, monitor_port, msg_num=4, batch_size=2,
+                               codec="binary", trace_dir=str(tmp_path), trace_sample=1.0)
+    system.Sender(sender_port, producer_port, mean_time=0, failure_rate=0.0, window=2,
+                  codec="binary", trace_dir=str(tmp_path))
+
+    try:
+        utils.wait_until(lambda: producer.status["num_sent"] == 4)
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+    producer_spans = load_events(str(tmp_path / "producer-{}.json".format(producer_port)))
+    sender_spans = load_events(str(tmp_path / "sender-{}.json".format(sender_port)))
+    assert not producer.traced
+    for msg_id in range(4):
+        spans = {event["name"]: event for event in producer_spans + sender_spans
+                 if event.get("tid") == msg_id}
+        assert set(spans) == {"queued", "assign", "wire", "waiting", "send", "finished"}
+        assert spans["send"]["args"]["success"] is True
+        assert spans["queued"]["ts"] <= spans["assign"]["ts"] <= spans["send"]["ts"]
+        assert spans["send"]["ts"] <= spans["finished"]["ts"]
+        wire = [event for event in producer_spans + sender_spans
+                if event.get("tid") == msg_id and event["name"] == "wire"]
+        assert {event["pid"] for event in wire} == {producer_port, sender_port}
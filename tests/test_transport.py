@@ -0,0 +1,65 @@
+import os
+import socket
+import threading
+import pytest
+import system
+import utils
+from system.utils import ConnectionPool, send_msg_tcp, serve_tcp, socket_path
+
+
+def test_pool_prefers_unix_socket(tmp_path):
+    """Test peers serving a Unix socket are reached through it, any other over TCP."""
+    socket_dir = str(tmp_path)
+    port, tcp_only_port = utils.free_port(), utils.free_port()
+    received = []
+    shut_down = []
+    threads = []
+    for each, each_dir in ((port, socket_dir), (tcp_only_port, None)):
+        ready = threading.Event()
+        thread = threading.Thread(target=serve_tcp, args=(
+            each, received.append, lambda: shut_down, ready, None, each_dir))
+        thread.start()
+        ready.wait(utils.TIMEOUT)
+        threads.append(thread)
+    assert os.path.exists(socket_path(socket_dir, port))
+
+    pool = ConnectionPool(socket_dir=socket_dir)
+    try:
+        pool.send(port, {"message_type": "status", "n": 1})
+        pool.send(tcp_only_port, {"message_type": "status", "n": 2})
+        # the TCP listener stays up for peers on other hosts
+        send_msg_tcp(port, {"message_type": "status", "n": 3})
+        utils.wait_until(lambda: len(received) == 3)
+        assert sorted(m["n"] for m in received) == [1, 2, 3]
+        assert pool.conns[port].family == socket.AF_UNIX
+        assert pool.conns[tcp_only_port].family == socket.AF_INET
+    finally:
+        pool.close()
+        shut_down.append(True)
+        for thread in threads:
+            thread.join()
+    assert not os.path.exists(socket_path(socket_dir, port))
+
+
+@pytest.mark.parametrize("server_mode", ["thread", "asyncio"])
+def test_system_over_unix_sockets(tmp_path, server_mode):
+    """Test the whole system delivers every msg with components talking over Unix sockets."""
+    socket_dir = str(tmp_path)
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    monitor = system.Monitor(monitor_port, producer_port, N=1, server_mode=server_mode,
+                             socket_dir=socket_dir)
+    producer = system.Producer(producer_port, monitor_port, msg_num=6, server_mode=server_mode,
+                               socket_dir=socket_dir)
+    senders = [system.Sender(utils.free_port(), producer_port, mean_time=0, failure_rate=0.0,
+                             server_mode=server_mode, socket_dir=socket_dir) for _ in range(2)]
+
+    try:
+        utils.wait_until(lambda: producer.status["num_sent"] == 6)
+        utils.wait_until(lambda: monitor.status["num_sent"] == 6)
+        for sender in senders:
+            assert producer.pool.conns[sender.port].family == socket.AF_UNIX
+            assert sender.pool.conns[producer_port].family == socket.AF_UNIX
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+    assert os.listdir(socket_dir) == []
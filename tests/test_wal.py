@@ -0,0 +1,126 @@
+import os
+import system
+import utils
+from system.utils import send_msg_tcp
+from system.wal import WriteAheadLog
+
+
+def test_wal_replays_queue_and_stats(tmp_path):
+    """Test recovery requeues unfinished msgs and rebuilds the counters."""
+    wal = WriteAheadLog(str(tmp_path))
+    wal.recover()
+    for msg_id in range(4):
+        wal.log_enqueued(msg_id, "12345678{}".format(msg_id), "msg {}".format(msg_id))
+    wal.log_assigned(0, 3001)
+    wal.log_assigned(1, 3001)
+    wal.log_finished(0, True, 2.5)
+    wal.log_finished(2, False, 1.0)
+    # failed once and waiting for its retry
+    wal.log_retried(1, 0.5)
+    wal.close()
+
+    wal = WriteAheadLog(str(tmp_path))
+    state = wal.recover()
+    wal.close()
+    assert list(state.pending.values()) == [
+        (1, "123456781", "msg 1"), (3, "123456783", "msg 3"),
+    ]
+    assert state.requeued == 0
+    assert state.next_msg_id == 4
+    assert state.status == {"num_sent": 1, "num_fail": 2, "total_time": 2.5}
+
+
+def test_wal_stops_at_torn_record(tmp_path):
+    """Test a half written record is ignored and overwritten after recovery."""
+    wal = WriteAheadLog(str(tmp_path))
+    wal.recover()
+    wal.log_enqueued(0, "123456789", "kept")
+    position = wal.segment.position
+    wal.segment.map[position:position + 6] = b"\x30\x00\x00\x00\xff\xff"
+    wal.close()
+
+    wal = WriteAheadLog(str(tmp_path))
+    assert list(wal.recover().pending) == [0]
+    wal.log_enqueued(1, "123456789", "appended")
+    wal.close()
+
+    wal = WriteAheadLog(str(tmp_path))
+    assert list(wal.recover().pending) == [0, 1]
+    wal.close()
+
+
+def test_wal_compacts_old_segments(tmp_path):
+    """Test full segments are folded into a checkpoint without losing state."""
+    wal = WriteAheadLog(str(tmp_path), segment_size=4096, compact_after=2)
+    wal.recover()
+    for msg_id in range(500):
+        wal.log_enqueued(msg_id, "123456789", "x" * 20, lane=0 if msg_id % 10 == 0 else 1)
+        if msg_id % 5:
+            wal.log_finished(msg_id, True, 1.0)
+    wal.close()
+
+    names = os.listdir(str(tmp_path))
+    assert any(name.startswith("checkpoint") for name in names)
+    assert len([name for name in names if name.startswith("segment")]) < 10
+
+    wal = WriteAheadLog(str(tmp_path), segment_size=4096)
+    state = wal.recover()
+    wal.close()
+    assert list(state.pending) == list(range(0, 500, 5))
+    # only msgs outside the default lane record theirs
+    assert state.lanes == dict.fromkeys(range(0, 500, 10), 0)
+    assert state.status == {"num_sent": 400, "num_fail": 0, "total_time": 400.0}
+    assert state.next_msg_id == 500
+
+
+def test_producer_recovers_from_wal(mocker, tmp_path):
+    """Test a restarted producer sends the msgs left over in its log first."""
+    wal = WriteAheadLog(str(tmp_path))
+    wal.recover()
+    wal.log_enqueued(7, "123456789", "left over", generated=True)
+    wal.log_assigned(7, 3001)
+    wal.close()
+
+    mock_socket = mocker.patch('socket.socket')
+    mockproducersocket = mocker.MagicMock()
+    mockproducersocket.recv.side_effect = [
+        utils.frame({"message_type": "register", "sender_port": 3001, "credits": 2}),
+        utils.frame({"message_type": "shutdown"}),
+        None,
+    ]
+    mock_socket.return_value.__enter__.return_value.accept.side_effect = \
+        utils.accept_once(mockproducersocket)
+
+    system.Producer(port=6000, monitor_port=5999, msg_num=10, wal_dir=str(tmp_path))
+    utils.wait_for_threads()
+
+    tasks = [m for m in utils.get_messages(mock_socket) if m["message_type"] == "sendmsg"]
+    assert [(task["msg_id"], task["msg"]) for task in tasks][0] == (7, "left over")
+    # generated msgs resume after the last one logged
+    assert tasks[1]["msg_id"] == 8
+
+
+def test_producer_recovers_failure_counts(tmp_path):
+    """Test a restarted Producer counts every failed attempt, not only the final ones."""
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=1)
+    producer = system.Producer(producer_port, monitor_port, msg_num=3, wal_dir=str(tmp_path),
+                               max_attempts=2, retry_backoff=0.01)
+    system.Sender(utils.free_port(), producer_port, mean_time=0, std_time=0, failure_rate=1.0)
+    try:
+        utils.wait_until(lambda: producer.retries["exhausted"] == 3)
+        status = dict(producer.status)
+        assert status["num_fail"] == 6
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
+
+    monitor_port, producer_port = utils.free_port(), utils.free_port()
+    system.Monitor(monitor_port, producer_port, N=1)
+    producer = system.Producer(producer_port, monitor_port, msg_num=3, wal_dir=str(tmp_path))
+    try:
+        assert producer.status == status
+        assert not producer.queue
+    finally:
+        send_msg_tcp(producer_port, {"message_type": "shutdown"})
+        utils.wait_for_threads()
@@ -1,6 +1,7 @@
 import time
 import threading
 import json
+import socket
 
 TIMEOUT = 10
 TIMEOUT_LONG = 30
@@ -14,6 +15,40 @@ def wait_for_threads(num=1):
     raise Exception("Failed to close threads.")
 
 
+def accept_once(conn):
+    """Return an accept() side effect handing out conn once, then timing out."""
+    connections = iter([(conn, ("localhost", 10000))])
+
+    def accept():
+        try:
+            return next(connections)
+        except StopIteration:
+            time.sleep(0.1)
+            raise socket.timeout
+    return accept
+
+
+def free_port():
+    """Return a localhost port nobody is listening on."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(condition, timeout=TIMEOUT):
+    """Poll until condition() is True, fail after timeout secs."""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise Exception("Condition not met in time.")
+        time.sleep(0.05)
+
+
+def frame(message_dict):
+    """Encode a msg dict as a single newline-delimited wire frame."""
+    return json.dumps(message_dict).encode('utf-8') + b'\n'
+
+
 def wait_for_right_messages(function, mock_socket, num=1):
     """Return when function() evaluates to True on num messages."""
     for _ in get_right_messages(function, mock_socket, num):
@@ -38,11 +73,12 @@ def get_messages(mock_socket):
 
     # Add sendall returns that do and do not use context managers
     args_list = \
-        mock_socket.return_value.__enter__.return_value.sendall.call_args_list
+        mock_socket.return_value.__enter__.return_value.sendall.call_args_list + \
+        mock_socket.return_value.sendall.call_args_list
 
     for args, _ in args_list:
         message_str = args[0].decode('utf-8')
-        message_dict = json.loads(message_str)
-        messages.append(message_dict)
+        for line in message_str.splitlines():
+            messages.append(json.loads(line))
 
     return messages